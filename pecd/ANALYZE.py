@@ -8,6 +8,7 @@ from scipy.special import sph_harm
 from scipy.special import eval_legendre
 from scipy import integrate
 from scipy import interpolate   
+from scipy import sparse
 
 
 import h5py
@@ -22,6 +23,7 @@ import GRID
 import CONSTANTS
 import PLOTS
 import GRAPHICS
+import QUEUE
 
 import matplotlib.gridspec as gridspec
 import matplotlib.pyplot as plt
@@ -376,8 +378,9 @@ class analysis:
         """ Calculate real-space grid (r,theta) for evaluation of Hankel transform and for plottting"""
         """ The real-space grid determines the k-space grid returned by PyHank """
 
-        nbins   = self.params['prop_nbins'] 
-        rmax    = nbins * self.params['bound_binw']
+        rmax    = 0.0
+        for elem in self.params['FEMLIST_PROP']:
+            rmax += elem[0] * elem[2]
         npts    = self.params['npts_r_ft'] 
         N_red   = npts 
 
@@ -393,7 +396,7 @@ class analysis:
         irun                    = self.params['irun']
 
         # which grid point corresponds to the radial cut-off?
-        self.params['ipoint_cutoff'] = np.argmin(np.abs(self.params['Gr'].ravel() - self.params['rcutoff']))
+        self.params['ipoint_cutoff'] = np.argmin(np.abs(GRID.r_points(self.params['Gr']) - self.params['rcutoff']))
         print("ipoint_cutoff = " + str(self.params['ipoint_cutoff']))
 
         """ set up time grids for evaluating wfn """
@@ -460,74 +463,84 @@ class analysis:
         return FT
 
 
-    def calc_partial_waves(self, grid_r, wavepacket):
+    def chi_basis_matrix(self, grid_r):
         """
-        returns: list of numpy arrays. List is labelled by l,m and t_i from 'momentum_analyze_time'
+        returns: sparse matrix B[ipoint, ielem] = chi_ielem(grid_r[ipoint]) of the radial basis functions in maparray_chi.
+        Columns of functions with radial index <= ipoint_cutoff are zero (cut-out bound-state electron density).
+        Built once per (grid_r, ipoint_cutoff) and kept in params['chi_basis_matrix'].
         """
+        ipoint_cutoff   = self.params['ipoint_cutoff']
+        cached          = self.params.get('chi_basis_matrix')
+        if cached is not None and cached['ipoint_cutoff'] == ipoint_cutoff and np.array_equal(cached['grid_r'], grid_r):
+            return cached['B']
 
-        Plm = []
-        lmax            = self.params['bound_lmax']
-        maparray_global = self.params['maparray_global']
-        maparray_chi    = self.params['maparray_chi']
         chilist         = self.params['chilist']
-        ipoint_cutoff   = self.params['ipoint_cutoff']
+        maparray_chi    = self.params['maparray_chi']
+
+        rows = [np.zeros(0, dtype = int)] #empty matrix if all functions are cut out
+        cols = [np.zeros(0, dtype = int)]
+        vals = [np.zeros(0, dtype = float)]
+        for ielem, elem in enumerate(maparray_chi):
+            if elem[2] > ipoint_cutoff:
+                chi     = chilist[elem[2]-1](grid_r)
+                inz     = np.flatnonzero(chi) #chi vanishes outside of its bin(s)
+                rows.append(inz)
+                cols.append(np.full(inz.size, ielem))
+                vals.append(chi[inz])
+
+        B = sparse.csr_matrix( (np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))), 
+                                shape = (grid_r.size, len(maparray_chi)) )
+
+        self.params['chi_basis_matrix'] = {'grid_r': grid_r.copy(), 'ipoint_cutoff': ipoint_cutoff, 'B': B}
+        return B
+
+
+    def calc_partial_waves(self, grid_r, wavepacket):
+        """
+        returns: numpy array Plm[itime, indang, ipoint] of the partial waves at times itime from 'momentum_analyze_time',
+        with indang running over (l,m) = (0,0), (1,-1), (1,0), ..., evaluated on grid_r
+        """
+        lmax            = self.params['bound_lmax']
         
         Nt              = wavepacket.shape[0] #number of evaluation times
-        Nbas            = len(maparray_global)
-        Nr              = len(maparray_chi)
-        npts = grid_r.size #number of radial grid point at which Plm are evaluated. This grid determines the maximum photoelectron momentum.
+        Nr              = len(self.params['maparray_chi'])
+        npts            = grid_r.size #number of radial grid point at which Plm are evaluated. This grid determines the maximum photoelectron momentum.
         
+        B               = self.chi_basis_matrix(grid_r)
+
+        # wavepacket coefficients are ordered as (radial function, (l,m)): one product for all times and partial waves
+        c_arr           = wavepacket.reshape(Nt, Nr, -1)
+        Nang            = c_arr.shape[2]
+        Plm             = (B @ c_arr.transpose(1,0,2).reshape(Nr, Nt * Nang)).reshape(npts, Nt, Nang).transpose(1,2,0)
+        print("partial waves: " + str(Nt) + " time-points, " + str(Nang) + " (l,m) pairs, " + str(npts) + " radial points")
+
+        if self.params['plot_Plm'] == True:
+            #only for itime =0:
+            for s in range((lmax+1)**2):
+                plt.plot(grid_r,np.abs(Plm[0,s,:]),marker='.',label="P_"+str(s))
+                plt.legend()
+            plt.show()
+            plt.close()
+        return Plm
 
-        val = np.zeros(npts, dtype = complex)
 
+    def calc_hankel_transforms(self, Plm, grid_r):
+        Flm = [] #list of output Hankel transforms
+        lmax = self.params['bound_lmax']
 
-        for itime in range(Nt):
-            psi = wavepacket[itime,:]
-            c_arr = psi.reshape(len(maparray_chi),-1)
-            print("time-point: " + str(itime))
-            val = 0.0 + 1j * 0.0
+        for itime in range(Plm.shape[0]):
             indang = 0
             for l in range(0,lmax+1):
+                Hank_obj = HankelTransform(l, radial_grid = grid_r) #max_radius=200.0, n_points=1000) #radial_grid=fine_grid)
                 for m in range(-l,l+1):
-                    print("P_lm: " + str(l) + " " + str(m))
-                
-                    for ielem, elem in enumerate(maparray_chi):
-                        if elem[2] > ipoint_cutoff: #cut-out bound-state electron density
-
-                            val +=  c_arr[ielem][indang] * chilist[elem[2]-1](grid_r)
+                    print("Calculating Hankel transform for time-point =  " + str(itime) + " for partial wave Plm: " + str(l) + " " + str(m))
 
+                    Plm_resampled = Hank_obj.to_transform_r(Plm[itime,indang,:])
+                    F = Hank_obj.qdht(Plm_resampled)
+                    Flm.append([itime,l,m,F])
                     indang += 1
-                    Plm.append([itime,l,m,val])
-                    val = 0.0 + 1j * 0.0
-
-            if self.params['plot_Plm'] == True:
-
-
-                #for i in range(Nr):
-                #    plt.plot(grid_r,chilist[i](grid_r))
-                #plt.show()
-                #only for itime =0:
-                for s in range((lmax+1)**2):
-                    plt.plot(grid_r,np.abs(Plm[s][3]),marker='.',label="P_"+str(s))
-                    plt.legend()
-                plt.show()
-                plt.close()
-        return Plm
-
-
-    def calc_hankel_transforms(self, Plm, grid_r):
-        Flm = [] #list of output Hankel transforms
-    
-        for ielem, elem in enumerate(Plm):
-            print("Calculating Hankel transform for time-point =  " + str(elem[0]) + " for partial wave Plm: " + str(elem[1]) + " " + str(elem[2]))
-
-            Hank_obj = HankelTransform(elem[1], radial_grid = grid_r) #max_radius=200.0, n_points=1000) #radial_grid=fine_grid)
-            #Hank.append(Hank_obj) 
-            Plm_resampled = Hank_obj.to_transform_r(elem[3])
-            F = Hank_obj.qdht(Plm_resampled)
-            Flm.append([elem[0],elem[1],elem[2],F])
-            if  params['plot_Flm']  == True:
-                plt.plot(Hank_obj.kr,np.abs(F))
+                    if  params['plot_Flm']  == True:
+                        plt.plot(Hank_obj.kr,np.abs(F))
         
         if  params['plot_Flm']  == True:   
             plt.show()
@@ -537,14 +550,18 @@ class analysis:
 
 
 
-    def barray_plot_2D(self,grid_euler,ibcoeff,funcpars):
+    def barray_plot_2D(self,grid_euler,ibcoeff,funcpars,weights = None,rep = None):
         """ Produces contour plot for b(beta,gamma) """
 
         """
         Args:
+            weights: quadrature weights of the Euler grid (grid_euler_weights.dat); None for uniform weights
+            rep: index of the symmetry-equivalent representative of each orientation, whose b-coefficients are used
             
         Comments:
-            1)
+            1) The orientation-averaged b-coefficients sum_i w_i b(i) are saved in barray_av.dat, once the
+               b-coefficients of all orientations are present. Each batch calls this function at its end: the
+               batch which completes the grid writes the average.
 
         """
 
@@ -553,6 +570,9 @@ class analysis:
         N_Euler = grid_euler.shape[0]
     
         barray = np.zeros((N_Euler,4+2*(self.params['Leg_lmax']+1)), dtype = float)
+        found  = np.zeros(N_Euler, dtype = bool)
+        if rep is None:
+            rep = np.arange(N_Euler)
         
         #for each time pointer
         #for each k pointer
@@ -561,7 +581,7 @@ class analysis:
             barray[irun,0],barray[irun,1] = grid_euler[irun,1], grid_euler[irun,2]
             for t in list(self.params['momentum_analyze_times']):
                 file = self.params['job_directory'] +  "bcoeffs" +\
-                            "_" + str(irun) + "_"  + str('{:.1f}'.format(t) ) +\
+                            "_" + str(rep[irun]) + "_"  + str('{:.1f}'.format(t) ) +\
                             ".dat"
 
                 barray[irun,2] = t
@@ -569,6 +589,7 @@ class analysis:
                     continue
                 else:
                     with open(  file , 'r') as pecdfile:
+                        found[irun] = True
                         barray[irun,2] = t
                         #for ikelem, k in enumerate(self.params['pecd_momenta']):
 
@@ -582,6 +603,21 @@ class analysis:
         with open( params['job_directory'] +  "barray.dat" , 'w') as barfile:   
             np.savetxt(barfile, barray, fmt = '%12.8f')
 
+        """ orientation average with the quadrature weights of the Euler grid """
+        if weights is None:
+            weights = np.full(N_Euler, 1.0 / N_Euler)
+
+        if not np.all(found):
+            print("b-coefficients missing for " + str(N_Euler - np.count_nonzero(found)) + " of " + str(N_Euler) + \
+                    " orientations: orientation average not written")
+        else:
+            barray_av   = np.dot(weights / np.sum(weights), barray[:,3:])
+            print("Orientation-averaged b-coefficients: " + str(barray_av[1:]))
+            tmpfile = params['job_directory'] +  "barray_av.dat." + str(os.getpid()) + ".tmp"
+            with open( tmpfile , 'w') as barfile:   
+                np.savetxt(barfile, barray_av[None,:], fmt = '%12.8f')
+            os.replace(tmpfile, params['job_directory'] +  "barray_av.dat")
+
 
         bcoef = barray[:,4+ibcoeff]
 
@@ -2148,21 +2184,18 @@ if __name__ == "__main__":
                                                                                     params['map_type'], 
                                                                                     path )
 
-    params['Gr'], params['Nr ']                         = GRID.r_grid(              params['bound_nlobs'], 
-                                                                                    params['prop_nbins'] , 
-                                                                                    params['bound_binw'],  
+    params['Gr'], params['Nr ']                         = GRID.r_grid_femlist(      params['FEMLIST_PROP'], 
                                                                                     params['bound_rshift'] )
 
-    params['Gr_prim'], params['Nr_prim']                = GRID.r_grid_prim(         params['bound_nlobs'], 
-                                                                                    params['prop_nbins'], 
-                                                                                    params['bound_binw'], 
+    params['Gr_prim'], params['Nr_prim']                = GRID.r_grid_prim_femlist( params['FEMLIST_PROP'], 
                                                                                     params['bound_rshift'] )
 
     params['chilist']                                   = PLOTS.interpolate_chi(    params['Gr_prim'], 
                                                                                     params['bound_nlobs'], 
                                                                                     params['prop_nbins'], 
                                                                                     params['bound_binw'], 
-                                                                                    params['maparray_chi'])
+                                                                                    params['maparray_chi'],
+                                                                                    femlist = params['FEMLIST_PROP'])
 
     """ Read grid of Euler angles"""
     with open( "grid_euler.dat" , 'r') as eulerfile:   
@@ -2172,7 +2205,26 @@ if __name__ == "__main__":
 
     N_Euler = grid_euler.shape[0]
 
-    N_per_batch = int(N_Euler/params['N_batches'])
+    """ Quadrature weights of the orientations (uniform for grids without weights file) """
+    if os.path.isfile("grid_euler_weights.dat"):
+        weights_euler = np.loadtxt("grid_euler_weights.dat").reshape(-1)
+    else:
+        weights_euler = np.full(N_Euler, 1.0 / N_Euler)
+
+    """ Symmetry-equivalent orientations (PROPAGATE.save_euler_rep): results of the representative are used """
+    if os.path.isfile("grid_euler_rep.dat"):
+        rep_euler = np.loadtxt("grid_euler_rep.dat", dtype = int).reshape(-1)
+    else:
+        rep_euler = np.arange(N_Euler)
+    unique_euler = np.flatnonzero(rep_euler == np.arange(N_Euler))
+
+    """ Orientations of this batch: claimed one at a time from the shared queue, or a fixed chunk of the grid.
+        The queue is keyed on the grid (and its symmetry map) as well, since orientations are queued by index. """
+    if params['orient_queue'] == True:
+        iruns = QUEUE.orientation_queue(params, "analyze_" + QUEUE.params_hash(params_analyze)[:8] + "_" + \
+                                        QUEUE.array_hash(grid_euler, rep_euler)[:8], N_Euler, ibatch)
+    else:
+        iruns = [ unique_euler[k] for k in QUEUE.static_batch(len(unique_euler), params['N_batches'], ibatch) ]
 
 
 
@@ -2183,7 +2235,11 @@ if __name__ == "__main__":
 
 
 
-    for irun in range(ibatch * N_per_batch, (ibatch+1) * N_per_batch):
+    for irun in iruns:
+        if rep_euler[irun] != irun:
+            print("grid point " + str(irun) + " is equivalent to " + str(rep_euler[irun]) + " by symmetry, skipping")
+            continue
+
         print("processing grid point: " + str(irun) + " " + str(grid_euler[irun]) )
 
         alpha   = grid_euler[irun][0]
@@ -2196,7 +2252,20 @@ if __name__ == "__main__":
         params['irun'] = irun 
 
         analysis_obj    = analysis(params)
-        
+
+        """ skip orientations analyzed with the same input and the same (complete) wavepacket """
+        file_wavepacket = params['job_directory'] + params['wavepacket_file'] + analysis_obj.pull_helicity() + \
+                            "_" + str(irun) + "." + params['wavepacket_format']
+        markerfile      = params['job_directory'] + "analyze_" + str(irun) + ".done"
+        analyze_hash    = QUEUE.params_hash(params_analyze)
+
+        if params['resume'] == True:
+            marker = QUEUE.marker_read(markerfile)
+            if  marker is not None and marker.get('analyze_hash') == analyze_hash and \
+                marker.get('wavepacket') == file_wavepacket and \
+                QUEUE.file_unchanged(marker.get('wavepacket_info'), file_wavepacket):
+                print("Orientation " + str(irun) + " already analyzed, skipping")
+                continue
 
 
         params['tgrid_plot_space'], params['tgrid_plot_index_space'] = analysis_obj.setup_timegrids(params['space_analyze_times'])
@@ -2223,6 +2292,9 @@ if __name__ == "__main__":
             print("Calling momentum function: " + str(elem['name']))
             func(elem)
         
+        QUEUE.marker_write(markerfile, {    "analyze_hash":     analyze_hash,
+                                            "wavepacket":       file_wavepacket,
+                                            "wavepacket_info":  QUEUE.file_info(file_wavepacket) if os.path.isfile(file_wavepacket) else None })
 
 
         """ calculate contribution to averaged quantities"""
@@ -2242,5 +2314,5 @@ if __name__ == "__main__":
     """ Consolidate quanitites averaged over orientations """
     obj     = analysis(params)
     ibcoeff = 9
-    obj.barray_plot_2D(grid_euler,ibcoeff,params['bcoeffs'])
+    obj.barray_plot_2D(grid_euler,ibcoeff,params['bcoeffs'],weights_euler,rep_euler)
     #exit()
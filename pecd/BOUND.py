@@ -18,6 +18,7 @@ from scipy.special import sph_harm
 import scipy.integrate as integrate
 from scipy import interpolate
 from scipy.spatial.transform import Rotation as R
+from scipy.spatial import cKDTree
 import quadpy
 
 from sympy.functions.elementary.miscellaneous import sqrt
@@ -28,6 +29,7 @@ import spherical
 import sys
 import os.path
 import time
+import functools
 
 from numba import jit, prange
 
@@ -114,6 +116,71 @@ def calc_potmat_jit( vlist, VG, Gs ):
         #potmat[vlist[p1,5],vlist[p1,6]] = np.dot(w,f.T) * 4.0 * np.pi
     return pot, potind
 
+
+def gen_ylm_table(G, lmax):
+    """ Tabulate Y_lm(theta,phi) on a spherical quadrature grid G = [theta, phi, w]
+
+        Returns array Y[s, l*(l+1)+m] for l = 0,...,lmax and m = -l,...,l, i.e. in the
+        order of the angular basis functions at fixed xi in the DVR map.
+    """
+    L = np.concatenate([np.full(2*l+1, l) for l in range(lmax+1)])
+    M = np.concatenate([np.arange(-l, l+1) for l in range(lmax+1)])
+    return sph_harm(M[None,:], L[None,:], G[:,1,None] + np.pi, G[:,0,None])
+
+
+def calc_potmat_vec( vlist, VG, Gs, sph_quad_list, max_batch_elems = 2**25 ):
+    """ Vectorized version of calc_potmat_jit.
+
+        Y_lm are tabulated once per Lebedev scheme. For each radial point xi the full angular
+        block Y^H diag(w V) Y is computed with a single matrix product, batched over
+        all radial points which share the scheme. Elements labeled by vlist are then
+        pulled out of the blocks.
+
+        Arguments:
+            vlist: array (xi, l1, m1, l2, m2, p1, p2) from MAPPING.GEN_VLIST ('DVR' map)
+            VG: list of ESP values on the quadrature grids, VG[xi-1]
+            Gs: list of quadrature grids, Gs[xi-1]
+            sph_quad_list: list of [i, n, xi, scheme], one entry per element of Gs
+            max_batch_elems: size limit of the (batch, angular, grid) work array
+
+        Returns:
+            vals, rows, cols: potential matrix in COO format
+    """
+    lmax = max(vlist[:,1].max(), vlist[:,3].max())
+    nang = (lmax+1)**2
+
+    xi_vlist    = vlist[:,0] - 1 #xi starts from 1
+    ind1        = vlist[:,1] * (vlist[:,1] + 1) + vlist[:,2]
+    ind2        = vlist[:,3] * (vlist[:,3] + 1) + vlist[:,4]
+    vals        = np.zeros(vlist.shape[0], dtype = complex)
+
+    #group radial points by quadrature scheme
+    schemes = {}
+    for xi in np.unique(xi_vlist):
+        schemes.setdefault(str(sph_quad_list[xi][3]), []).append(xi)
+
+    for scheme, xilist in schemes.items():
+        xilist  = np.asarray(xilist, dtype = int)
+        G       = Gs[xilist[0]]
+        Y       = gen_ylm_table(G, lmax)
+        YH      = np.conj(Y.T)
+        nbatch  = max(1, int(max_batch_elems // (nang * G.shape[0])))
+
+        #vlist rows belonging to this scheme and their positions in xilist
+        rows_scheme = np.where(np.isin(xi_vlist, xilist))[0]
+        pos         = np.searchsorted(xilist, xi_vlist[rows_scheme])
+
+        for ib in range(0, len(xilist), nbatch):
+            xib     = xilist[ib:ib+nbatch]
+            WV      = np.stack([G[:,2] * VG[xi] for xi in xib]) #(batch, npts)
+            blocks  = np.matmul(YH[None,:,:] * WV[:,None,:], Y) * 4.0 * np.pi #(batch, nang, nang)
+
+            mask    = (pos >= ib) & (pos < ib + len(xib))
+            irow    = rows_scheme[mask]
+            vals[irow] = blocks[pos[mask] - ib, ind1[irow], ind2[irow]]
+
+    return vals, vlist[:,5], vlist[:,6]
+
 #@jit( nopython=True, parallel=False, cache = jitcache, fastmath=False) 
 def calc_potmat_multipoles_jit( vlist, tjmat, qlm, Lmax, rlmat ):
     pot = []
@@ -273,99 +340,117 @@ def BUILD_HMAT0(params):
 
 
 """ ============ KEOMAT - new fast implementation ============ """
-def BUILD_KEOMAT_FAST(params, maparray, Nbas, Gr):
+def BUILD_KEOMAT_FAST(params, maparray, Nbas, Gr, triangle = 'upper', femlist = None):
+    """ KEO matrix 0.5 * ( -d^2/dr^2 + l(l+1)/r^2 ) in the FEM-DVR basis.
+
+        The radial part is assembled once as a banded matrix over the radial functions (bin, n) from the
+        stiffness matrices of the individual bins, expanded to the full basis with sparse.kron(Krad, I_lm) and
+        permuted to the order of maparray. The centrifugal term is added as a diagonal. The cost is linear
+        in the number of nonzero elements.
+
+        triangle:   'upper' - only the upper triangle is returned (to be hermitized by the caller)
+                    'full'  - the complete symmetric matrix
+        femlist:    bins of the radial grid Gr as [[nbins, nlobs, binw], ...]. Bins may differ in width and
+                    number of Gauss-Lobatto points. Default: Gr.shape[0] bins of width params['bound_binw']
+                    with params['bound_nlobs'] points.
+    """
 
-    nlobs = params['bound_nlobs'] 
+    if not isinstance(maparray, MAPPING.basismap):
+        maparray = MAPPING.basismap(np.asarray(maparray)[:Nbas], params['map_type'])
 
-    if params['hmat_format'] == 'numpy_arr':    
-        keomat =  np.zeros((Nbas, Nbas), dtype=float)
-    elif params['hmat_format'] == 'sparse_csr':
-        keomat = sparse.csr_matrix((Nbas, Nbas), dtype=float)
-    else:
-        raise ValueError("Incorrect format type for the Hamiltonian")
+    if femlist is None:
+        femlist = [[Gr.shape[0], params['bound_nlobs'], params['bound_binw']]]
 
-    """call Gauss-Lobatto rule """
-    x       =   np.zeros(nlobs, dtype = float)
-    w       =   np.zeros(nlobs, dtype = float)
-    xc, wc  =   GRID.gauss_lobatto(nlobs,14)
-    x       =   np.asarray(xc, dtype = float)
-    w       =   np.asarray(wc, dtype = float)
+    nlobs_bin, binw_bin = GRID.femlist_bins(femlist)
 
+    ibin    = maparray.field('bin')[:Nbas]
+    n       = maparray.field('n')[:Nbas]
+    l       = maparray.field('l')[:Nbas]
+    m       = maparray.field('m')[:Nbas]
 
-    #w[0] *= 2.0
-    #w[nlobs-1] *=2.0
+    if np.any(n < 1):
+        raise ValueError("KEO requires the natural-order map with n = 1, 2, ..., nlobs-1 in each bin")
 
-    #print(w)
-    #exit()
-    #w /= np.sum(w[:])
-    #w *= 0.5 * params['bound_binw']
-    #scaling to quadrature range
-    #x *= 0.5 * params['bound_binw']
+    """ radial functions (bin, n) and angular functions (l, m) present in the basis """
+    nmax        = int(nlobs_bin.max())
+    rad, irad   = np.unique(ibin.astype(np.int64) * nmax + n, return_inverse = True)
+    lm, ilm     = np.unique(l * (l + 1) + m, return_inverse = True)
+    rbin, rn    = np.divmod(rad, nmax)
 
-    """ Build D-matrix """
-    DMAT = BUILD_DMAT(x,w)
+    krad = sparse.triu( gen_keo_radial(rbin, rn, nlobs_bin, binw_bin) )
 
-    """ Build J-matrix """
-    JMAT  = BUILD_JMAT(DMAT,w)
+    """ kron orders the basis as (radial, angular): permute to the order of maparray """
+    perm    = irad.ravel() * lm.size + ilm.ravel()
+    keomat  = sparse.kron(krad, sparse.identity(lm.size, format = 'csr'), format = 'csr')[perm][:,perm]
 
-    """
-    plot_mat(JMAT)
-    plt.spy(JMAT, precision=params['sph_quad_tol'], markersize=5, label="J-matrix")
-    plt.legend()
-    plt.show()
-    """
-    """ Build KD, KC matrices """
-    KD  = BUILD_KD(JMAT,w,nlobs) / (0.5 * params['bound_binw'])**2 #### !!!! check
-    KC  = BUILD_KC(JMAT,w,nlobs) / (0.5 * params['bound_binw'])**2
+    """ a non-monotonic map may move elements below the diagonal: fold them back into the upper triangle """
+    keomat  = sparse.triu(keomat) + sparse.tril(keomat, k = -1).T
 
-    #plot_mat(KD)
-    #plt.spy(KD, precision=params['sph_quad_tol'], markersize=5, label="KD")
-    #plt.legend()
-    #plt.show()
+    """ centrifugal term """
+    rin     = Gr[ibin, n - 1] #Gr has no n=0 point, while n=1,2,... in maparray
+    keomat  = keomat + sparse.diags(l * (l + 1.0) / rin**2)
+
+    if triangle == 'full':
+        keomat = keomat + sparse.triu(keomat, k = 1).T
+    elif triangle != 'upper':
+        raise ValueError("Incorrect triangle type for the KEO matrix")
+
+    if params['hmat_format'] == 'numpy_arr':    
+        return 0.5 * keomat.toarray()
+    elif params['hmat_format'] == 'sparse_csr':
+        return 0.5 * keomat.tocsr()
+    else:
+        raise ValueError("Incorrect format type for the Hamiltonian")
 
-    """ Generate K-list """
-    klist = MAPPING.GEN_KLIST(maparray, Nbas, params['map_type'] )
 
-    """ Fill up global KEO """
-    klist = np.asarray(klist, dtype=int)
+def gen_keo_radial(rbin, rn, nlobs_bin, binw_bin):
+    """ Radial KEO (symmetric, without the factor 1/2) over the radial functions (rbin, rn) for bins with
+        nlobs_bin Gauss-Lobatto points and widths binw_bin.
 
-    for i in range(klist.shape[0]):
-        if klist[i,0] == klist[i,2]:
-            #diagonal blocks
-            #print(klist[i,1],klist[i,3])
-            keomat[ klist[i,5], klist[i,6] ] += KD[ klist[i,1] - 1, klist[i,3] - 1 ] #basis indices start from 1. But Kd array starts from 0 although its elems correspond to basis starting from n=1.
+        The stiffness matrices of all bins are collected in a block-diagonal matrix over the primitive Lagrange
+        functions (i, n = 0, ..., nlobs_i - 1). A radial function is the primitive (i, n), except for the bridge
+        function n = nlobs_i - 1, which also contains the primitive (i+1, 0) of the next bin. Each function is
+        normalized with the quadrature weights of its primitives, so that bridges between bins of different
+        width and order are treated exactly.
+    """
+    nbins   = nlobs_bin.size
+    nrad    = rbin.size
+    offset  = np.r_[0, np.cumsum(nlobs_bin)] #primitive (i, n) -> offset[i] + n
 
-            if klist[i,1] == klist[i,3]:
-                rin = Gr[ klist[i,0], klist[i,1] - 1 ] #note that grid contains all points, including n=0. Note that i=0,1,2,... and n=1,2,3... in maparray
-                #print(rin)
-                keomat[ klist[i,5], klist[i,6] ] +=  float(klist[i,4]) * ( float(klist[i,4]) + 1) / rin**2 
+    blocks  = [ gen_keo_stiffness(int(nlobs_bin[i]), float(binw_bin[i])) for i in range(nbins) ]
+    stiff   = sparse.block_diag([ blk[0] for blk in blocks ], format = 'csr')
+    wprim   = np.concatenate([ blk[1] for blk in blocks ])
 
-        elif klist[i,0] == klist[i,2] - 1: # i = i' - 1
-            #off-diagonal blocks
-            if klist[i,1] == nlobs - 1 : #last n
-                # u_bs and u_bb:
-                keomat[ klist[i,5], klist[i,6] ] += KC[ klist[i,3] - 1 ]
-                                
-               # print("n = " + str(klist[i,1]) + ",  n' in u_bs = " + str(klist[i,3] ))
+    bridge  = (rn == nlobs_bin[rbin] - 1) & (rbin < nbins - 1)
+    rows    = np.r_[ offset[rbin] + rn, offset[rbin[bridge] + 1] ]
+    cols    = np.r_[ np.arange(nrad), np.flatnonzero(bridge) ]
+    inc     = sparse.csr_matrix( (np.ones(rows.size), (rows, cols)), shape = (offset[-1], nrad) )
 
+    scale   = sparse.diags( 1.0 / np.sqrt(inc.T @ wprim) )
+    return ( scale @ (inc.T @ stiff @ inc) @ scale ).tocsr()
 
 
-    #exit()
-    #print("KEO matrix")
-    #with np.printoptions(precision=3, suppress=True, formatter={'float': '{:10.3f}'.format}, linewidth=400):
-    #    print(0.5*keomat)
-  
-    #plot_mat(keomat)
-    #plt.spy(keomat, precision=params['sph_quad_tol'], markersize=5, label="KEO")
-    #plt.legend()
-    #plt.show()
-    #exit()
+@functools.lru_cache(maxsize=None)
+def gen_keo_stiffness(nlobs, binw):
+    """ Stiffness matrix S_nm = int L_n'(r) L_m'(r) dr of the Lagrange polynomials of a bin of width binw with
+        nlobs Gauss-Lobatto points (n, m = 0, ..., nlobs-1), and the quadrature weights of the bin.
+
+        Both are identical for all bins with the same (nlobs, binw), e.g. across an orientation or lmax sweep,
+        so they are memoized. Returned arrays are read-only.
+    """
+    x, w = GRID.gauss_lobatto(nlobs,14)
+    w    = np.asarray(w, dtype = float)
 
-    #print size of KEO matrix
-    #keo_csr_size = keomat.data.size/(1024**2)
-    #print('Size of the sparse KEO csr_matrix: '+ '%3.2f' %keo_csr_size + ' MB')
+    """ J-matrix is built from the normalized functions L_n / sqrt(w_n) """
+    JMAT  = BUILD_JMAT(BUILD_DMAT(x,w),w)
+
+    stiff   = JMAT * np.sqrt(np.outer(w,w)) / (0.5 * binw)
+    wbin    = w * 0.5 * binw
+
+    stiff.setflags(write = False)
+    wbin.setflags(write = False)
+    return stiff, wbin
 
-    return  0.5 * keomat 
 
 def BUILD_DMAT(x,w):
 
@@ -471,11 +556,16 @@ def BUILD_KEOMAT( params, maparray, Nbas, Gr ):
 
     keomat =  np.zeros((Nbas, Nbas), dtype=np.float64)
 
+    if not isinstance(maparray, MAPPING.basismap):
+        maparray = MAPPING.basismap(np.asarray(maparray)[:Nbas], params['map_type'])
+    rows = np.arange(Nbas)
+
     for i in range(Nbas):
         rin = Gr[maparray[i][0],maparray[i][1]]
 
-        for j in range(i,Nbas):
-            if maparray[i][3] == maparray[j][3] and maparray[i][4] == maparray[j][4]:
+        #the KEO is diagonal in (l,m): only the (l,m)-block of row i
+        for j in rows[maparray.lm_block(maparray[i][3], maparray[i][4])]:
+            if j >= i:
                 keomat[i,j] = calc_keomatel(maparray[i][0], maparray[i][1],\
                                             maparray[i][3], maparray[j][0], maparray[j][1], x, w, rin, \
                                             params['bound_rshift'],params['bound_binw']) #what a waste! Going over all bins!
@@ -600,7 +690,7 @@ def fp(i,n,k,x):
 """ ============ POTMAT0 ============ """
 def BUILD_POTMAT0( params, maparray, Nbas , Gr ):
 
-    if params['esp_mode'] == "interpolation":
+    if params['esp_mode'] == "interpolate":
         print("Interpolating electrostatic potential")
         esp_interpolant = POTENTIAL.INTERP_POT(params)
 
@@ -610,7 +700,9 @@ def BUILD_POTMAT0( params, maparray, Nbas , Gr ):
             sph_quad_list = read_adaptive_quads(params)
         elif params['gen_adaptive_quads'] == False and params['use_adaptive_quads'] == False:
             print("using global quadrature scheme")
-            sph_quad_list = [params['sph_quad_global']]
+            sph_quad_list = []
+            for xi, (i, n) in enumerate(zip(*GRID.r_labels(Gr))):
+                sph_quad_list.append([i,n+1,xi+1,params['sph_quad_global']])
 
     elif params['esp_mode'] == "exact":
         if  params['gen_adaptive_quads'] == True:
@@ -660,6 +752,13 @@ def BUILD_POTMAT0( params, maparray, Nbas , Gr ):
         #potmat0, potind = calc_potmat_jit( vlist, VG, Gs )
         #end_time = time.time()
         #print("Second call: Time for construction of potential matrix is " +  str("%10.3f"%(end_time-start_time)) + "s")
+
+    elif params['calc_method'] == 'vec':
+        start_time = time.time()
+        vals, rows, cols = calc_potmat_vec( vlist, VG, Gs, sph_quad_list )
+        potmat0, potind = vals[:,None], np.column_stack((rows, cols))
+        end_time = time.time()
+        print("Time for construction of potential matrix with tabulated spherical harmonics is " +  str("%10.3f"%(end_time-start_time)) + "s")
     """
     if params['hmat_format'] == "regular":
         potmat = convert_lists_to_regular(potmat0,potind)
@@ -903,6 +1002,106 @@ def rotate_mol_xyz(params, grid_euler, irun):
 
     return mol_xyz_rotated
 
+""" atom labels in the column order of rotate_mol_xyz() for molecules with explicit geometry """
+MOL_ATOMS = {   "d2s":  ["S", "D", "D"],
+                "n2":   ["N", "N"],
+                "co":   ["C", "O"],
+                "h":    ["H"],
+                "c":    ["C"] }
+
+
+def gen_euler_equivalence(params, grid_euler, tol = 1.0e-3):
+    """ Fold the grid of orientations with the symmetry of the molecule.
+
+        Orientations R_i and R_j are equivalent if the rotated molecules coincide up to a permutation of identical
+        atoms, i.e. R_j = R_i S with S a proper rotation of the molecular point group (or a duplicate grid point,
+        e.g. beta = 0 with different alpha, gamma). All results of equivalent orientations are identical, so only one
+        representative per class needs to be propagated. The point group does not have to be given: equivalence is
+        detected from the rotated geometries, where every atom must lie within 'tol' a.u. of an identical atom of 
+        the representative. The matching does not depend on how accurately the grid was stored (grid_euler.dat).
+
+        Candidate representatives are found with a k-d tree over permutation-invariant descriptors of the rotated 
+        geometry (first and second moments of the positions of each kind of atom) and checked atom by atom.
+
+        Returns:
+            rep: numpy array (N_Euler) with the index of the representative (lowest index of its class) of each
+                 orientation; rep[i] = i for all i if the molecule has no explicit geometry in rotate_mol_xyz()
+    """
+    N_Euler = grid_euler.shape[0]
+    rep     = np.arange(N_Euler)
+
+    if params['molec_name'] not in MOL_ATOMS:
+        print("No geometry for " + str(params['molec_name']) + ": orientation grid is not reduced by symmetry")
+        return rep
+
+    labels  = np.array(MOL_ATOMS[params['molec_name']])
+    mol_xyz = rotate_mol_xyz(params, np.zeros((1,3)), 0) #molecular frame geometry (3, natoms)
+    kinds   = [labels == label for label in sorted(set(labels))]
+
+    xyz     = np.stack([ R.from_euler('zyz', euler, degrees=False).apply(mol_xyz.T) for euler in grid_euler ])
+    iu      = np.triu_indices(3)
+    desc    = np.concatenate( [ np.concatenate( ( xyz[:,kind,:].sum(axis=1), 
+                                                  np.einsum('nai,naj->nij', xyz[:,kind,:], xyz[:,kind,:])[:,iu[0],iu[1]] ),
+                                                axis = 1 ) for kind in kinds ], axis = 1 )
+
+    # atoms displaced by less than tol change the descriptors by less than natoms * tol * (1 + 2 rmax + tol)
+    rmax    = np.max(np.linalg.norm(mol_xyz, axis=0))
+    dtol    = len(labels) * tol * (1.0 + 2.0 * rmax + tol) * np.sqrt(desc.shape[1])
+    tree    = cKDTree(desc)
+
+    same_kind = labels[:,None] == labels[None,:]
+    nunique = 0
+    for irun in range(N_Euler):
+        for jrun in sorted(tree.query_ball_point(desc[irun], dtol)):
+            if jrun >= irun:
+                break
+            if rep[jrun] != jrun:
+                continue
+            dist = np.linalg.norm(xyz[irun][:,None,:] - xyz[jrun][None,:,:], axis=2)
+            if np.all(np.any((dist < tol) & same_kind, axis=1)):
+                rep[irun] = jrun
+                break
+        if rep[irun] == irun:
+            nunique += 1
+
+    print("Symmetry-unique orientations: " + str(nunique) + " out of " + str(N_Euler) + \
+          " (reduction factor " + str("%6.2f"%(N_Euler/nunique)) + ")")
+    return rep
+
+
+def precompute_esp_rot(params, Gr, grid_euler, iruns):
+    """ Evaluate the exact ESP for a set of orientations in parallel (GRID.CALC_ESP_POOL) and put it in the ESP store,
+        where BUILD_ESP_MAT_EXACT_ROT picks it up. Only the global quadrature scheme is supported: adaptive
+        quadratures depend on the orientation and are generated per orientation.
+    """
+    if params['gen_adaptive_quads'] == True or params['use_adaptive_quads'] == True:
+        print("ESP precomputation skipped: adaptive quadratures are orientation dependent")
+        return
+
+    sph_quad_list = []
+    for xi, (i, n) in enumerate(zip(*GRID.r_labels(Gr))):
+        sph_quad_list.append([i,n+1,xi+1,params['sph_quad_default']])
+
+    Gs          = GRID.GEN_GRID( sph_quad_list, params['main_dir'])
+    grid_xyz    = GRID.GEN_XYZ_GRID(Gs, Gr)
+    storedir    = GRID.esp_store_open(params, Gr, Gs)
+
+    mol_xyz_list = []
+    for irun in iruns:
+        mol_xyz = rotate_mol_xyz(params, grid_euler, irun)
+        V       = GRID.esp_store_read(storedir, mol_xyz)
+        if V is None or np.any(np.isnan(V)):
+            mol_xyz_list.append(mol_xyz)
+
+    if not mol_xyz_list:
+        return
+
+    Vlist = GRID.CALC_ESP_POOL(params, mol_xyz_list, grid_xyz)
+
+    for mol_xyz, V in zip(mol_xyz_list, Vlist):
+        GRID.esp_store_write(storedir, mol_xyz, -1.0 * V)
+
+
 """ ============ POTMAT0 ROTATED ============ """
 def BUILD_POTMAT0_ROT( params, maparray, Nbas , Gr, grid_euler, irun ):
 
@@ -922,12 +1121,8 @@ def BUILD_POTMAT0_ROT( params, maparray, Nbas , Gr, grid_euler, irun ):
         elif params['gen_adaptive_quads'] == False and params['use_adaptive_quads'] == False:
             print("using global quadrature scheme")
             sph_quad_list = []
-            xi = 0
-
-            for i in range(Gr.shape[0]):
-                for n in range(Gr.shape[1]):
-                    xi +=1
-                    sph_quad_list.append([i,n+1,xi,params['sph_quad_default']])
+            for xi, (i, n) in enumerate(zip(*GRID.r_labels(Gr))):
+                sph_quad_list.append([i,n+1,xi+1,params['sph_quad_default']])
             #print(sph_quad_list)
             #exit()
 
@@ -966,6 +1161,13 @@ def BUILD_POTMAT0_ROT( params, maparray, Nbas , Gr, grid_euler, irun ):
         #potmat0, potind = calc_potmat_jit( vlist, VG, Gs )
         #end_time = time.time()
         #print("Second call: Time for construction of potential matrix is " +  str("%10.3f"%(end_time-start_time)) + "s")
+
+    elif params['calc_method'] == 'vec':
+        start_time = time.time()
+        vals, rows, cols = calc_potmat_vec( vlist, VG, Gs, sph_quad_list )
+        potmat0, potind = vals[:,None], np.column_stack((rows, cols))
+        end_time = time.time()
+        print("Time for construction of potential matrix with tabulated spherical harmonics is " +  str("%10.3f"%(end_time-start_time)) + "s")
     """
     if params['hmat_format'] == "regular":
         potmat = convert_lists_to_regular(potmat0,potind)
@@ -1140,9 +1342,10 @@ def BUILD_POTMAT0_MULTIPOLES_ROT( params, maparray, Nbas , Gr, grid_euler, irun
 
     # 3a. Build array of '1/r**l' values on the radial grid
 
-    rlmat = np.zeros((Gr.shape[0]*Gr.shape[1],params['multi_lmax']), dtype=float)
+    r_array = GRID.r_points(Gr)
+    rlmat = np.zeros((r_array.size,params['multi_lmax']), dtype=float)
     for L in range(params['multi_lmax']):
-        rlmat[:,L] = 1.0 / Gr.ravel()**L
+        rlmat[:,L] = 1.0 / r_array**L
 
 
     # 4. Perform semi-vectorized summation
@@ -1199,6 +1402,25 @@ def rotate_tjmat(grid_euler,irun,tjmat):
 
     return tjmat_rot
 
+def rotate_vlm(grid_euler,irun,vLM):
+    """ Rotate partial waves of the potential: vLM_rot[L,M'] = sum_M D^L_{M'M} vLM[L,M].
+
+        Equivalent to contracting vLM with rotate_tjmat(grid_euler,irun,tjmat), at the cost of a single
+        small matrix product per L.
+    """
+    Lmax = vLM.shape[1] - 1
+
+    print("current Euler grid point = " + str(grid_euler[irun]))
+
+    WDMATS = gen_wigner_dmats(1, Lmax, grid_euler[irun])
+
+    vLM_rot = np.zeros(vLM.shape, dtype = complex)
+    for L in range(0,Lmax+1):
+        vLM_rot[:,L,:2*L+1] = vLM[:,L,:2*L+1] @ WDMATS[L][:,:,0].T
+
+    return vLM_rot
+
+
 """ ============ POTMAT0 ROTATED with Anton's potential ============ """
 def BUILD_POTMAT0_ANTON_ROT( params, maparray, Nbas , Gr, grid_euler, irun ):
     """ Calculate potential matrix using projection onto spherical harmonics representation of 
@@ -1276,6 +1498,39 @@ def BUILD_POTMAT0_ANTON_ROT( params, maparray, Nbas , Gr, grid_euler, irun ):
     # 5. Return final potential matrix
     return potmat0,potind
 
+
+""" ============ POTMAT0 ROTATED with partial waves of the exact ESP ============ """
+def BUILD_POTMAT0_VLM_ROT( params, maparray, Nbas , Gr, grid_euler, irun ):
+    """ Calculate potential matrix from the partial-wave representation of the exact (psi4) ESP.
+        Partial waves are calculated once in the molecular frame (POTENTIAL.gen_vlm_exact) and rotated to 
+        the current orientation with Wigner D-matrices. No psi4 calculation is done per orientation.
+    """
+
+    # 1. Construct vlist
+    start_time = time.time()
+    vlist = MAPPING.GEN_VLIST( maparray, Nbas, params['map_type'] )
+    vlist = np.asarray(vlist)
+    end_time = time.time()
+    print("Time for the construction of vlist: " +  str("%10.3f"%(end_time-start_time)) + "s")
+
+    # 2. Partial waves of the potential in the molecular frame
+    start_time = time.time()
+    mol_xyz = rotate_mol_xyz(params, np.zeros((1,3), dtype = float), 0)
+    vLM     = POTENTIAL.gen_vlm_exact(params, Gr, mol_xyz)
+    end_time = time.time()
+    print("Time for the construction of the potential partial waves: " +  str("%10.3f"%(end_time-start_time)) + "s")
+
+    # 3. Build array of 3-j symbols up to the converged L of the partial waves
+    tjmat       = gen_tjmat(params['bound_lmax'],vLM.shape[1]-1)
+
+    # 4. rotate partial waves and sum them up
+    if params['N_euler'] > 1:
+        vLM = rotate_vlm(grid_euler,irun,vLM)
+
+    potmat0, potind = calc_potmat_anton_jit( vLM, vlist, tjmat )
+
+    return potmat0,potind
+
 def calc_potmatelem_quadpy( l1, m1, l2, m2, rin, scheme, esp_interpolant ):
     """calculate single element of the potential matrix on an interpolated potential"""
     myscheme = quadpy.u3.schemes[scheme]()
@@ -1348,6 +1603,8 @@ def gen_adaptive_quads(params, esp_interpolant, rgrid):
     for i in range(np.size( rgrid, axis=0 )): 
         for n in range(np.size( rgrid, axis=1 )): 
             rin = rgrid[i,n]
+            if np.isnan(rin): #padding of bins with fewer Gauss-Lobatto points
+                continue
             print("i = " + str(i) + ", n = " + str(n) + ", xi = " + str(xi) + ", r = " + str(rin) )
             if rin <= params['r_cutoff']:
                 for scheme in spherical_schemes[3:]: #skip 003a,003b,003c rules
@@ -1408,110 +1665,94 @@ def gen_adaptive_quads_exact_rot(params , rgrid, mol_xyz, irun ):
 
     sphlist = MAPPING.GEN_SPHLIST(lmax)
 
-    val =  np.zeros( shape = ( len(sphlist)**2 ), dtype=complex)
-    val_prev = np.zeros( shape = ( len(sphlist)**2 ), dtype=complex)
-
     spherical_schemes = []
     for elem in list(quadpy.u3.schemes.keys()):
         if 'lebedev' in elem:
             spherical_schemes.append(elem)
 
-    xi = 0
     flesp = open("esp_radial",'w')
     esp_int = [] #list of values of integrals for all grid points
-    for i in range(np.size( rgrid, axis=0 )): 
-        for n in range(np.size( rgrid, axis=1 )): 
-            #if i == np.size( rgrid, axis=0 ) - 1 and n == np.size( rgrid, axis=1 ) - 1: break
-                        
-            rin = rgrid[i,n]
-            print("i = " + str(i) + ", n = " + str(n+1) + ", xi = " + str(xi+1) + ", r = " + str(rin) )
-
-            for scheme in spherical_schemes[3:]: #skip 003a,003b,003c rules
-                ischeme = 0 #use enumerate()
 
-                #get grid
-                Gs = GRID.read_leb_quad(scheme, params['main_dir'] )
+    """ Quadrature levels are tested level-by-level for all radial points which have not converged yet.
+        ESP values missing in the ESP store are evaluated for all these points in a single batched call from one
+        SCF wavefunction per orientation. Points shared with lower levels are taken from esp_cache."""
+    r_array     = GRID.r_points(rgrid) #xi = 0, 1, 2, ... runs over (i,n) in natural order
+    npts_r      = r_array.shape[0]
+    ibin, ncol  = GRID.r_labels(rgrid)
 
-                #pull potential at quadrature points
-                potfilename = "esp_" + params['molec_name'] + "_"+params['esp_mode'] + "_" + str('%6.4f'%rin) + "_"+scheme + "_"+str(irun)
+    vals_prev   = np.zeros( shape = ( npts_r, len(sphlist)**2 ), dtype=complex)
+    level       = [None] * npts_r
+    wfn         = None
+    esp_cache   = {}
 
-                if os.path.isfile(params['job_directory']  + "esp/" + str(irun) + "/" + potfilename):
-                    print (potfilename + " file exist")
+    for scheme in spherical_schemes[3:]: #skip 003a,003b,003c rules
 
+        active = [xi for xi in range(npts_r) if level[xi] is None]
+        if not active:
+            break
 
-                    filesize = os.path.getsize(params['job_directory']  + "esp/" + str(irun) + "/" + potfilename)
+        #get grid
+        Gs = GRID.get_leb_quad(scheme, params['main_dir'] )
 
-                    if filesize == 0:
-                        print("The file is empty: " + str(filesize))
-                        os.remove(params['job_directory']  + "esp/"+ str(irun) + "/"  + potfilename)
-                        GRID.GEN_XYZ_GRID([Gs], np.array(rin), params['job_directory'] + "esp/"+ str(irun) + "/" )
+        #pull potential at quadrature points: from the ESP store if present, otherwise from the batched ESP call
+        storedir = GRID.esp_store_open(params, rgrid, Gs)
+        Vstore   = GRID.esp_store_read(storedir, mol_xyz)
+        if Vstore is None:
+            Vstore = np.full((npts_r, Gs.shape[0]), np.nan)
+        Vstore  = Vstore.reshape(npts_r, Gs.shape[0])
+        missing = [xi for xi in active if np.any(np.isnan(Vstore[xi]))]
 
-                        V = GRID.CALC_ESP_PSI4_ROT(params['job_directory'] + "esp/"+ str(irun) + "/" , params, mol_xyz)
-                        V = np.asarray(V)
-                        fl = open(params['job_directory'] + "esp/"+ str(irun) + "/"  + potfilename,"w")
-                        np.savetxt(fl,V,fmt='%10.6f')
+        if missing:
+            if wfn is None:
+                wfn = GRID.CALC_SCF_PSI4_ROT(params, mol_xyz)
 
-                    else:
-                        print("The file is not empty: " + str(filesize))
-                        fl = open(params['job_directory'] + "esp/" + str(irun) + "/" + potfilename , 'r' )
-                        V = []
-                        for line in fl:
-                            words = line.split()
-                            potval = -1.0 * float(words[0])
-                            V.append(potval)
-                        V = np.asarray(V)
-    
-                else:
-                    print (potfilename + " file does not exist")
-
-                    #generate xyz grid
-                    GRID.GEN_XYZ_GRID([Gs], np.array(rin), params['job_directory'] + "esp/"+ str(irun) + "/" )
-
-                    V = GRID.CALC_ESP_PSI4_ROT(params['job_directory'] + "esp/"+ str(irun) + "/" , params, mol_xyz)
-                    V = np.asarray(V)
+            x, y, z = GRID.sph2cart( r_array[missing][:,None], Gs[None,:,0], Gs[None,:,1] )
+            V = GRID.CALC_ESP_WFN(wfn, np.stack((x,y,z), axis = -1).reshape(-1,3), esp_cache)
+            Vstore[missing] = -1.0 * V.reshape(len(missing), Gs.shape[0]) #the store keeps -ESP (see GRID.esp_store_open)
+            GRID.esp_store_write(storedir, mol_xyz, Vstore)
 
-                    #fl = open(params['working_dir'] + "esp/" + potfilename,"w")
-                    #np.savetxt(fl, V, fmt='%10.6f')
+        for xi in active:
+            rin = r_array[xi]
+            print("i = " + str(ibin[xi]) + ", n = " + str(ncol[xi] + 1) + ", xi = " + str(xi+1) + ", r = " + str(rin) )
 
+            val = np.zeros( shape = ( len(sphlist)**2 ), dtype=complex)
+            ischeme = 0
+            for l1,m1 in sphlist:
+                for l2,m2 in sphlist:
 
-                for l1,m1 in sphlist:
-                    for l2,m2 in sphlist:
+                    val[ischeme] = calc_potmatelem_xi( Vstore[xi], Gs, l1, m1, l2, m2 )
 
-                        val[ischeme] = calc_potmatelem_xi( V, Gs, l1, m1, l2, m2 )
+                    print(  '%4d %4d %4d %4d'%(l1,m1,l2,m2) + '%12.6f' % val[ischeme] + \
+                            '%12.6f' % (vals_prev[xi,ischeme]) + \
+                            '%12.6f '%np.abs(val[ischeme]-vals_prev[xi,ischeme])  )
+                    ischeme += 1
 
-                        #val[k] = calc_potmatelem_quadpy( l1, m1, l2, m2, rin, scheme, esp_interpolant )
+            diff = np.abs(val - vals_prev[xi])
 
-                        print(  '%4d %4d %4d %4d'%(l1,m1,l2,m2) + '%12.6f' % val[ischeme] + \
-                                '%12.6f' % (val_prev[ischeme]) + \
-                                '%12.6f '%np.abs(val[ischeme]-val_prev[ischeme])  )
-                        ischeme += 1
-
-                diff = np.abs(val - val_prev)
-
-                if (np.any( diff > quad_tol )):
-                    print( str(scheme) + " convergence not reached" ) 
-                    for ischeme in range(len(val_prev)):
-                        val_prev[ischeme] = val[ischeme]
-                elif ( np.all( diff < quad_tol ) ):     
-                    print( str(scheme) + " convergence reached !!!")
-                    
-                    if params['integrate_esp'] == True:
-                        esp_int.append([xi,rin,val[0]])
-                        
-                        flesp.write( str('%4d '%xi) + str('%12.6f '%rin) + str('%12.6f '%val[0]) + "\n")
-
-                        
-                    sph_quad_list.append([ i, n + 1, xi + 1, str(scheme)]) #new, natural ordering n = 1, 2, 3, ..., N-1, where N-1 is bridge
-                    xi += 1
-                    break
+            if (np.any( diff > quad_tol )):
+                print( str(scheme) + " convergence not reached" ) 
+                vals_prev[xi] = val
 
                 #if no convergence reached raise warning
-                if ( scheme == spherical_schemes[len(spherical_schemes)-1] and np.any( diff > quad_tol )):
+                if scheme == spherical_schemes[len(spherical_schemes)-1]:
                     print("WARNING: convergence at tolerance level = " + str(quad_tol) + " not reached for all considered quadrature schemes")
                     print( str(scheme) + " convergence reached !!!")
+                    level[xi] = str(scheme)
+
+            else:
+                print( str(scheme) + " convergence reached !!!")
+                
+                if params['integrate_esp'] == True:
+                    esp_int.append([xi,rin,val[0]])
+                    flesp.write( str('%4d '%xi) + str('%12.6f '%rin) + str('%12.6f '%val[0]) + "\n")
 
-                    sph_quad_list.append([ i, n + 1, xi + 1, str(scheme)])
-                    xi += 1
+                level[xi] = str(scheme)
+
+    for xi in range(npts_r):
+        sph_quad_list.append([ ibin[xi], ncol[xi] + 1, xi + 1, level[xi]]) #new, natural ordering n = 1, 2, 3, ..., N-1, where N-1 is bridge
+
+    if params['integrate_esp'] == True:
+        esp_int.sort(key = lambda item: item[0])
 
     if params['integrate_esp'] == True:
         print("list of spherical integrals of ESP on radial grid:")
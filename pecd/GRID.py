@@ -5,22 +5,20 @@
 #
 import numpy as np
 import os
+import importlib.util
+import functools
+import time
+import hashlib
+import tempfile
+import shutil
+import multiprocessing
+
+import h5py
 
 import psi4
 
 import CONSTANTS
 
-from sympy import symbols
-from sympy.core import S, Dummy, pi
-from sympy.functions.combinatorial.factorials import factorial
-from sympy.functions.elementary.trigonometric import sin, cos
-from sympy.functions.elementary.miscellaneous import sqrt
-from sympy.functions.special.gamma_functions import gamma
-from sympy.polys.orthopolys import (legendre_poly, laguerre_poly,
-                                    hermite_poly, jacobi_poly)
-from sympy.polys.rootoftools import RootOf
-#from sympy.core.compatibility import range
-
 def read_leb_quad(scheme, path):
     sphgrid = []
     #print("reading Lebedev grid from file:" + "/lebedev_grids/"+str(scheme)+".txt")
@@ -53,15 +51,91 @@ def read_leb_quad(scheme, path):
     """
     return sphgrid
 
+""" registry of Lebedev grids loaded in this process: scheme -> read-only array [theta,phi,w] """
+LEB_GRIDS = {}
+
+""" number of points in Lebedev schemes available from the Laikov generator """
+LEB_NPOINTS_LAIKOV = {  "lebedev_003": 6,    "lebedev_005": 14,   "lebedev_007": 26, 
+                        "lebedev_009": 38,   "lebedev_011": 50,   "lebedev_013": 74,
+                        "lebedev_015": 86,   "lebedev_017": 110,  "lebedev_019": 146,
+                        "lebedev_021": 170,  "lebedev_023": 194 }
+
+
+def get_leb_quad(scheme, path):
+    """ Return Lebedev grid [theta,phi,w] for a given scheme.
+
+        Each scheme is loaded only once per process and the same read-only array is shared
+        by all radial points. Sources, in order of preference: in-process registry, 
+        binary cache lebedev_grids/scheme.npz, text file lebedev_grids/scheme.txt (a binary cache is written),
+        Laikov generator.
+    """
+    scheme = str(scheme)
+
+    if scheme in LEB_GRIDS:
+        return LEB_GRIDS[scheme]
+
+    cachefile   = path + "lebedev_grids/" + scheme + ".npz"
+    textfile    = path + "lebedev_grids/" + scheme + ".txt"
+
+    if os.path.isfile(cachefile):
+        with np.load(cachefile) as data:
+            sphgrid = data['sphgrid']
+
+    elif os.path.isfile(textfile):
+        sphgrid = read_leb_quad(scheme, path)
+        save_leb_quad_cache(sphgrid, cachefile)
+
+    elif scheme in LEB_NPOINTS_LAIKOV:
+        sphgrid = gen_leb_quad_laikov(scheme, path)
+        save_leb_quad_cache(sphgrid, cachefile)
+
+    else:
+        raise ValueError("Lebedev scheme " + scheme + " not available")
+
+    sphgrid.setflags(write = False)
+    LEB_GRIDS[scheme] = sphgrid
+
+    return sphgrid
+
+
+def save_leb_quad_cache(sphgrid, cachefile):
+    """ Write binary cache of a Lebedev grid. The file is replaced atomically, so that concurrent jobs never read partial files."""
+    tmpfile = cachefile + "." + str(os.getpid()) + ".tmp"
+    try:
+        with open(tmpfile, 'wb') as fl:
+            np.savez(fl, sphgrid = sphgrid)
+        os.replace(tmpfile, cachefile)
+    except OSError:
+        print("Warning: could not write Lebedev grid cache file " + cachefile)
+        if os.path.isfile(tmpfile):
+            os.remove(tmpfile)
+
+
+def gen_leb_quad_laikov(scheme, path):
+    """ Generate Lebedev grid [theta,phi,w] with the vendored Laikov generator (up to 194 points)"""
+    spec = importlib.util.spec_from_file_location("lebedev_grid_laikov", path + "lebedev_grids/lebedev_grid_laikov.py")
+    laikov = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(laikov)
+
+    xyzw = np.asarray(laikov.LebFunc[LEB_NPOINTS_LAIKOV[scheme]](), dtype = float)
+
+    sphgrid = np.zeros((xyzw.shape[0], 3), dtype = float)
+    sphgrid[:,0] = np.arccos(np.clip(xyzw[:,2], -1.0, 1.0)) #theta
+    sphgrid[:,1] = np.arctan2(xyzw[:,1], xyzw[:,0]) #phi in [-pi,pi] as in the text files
+    sphgrid[:,2] = xyzw[:,3]
+
+    return sphgrid
+
+
 def GEN_GRID(sph_quad_list, path):
     Gs = []
     for elem in sph_quad_list:
-        gs = read_leb_quad(str(elem[3]), path)
+        gs = get_leb_quad(str(elem[3]), path)
         Gs.append( gs )
     return Gs
 
 
-def gauss_lobatto(n, n_digits):
+def gauss_lobatto(n, n_digits = 14):
     """
     Computes the Gauss-Lobatto quadrature [1]_ points and weights.
 
@@ -77,122 +151,173 @@ def gauss_lobatto(n, n_digits):
         &w_i = \frac{2}{n(n-1) \left[P_{n-1}(x_i)\right]^2},\quad x\neq\pm 1\\
         &w_i = \frac{2}{n(n-1)},\quad x=\pm 1
 
+    The interior nodes are the eigenvalues of the Jacobi matrix of the Gauss-Jacobi(1,1) rule (Golub-Welsch),
+    polished with Newton iterations on `P'_(n-1)`. Results are accurate to machine precision and are memoized in n.
+
     Parameters
     ==========
 
     n : the order of quadrature
 
-    n_digits : number of significant digits of the points and weights to return
+    n_digits : kept for compatibility with the former sympy implementation. Points and weights are always
+               returned in full double precision.
 
     Returns
     =======
 
-    (x, w) : the ``x`` and ``w`` are lists of points and weights as Floats.
-            The points `x_i` and weights `w_i` are returned as ``(x, w)``
-            tuple of lists.
+    (x, w) : numpy arrays of points and weights. Fresh copies are returned on each call.
 
     Examples
     ========
 
-    >>> from sympy.integrals.quadrature import gauss_lobatto
-    >>> x, w = gauss_lobatto(3, 5)
-    >>> x
-    [-1, 0, 1]
-    >>> w
-    [0.33333, 1.3333, 0.33333]
-    >>> x, w = gauss_lobatto(4, 5)
+    >>> x, w = gauss_lobatto(4, 14)
     >>> x
-    [-1, -0.44721, 0.44721, 1]
+    array([-1.        , -0.4472136 ,  0.4472136 ,  1.        ])
     >>> w
-    [0.16667, 0.83333, 0.83333, 0.16667]
-
-    See Also
-    ========
-
-    gauss_legendre,gauss_laguerre, gauss_gen_laguerre, gauss_hermite, gauss_chebyshev_t, gauss_chebyshev_u, gauss_jacobi
+    array([0.16666667, 0.83333333, 0.83333333, 0.16666667])
 
     References
     ==========
 
     .. [1] https://en.wikipedia.org/wiki/Gaussian_quadrature#Gauss.E2.80.93Lobatto_rules
     .. [2] http://people.math.sfu.ca/~cbm/aands/page_888.htm
+    .. [3] G. H. Golub and J. H. Welsch, Math. Comp. 23, 221 (1969)
     """
-    x = Dummy("x")
-    p = legendre_poly(n-1, x, polys=True)
-    pd = p.diff(x)
-    xi = []
-    w = []
-    for r in pd.real_roots():
-        if isinstance(r, RootOf):
-            r = r.eval_rational(S(1)/10**(n_digits+2))
-        xi.append(r.n(n_digits))
-        w.append((2/(n*(n-1) * p.subs(x, r)**2)).n(n_digits))
-
-    xi.insert(0, -1)
-    xi.append(1)
-    w.insert(0, (S(2)/(n*(n-1))).n(n_digits))
-    w.append((S(2)/(n*(n-1))).n(n_digits))
-    return xi, w
-    
+    x, w = gauss_lobatto_cached(int(n))
+    return x.copy(), w.copy()
 
-def r_grid(nlobatto,nbins,binwidth,rshift):
-    """radial grid of Gauss-Lobatto quadrature points"""        
-    #return radial coordinate r_in for given i and n, natural order
 
-    """Note: this function must be generalized to account for FEMLIST
-    Only constant bin size is possible at the moment"""
+@functools.lru_cache(maxsize=None)
+def gauss_lobatto_cached(n):
+    """ Memoized numeric Gauss-Lobatto rule. Returned arrays are read-only. """
+    if n < 2:
+        raise ValueError("Gauss-Lobatto quadrature requires at least 2 points")
 
-    x       = np.zeros(nlobatto)
-    w       = np.zeros(nlobatto)
-    x, w    = gauss_lobatto(nlobatto,14)
-    w       = np.array(w)
-    x       = np.array(x) # convert back to np arrays
-    xgrid   = np.zeros( (nbins, nlobatto-1), dtype=float) 
-    
-    bingrid     = np.zeros(nbins)
-    bingrid     = x[1:] * 0.5 * binwidth + 0.5 * binwidth
-    xgrid[:,]   = bingrid
-    Translvec   = np.zeros(nbins)
+    N = n - 1 # degree of the Legendre polynomial
 
-    for i in range(len(Translvec)):
-        Translvec[i] = float(i) * binwidth + rshift
+    # interior nodes: roots of P'_N = zeros of the Jacobi polynomial P^(1,1)_(N-1)
+    k = np.arange(1, N - 1, dtype=float)
+    offdiag = np.sqrt( k * (k + 2.0) / ( (2.0 * k + 1.0) * (2.0 * k + 3.0) ) )
+    jacobi_mat = np.diag(offdiag, 1) + np.diag(offdiag, -1)
+    xi = np.linalg.eigvalsh(jacobi_mat) if N > 1 else np.zeros(0)
 
-    for ibin in range(nbins):    
-        xgrid[ibin,:] += Translvec[ibin]
+    # Newton polishing: P''_N = (2 x P'_N - N (N+1) P_N) / (1 - x^2)
+    for it in range(3):
+        p, dp = legendre_p_dp(N, xi)
+        d2p = (2.0 * xi * dp - N * (N + 1.0) * p) / (1.0 - xi**2)
+        xi = xi - dp / d2p
 
-    #print('\n'.join([' '.join(["  %12.4f"%item for item in row]) for row in xgrid]))
+    p, dp = legendre_p_dp(N, xi)
+
+    x = np.concatenate(([-1.0], xi, [1.0]))
+    w = np.concatenate(([2.0 / (n * N)], 2.0 / (n * N * p**2), [2.0 / (n * N)]))
+
+    x.setflags(write = False)
+    w.setflags(write = False)
+    return x, w
+
+
+def legendre_p_dp(N, x):
+    """ Legendre polynomial P_N(x) and its derivative at points x in (-1,1) from the three-term recurrence"""
+    p0 = np.ones_like(x)
+    p1 = np.copy(x)
+    if N == 0:
+        return p0, np.zeros_like(x)
+    for k in range(1, N):
+        p0, p1 = p1, ( (2.0 * k + 1.0) * x * p1 - k * p0 ) / (k + 1.0)
+    dp = N * (x * p1 - p0) / (x**2 - 1.0)
+    return p1, dp
+
+
+def r_grid(nlobatto,nbins,binwidth,rshift):
+    """radial grid of Gauss-Lobatto quadrature points"""        
+    #return radial coordinate r_in for given i and n, natural order
+    #uniform bins; see r_grid_femlist() for bins of different widths and Lobatto orders
 
-    return xgrid, (nlobatto-1) * nbins
+    return r_grid_femlist( [[nbins, nlobatto, binwidth]], rshift )
 
 def r_grid_prim(nlobatto,nbins,binwidth,rshift):
     """radial grid of Gauss-Lobatto quadrature points"""        
     #return radial coordinate r_in for given i and n
     #we double count joining points. It means we work in primitive basis/grid
 
-    """Note: this function must be generalized to account for FEMLIST"""
+    return r_grid_prim_femlist( [[nbins, nlobatto, binwidth]], rshift )
 
-    x = np.zeros(nlobatto)
-    w = np.zeros(nlobatto)
-    x, w = gauss_lobatto(nlobatto,14)
-    w = np.array(w)
-    x = np.array(x) # convert back to np arrays
-    xgrid = np.zeros( (nbins,nlobatto), dtype=float) 
-    
-    bingrid = np.zeros(nbins)
-    bingrid = x * 0.5 * binwidth + 0.5 * binwidth
-    xgrid[:,] = bingrid
 
-    Translvec = np.zeros(nbins)
+def femlist_bins(femlist):
+    """ Number of Gauss-Lobatto points and width of every bin defined by FEMLIST.
+
+        femlist: list of segments [nbins, nlobs, binw]; segments with nbins = 0 are skipped
+
+        Returns:
+            nlobs: int array (nbins_total,)
+            binw: float array (nbins_total,)
+    """
+    nlobs   = np.concatenate([ np.full(int(elem[0]), int(elem[1]), dtype = int) for elem in femlist ])
+    binw    = np.concatenate([ np.full(int(elem[0]), float(elem[2])) for elem in femlist ])
+    return nlobs, binw
+
+
+def femlist_bin_edges(femlist, rshift):
+    """ left edge of every bin defined by FEMLIST """
+    edges   = []
+    rleft   = rshift
+    for elem in femlist:
+        for i in range(int(elem[0])):
+            edges.append( float(i) * elem[2] + rleft )
+        rleft += float(elem[0]) * elem[2]
+    return np.array(edges, dtype = float)
+
+
+def r_grid_femlist(femlist, rshift):
+    """ radial grid of Gauss-Lobatto quadrature points for bins of (possibly) different widths and Lobatto orders.
+
+        Returns:
+            Gr: numpy array (nbins, max(nlobs) - 1). Row i holds the points n = 1, 2, ..., nlobs_i - 1 of bin i
+                (the last one is the bridge point), in natural order. Rows of bins with fewer points are padded
+                with NaN; use r_points() or r_labels() to iterate over the actual points.
+            Nr: number of radial points
+    """
+    nlobs, binw = femlist_bins(femlist)
+    rleft       = femlist_bin_edges(femlist, rshift)
 
-    for i in range(len(Translvec)):
-        Translvec[i] = float(i) * binwidth + rshift
+    xgrid = np.full( (nlobs.size, nlobs.max() - 1), np.nan, dtype = float)
 
-    for ibin in range(nbins):    
-        xgrid[ibin,:] += Translvec[ibin]
+    for ibin in range(nlobs.size):
+        x, w = gauss_lobatto(nlobs[ibin],14)
+        xgrid[ibin,:nlobs[ibin]-1] = np.asarray(x)[1:] * 0.5 * binw[ibin] + 0.5 * binw[ibin] + rleft[ibin]
 
     #print('\n'.join([' '.join(["  %12.4f"%item for item in row]) for row in xgrid]))
 
-    return xgrid, nlobatto * nbins
+    return xgrid, int(np.sum(nlobs - 1))
+
+
+def r_grid_prim_femlist(femlist, rshift):
+    """ primitive radial grid (joining points counted twice) for bins of different widths and Lobatto orders.
+        Rows are padded with NaN as in r_grid_femlist(). """
+    nlobs, binw = femlist_bins(femlist)
+    rleft       = femlist_bin_edges(femlist, rshift)
+
+    xgrid = np.full( (nlobs.size, nlobs.max()), np.nan, dtype = float)
+
+    for ibin in range(nlobs.size):
+        x, w = gauss_lobatto(nlobs[ibin],14)
+        xgrid[ibin,:nlobs[ibin]] = np.asarray(x) * 0.5 * binw[ibin] + 0.5 * binw[ibin] + rleft[ibin]
+
+    return xgrid, int(np.sum(nlobs))
+
+
+def r_points(Gr):
+    """ all radial points of the grid Gr in natural order (xi = 1, 2, ... -> r_points(Gr)[xi-1]) """
+    Gr = np.asarray(Gr, dtype = float)
+    return Gr[~np.isnan(Gr)]
+
+
+def r_labels(Gr):
+    """ bin index i and column n (n = 0 for the first point of a bin) of all radial points of Gr, natural order """
+    i, n = np.nonzero(~np.isnan(np.asarray(Gr, dtype = float)))
+    return i, n
+
 
 def sph2cart(r,theta,phi):
     x = r * np.sin(theta) * np.cos(phi)
@@ -200,29 +325,108 @@ def sph2cart(r,theta,phi):
     z = r * np.cos(theta)
     return x,y,z
 
-def GEN_XYZ_GRID(Gs,Gr,working_dir):
-    grid = []
-    r_array = Gr.flatten()
-    #print(r_array)
-    print("working dir: " + working_dir )
-    gridfile = open(working_dir + "grid.dat", 'w')
+def GEN_XYZ_GRID(Gs,Gr,working_dir = None):
+    """ Cartesian coordinates of all spherical quadrature points Gs[k] placed at radial points Gr[k].
 
-    for k in range(len(r_array)):
-        #print(Gs[k].shape[0])
-        for s in range(Gs[k].shape[0]):
+        Returns:
+            grid: numpy array (npts, 3). If working_dir is given, the grid is also saved to working_dir/grid.dat
+                    (input for psi4 GRID_ESP property calculations).
+    """
+    r_array = r_points(Gr)
+    r_pts   = np.concatenate([ np.full(Gs[k].shape[0], r_array[k]) for k in range(len(Gs)) ])
+    Gs_all  = np.concatenate([ Gs[k][:,:2] for k in range(len(Gs)) ], axis = 0)
 
-            theta   = Gs[k][s,0] 
-            phi     = Gs[k][s,1]
-            r       = r_array[k]
-            x,y,z   = sph2cart(r,theta,phi)
+    x,y,z   = sph2cart(r_pts, Gs_all[:,0], Gs_all[:,1])
+    grid    = np.column_stack((x,y,z))
 
-            gridfile.write( " %12.6f"%x +  " %12.6f"%y + "  %12.6f"%z + "\n")
-            grid.append([x,y,z])
+    if working_dir is not None:
+        print("working dir: " + working_dir )
+        np.savetxt(working_dir + "grid.dat", grid, fmt = " %12.6f %12.6f  %12.6f")
 
     return grid
 
+
+""" ============ ESP store ============ """
+def esp_store_open(params, Gr, Gs):
+    """ Open the binary ESP store for the radial grid Gr and spherical quadrature grids Gs (list over radial points,
+        or a single array if all radial points share the same angular grid).
+
+        The store is a directory esp/store_<hash>/ in the sweep directory, shared by all jobs of a parameter sweep.
+        The hash is calculated from the molecule, SCF settings and the radial and angular grids, so that stores for
+        different setups never mix. The grids
+        are saved once in grid.h5; values of the ESP for each orientation (geometry) are saved in separate
+        files, see esp_store_read() and esp_store_write().
+
+        Sign convention: the store always holds the negated psi4 ESP, -GRID_ESP, i.e. the potential energy of 
+        the electron used in the potential matrix. Writers negate the output of CALC_ESP_WFN / CALC_ESP_POOL 
+        before esp_store_write(); readers use the values as they are.
+
+        Returns:
+            storedir: path to the store
+    """
+    r_array = np.ascontiguousarray(r_points(Gr))
+    if isinstance(Gs, np.ndarray):
+        #single angular grid shared by all radial points
+        npts    = np.full(r_array.shape[0], Gs.shape[0], dtype = np.int64)
+        Gs_all  = np.ascontiguousarray(Gs, dtype = float)
+    else:
+        npts    = np.array([ Gs[k].shape[0] for k in range(len(Gs)) ], dtype = np.int64)
+        Gs_all  = np.ascontiguousarray(np.concatenate([ Gs[k] for k in range(len(Gs)) ], axis = 0), dtype = float)
+
+    h = hashlib.sha1()
+    for key in ['molec_name', 'scf_basis', 'scf_method', 'scf_enr_conv']:
+        h.update((key + "=" + str(params[key]) + ";").encode())
+    h.update(np.round(r_array, 10).tobytes())
+    h.update(npts.tobytes())
+    h.update(np.round(Gs_all, 12).tobytes())
+
+    storedir = params['sweep_directory'] + "esp/store_" + h.hexdigest()[:16] + "/"
+    os.makedirs(storedir, exist_ok = True)
+
+    if not os.path.isfile(storedir + "grid.h5"):
+        tmpfile = storedir + "grid_" + str(os.getpid()) + ".tmp"
+        with h5py.File(tmpfile, 'w') as h5:
+            h5.create_dataset("r", data = r_array)
+            h5.create_dataset("npts", data = npts)
+            h5.create_dataset("Gs", data = Gs_all)
+            h5.attrs['molec_name'] = params['molec_name']
+        os.replace(tmpfile, storedir + "grid.h5")
+
+    return storedir
+
+
+def esp_store_geomkey(mol_xyz):
+    """ hash of the geometry (orientation) of the molecule """
+    return hashlib.sha1(np.round(np.ascontiguousarray(mol_xyz, dtype = float), 10).tobytes()).hexdigest()[:16]
+
+
+def esp_store_read(storedir, mol_xyz):
+    """ Read the ESP for geometry mol_xyz from the store. Returns None if not present. 
+        Values not yet calculated are stored as NaN. """
+    filename = storedir + "esp_" + esp_store_geomkey(mol_xyz) + ".h5"
+    if not os.path.isfile(filename):
+        return None
+    try:
+        with h5py.File(filename, 'r') as h5:
+            return h5["V"][...]
+    except OSError:
+        print("Warning: corrupted ESP file " + filename + " will be recalculated")
+        return None
+
+
+def esp_store_write(storedir, mol_xyz, V):
+    """ Write the ESP for geometry mol_xyz to the store (negated psi4 ESP, see esp_store_open). The file is written
+        to a temporary file first and moved into place, so that readers never see partially written data. """
+    filename = storedir + "esp_" + esp_store_geomkey(mol_xyz) + ".h5"
+    tmpfile  = filename[:-3] + "_" + str(os.getpid()) + ".tmp"
+    with h5py.File(tmpfile, 'w') as h5:
+        h5.create_dataset("V", data = np.asarray(V, dtype = float))
+        h5.create_dataset("mol_xyz", data = np.asarray(mol_xyz, dtype = float))
+    os.replace(tmpfile, filename)
+
+
 def CALC_ESP_PSI4(dir,params):
-    os.chdir(dir)
+    """ ESP at the points listed in dir/grid.dat. The working directory of the process is not changed. """
     psi4.core.be_quiet()
     properties_origin=["COM"]
     #psi4.core.set_output_file(dir, False)
@@ -252,16 +456,19 @@ def CALC_ESP_PSI4(dir,params):
     )
 
     psi4.set_options({'basis': params['scf_basis'], 'e_convergence': params['scf_enr_conv'], 'reference': params['scf_method']})
-    E, wfn = psi4.prop('scf', properties = ["GRID_ESP"], return_wfn = True)
-    Vvals = wfn.oeprop.Vvals()
-    os.chdir("../")
-    return Vvals
+    E, wfn = psi4.energy('scf', molecule = mol, return_wfn = True)
+    return CALC_ESP_WFN(wfn, np.loadtxt(dir + "grid.dat", ndmin = 2))
 
 
 def CALC_ESP_PSI4_ROT(dir,params,mol_xyz):
-    os.chdir(dir)
-    psi4.core.be_quiet()
-    properties_origin=["COM"] #[“NUCLEAR_CHARGE”] or ["COM"] #here might be the shift!
+    """ ESP at the points listed in dir/grid.dat for the molecule at mol_xyz. The working directory of the process
+        is not changed. """
+    wfn = CALC_SCF_PSI4_ROT(params, mol_xyz)
+    return CALC_ESP_WFN(wfn, np.loadtxt(dir + "grid.dat", ndmin = 2))
+
+
+def gen_psi4_geometry(params, mol_xyz):
+    """ psi4 molecule for params['molec_name'] with atomic positions mol_xyz (3 x natoms, a.u.) """
     ang_au = CONSTANTS.angstrom_to_au
 
     if params['molec_name'] == "d2s":
@@ -381,11 +588,118 @@ def CALC_ESP_PSI4_ROT(dir,params,mol_xyz):
         """.format( 0.0, 0.0, 0.0)
         )
 
+    return mol
+
+
+def CALC_SCF_PSI4_ROT(params, mol_xyz):
+    """ Run a single SCF calculation for the molecule at orientation mol_xyz and return the wavefunction.
+
+        The ESP at any set of points is then available from CALC_ESP_WFN without repeating the SCF.
+    """
+    psi4.core.be_quiet()
+    mol = gen_psi4_geometry(params, mol_xyz)
     psi4.set_options({'basis': params['scf_basis'], 'e_convergence': params['scf_enr_conv'], 'reference': params['scf_method']})
-    E, wfn = psi4.prop('scf', properties = ["GRID_ESP"], return_wfn = True)
-    Vvals = wfn.oeprop.Vvals()
-    os.chdir("../")
-    return Vvals
+    start_time = time.time()
+    E, wfn = psi4.energy('scf', molecule = mol, return_wfn = True)
+    end_time = time.time()
+    print("Time for the SCF calculation: " +  str("%10.3f"%(end_time-start_time)) + "s")
+    return wfn
+
+
+def CALC_ESP_WFN(wfn, grid_xyz, esp_cache = None):
+    """ Evaluate the ESP of the SCF wavefunction wfn at points grid_xyz (npts x 3, a.u.) in a single call.
+
+        Arguments:
+            esp_cache: optional dict {(x,y,z): V} of points evaluated before, e.g. at lower quadrature levels.
+                        Points found in the cache are not recomputed; new points are added to it.
+
+        Returns:
+            V: numpy array (npts) with the same values as the GRID_ESP property (Vvals)
+    """
+    grid_xyz    = np.ascontiguousarray(grid_xyz, dtype = float).reshape(-1,3)
+    keys        = [tuple(p) for p in np.round(grid_xyz, 10)]
+    V           = np.zeros(grid_xyz.shape[0], dtype = float)
+
+    if esp_cache is None:
+        esp_cache = {}
+
+    new = [ipoint for ipoint, key in enumerate(keys) if key not in esp_cache]
+    if new:
+        #unique new points
+        new_keys, new_ind = np.unique(np.round(grid_xyz[new], 10), axis = 0, return_index = True)
+        points = grid_xyz[new][new_ind]
+        print("Evaluating ESP at " + str(points.shape[0]) + " points")
+        espcalc = psi4.core.ESPPropCalc(wfn)
+        Vnew = np.asarray(espcalc.compute_esp_over_grid_in_memory(psi4.core.Matrix.from_array(points))).ravel()
+        for key, val in zip(new_keys, Vnew):
+            esp_cache[tuple(key)] = val
+
+    for ipoint, key in enumerate(keys):
+        V[ipoint] = esp_cache[key]
+
+    return V
+
+
+""" ============ ESP service: parallel psi4 workers ============ """
+def esp_worker(task):
+    """ Evaluate the ESP for one geometry in a worker process with its own psi4 scratch directory.
+
+        task = (params, mol_xyz, grid_xyz, nthreads). Returns numpy array of ESP values at grid_xyz.
+    """
+    params, mol_xyz, grid_xyz, nthreads = task
+
+    scratch = tempfile.mkdtemp(prefix = "psi4_esp_", dir = params.get('esp_scratch_dir'))
+    try:
+        psi4.core.IOManager.shared_object().set_default_path(scratch)
+        psi4.core.set_output_file(os.path.join(scratch, "output.dat"), False)
+        psi4.set_num_threads(nthreads)
+        wfn = CALC_SCF_PSI4_ROT(params, mol_xyz)
+        V   = CALC_ESP_WFN(wfn, grid_xyz)
+        psi4.core.clean()
+    finally:
+        shutil.rmtree(scratch, ignore_errors = True)
+    return V
+
+
+def CALC_ESP_POOL(params, mol_xyz_list, grid_xyz_list):
+    """ Evaluate the ESP for many geometries (e.g. orientations) in parallel on one node.
+
+        Each geometry is handled by a psi4 job in a separate worker process (params['esp_nprocs'] processes,
+        params['esp_nthreads'] threads each) with its own scratch directory, so no global state such as the
+        working directory is shared between jobs.
+
+        Arguments:
+            mol_xyz_list: list of arrays (3, natoms) with atomic positions
+            grid_xyz_list: list of arrays (npts, 3) with points at which the ESP is evaluated,
+                            or a single array used for all geometries
+
+        Returns:
+            list of numpy arrays with ESP values (same sign convention as GRID_ESP)
+    """
+    if isinstance(grid_xyz_list, np.ndarray):
+        grid_xyz_list = [grid_xyz_list] * len(mol_xyz_list)
+
+    #only settings needed by the workers are sent to them
+    params_esp = { key: params[key] for key in ['molec_name', 'mol_geometry', 'scf_basis', 'scf_enr_conv', 
+                                                'scf_method', 'esp_scratch_dir'] if key in params }
+
+    tasks = [ (params_esp, mol_xyz, np.asarray(grid_xyz, dtype = float), params['esp_nthreads']) 
+                for mol_xyz, grid_xyz in zip(mol_xyz_list, grid_xyz_list) ]
+
+    nprocs = min(params['esp_nprocs'], len(tasks))
+    print("Evaluating ESP for " + str(len(tasks)) + " geometries on " + str(nprocs) + " processes")
+
+    start_time = time.time()
+    if nprocs <= 1:
+        Vlist = [ esp_worker(task) for task in tasks ]
+    else:
+        #psi4 is not fork-safe: start fresh interpreters
+        with multiprocessing.get_context("spawn").Pool(processes = nprocs, maxtasksperchild = 1) as pool:
+            Vlist = pool.map(esp_worker, tasks, chunksize = 1)
+    end_time = time.time()
+    print("Time for the ESP evaluation: " +  str("%10.3f"%(end_time-start_time)) + "s")
+
+    return Vlist
 
 
 
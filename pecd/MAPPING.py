@@ -14,6 +14,8 @@ def GENMAP_FEMLIST(femlist,lmax,maptype,working_dir):
     elif maptype == 'SPECT':
         maparray, Nbas = MAP_SPECT_FEMLIST(femlist,lmax)
 
+    maparray = basismap(maparray, maptype)
+
     #fl = open(working_dir + 'map.dat','w')
     #for elem in maparray:   
     #    fl.write("%5d"%elem[0]+"  %5d"%elem[1]+ "  %5d"%elem[2]+ "  %5d"%elem[3]+  " %5d"%elem[4]+" %5d"%elem[5]+"\n")
@@ -24,6 +26,124 @@ def GENMAP_FEMLIST(femlist,lmax,maptype,working_dir):
 
 
 
+class basismap:
+    """ Basis index backed by a numpy structured array with fields (bin, n, xi, l, m, idx).
+
+        Row p of the map describes the p-th basis function. The object behaves like the former
+        list-of-lists maparray: len(), iteration and maparray[p][k] return the same integers in the same
+        column order ([bin,n,xi,l,m,idx] for 'DVR', [l,m,bin,n,xi,idx] for 'SPECT'), and np.asarray(maparray)
+        gives the (Nbas,6) integer table. On top of that it provides vectorized field accessors and
+        precomputed inverse lookups:
+
+            index(xi,l,m)   -> row of the basis function (vectorized, -1 if absent)
+            xi_block(xi)    -> slice (or index array) of rows sharing radial point xi
+            lm_block(l,m)   -> strided slice (or index array) of rows with given (l,m)
+    """
+
+    columns = { 'DVR':      ('bin', 'n', 'xi', 'l', 'm', 'idx'),
+                'SPECT':    ('l', 'm', 'bin', 'n', 'xi', 'idx') }
+
+    def __init__(self, maparray, maptype = 'DVR'):
+
+        if maptype not in self.columns:
+            raise ValueError("Incorrect map type")
+
+        self.maptype    = maptype
+        self.names      = self.columns[maptype]
+        self.table      = np.ascontiguousarray(np.asarray(maparray, dtype = np.int32).reshape(-1,6))
+        self.data       = self.table.view([(name, np.int32) for name in self.names]).ravel()
+        self.table.setflags(write = False)
+        self.gen_lookups()
+
+
+    def gen_lookups(self):
+        """ precompute inverse lookups (xi,l,m) -> row, xi -> rows, (l,m) -> rows """
+        xi  = self.table[:,self.names.index('xi')]
+        l   = self.table[:,self.names.index('l')]
+        m   = self.table[:,self.names.index('m')]
+        rows = np.arange(self.table.shape[0])
+
+        self.lmax   = int(l.max()) if rows.size else 0
+        self.xi_max = int(xi.max()) if rows.size else 0
+        lm          = l * (l + 1) + m
+
+        self.lookup = np.full((self.xi_max + 1, (self.lmax + 1)**2), -1, dtype = np.int64)
+        self.lookup[xi, lm] = rows
+
+        self.xi_rows = self.gen_blocks(xi, self.xi_max + 1)
+        self.lm_rows = self.gen_blocks(lm, (self.lmax + 1)**2)
+
+
+    @staticmethod
+    def gen_blocks(key, nkeys):
+        """ rows with given key, stored as a slice when they form an arithmetic progression """
+        order   = np.argsort(key, kind = 'stable')
+        counts  = np.bincount(key, minlength = nkeys)
+        bounds  = np.r_[0, np.cumsum(counts)]
+        blocks  = []
+        for k in range(nkeys):
+            rows = order[bounds[k]:bounds[k+1]]
+            if rows.size == 0:
+                blocks.append(rows)
+            elif rows.size == 1:
+                blocks.append(slice(int(rows[0]), int(rows[0]) + 1))
+            elif np.all(np.diff(rows) == rows[1] - rows[0]):
+                blocks.append(slice(int(rows[0]), int(rows[-1]) + 1, int(rows[1] - rows[0])))
+            else:
+                blocks.append(rows)
+        return blocks
+
+
+    def index(self, xi, l, m):
+        """ row(s) of basis functions labeled by (xi, l, m); -1 for functions not in the basis """
+        xi, l, m = np.broadcast_arrays(xi, l, m)
+        inside  = (xi >= 0) & (xi <= self.xi_max) & (l >= 0) & (l <= self.lmax) & (np.abs(m) <= l)
+        ind     = np.full(xi.shape, -1, dtype = np.int64)
+        ind[inside] = self.lookup[xi[inside], l[inside] * (l[inside] + 1) + m[inside]]
+        return ind if ind.ndim else int(ind)
+
+
+    def xi_block(self, xi):
+        """ rows sharing the radial point xi """
+        return self.xi_rows[xi]
+
+
+    def lm_block(self, l, m):
+        """ rows with angular quantum numbers (l, m) """
+        return self.lm_rows[l * (l + 1) + m]
+
+
+    def field(self, name):
+        """ read-only column of the map, e.g. maparray.field('xi') """
+        return self.table[:,self.names.index(name)]
+
+
+    def save(self, file):
+        """ binary persistence of the map as a structured .npy array """
+        np.save(file, self.data)
+
+
+    @classmethod
+    def load(cls, file):
+        data    = np.load(file)
+        names   = data.dtype.names
+        maptype = [key for key, val in cls.columns.items() if val == names][0]
+        return cls(np.asarray(data.tolist(), dtype = np.int32), maptype)
+
+
+    def __len__(self):
+        return self.table.shape[0]
+
+    def __getitem__(self, key):
+        return self.table[key]
+
+    def __iter__(self):
+        return iter(self.table)
+
+    def __array__(self, dtype = None, copy = None):
+        return self.table if dtype is None else self.table.astype(dtype)
+
+
 def MAP_DVR_FEMLIST(femlist,lmax):
     imap = 0
     xi = 0
@@ -135,6 +255,9 @@ def GENMAP(nlobs,nbins,lmax,maptype,working_dir):
         fl.write("%5d"%elem[0]+"  %5d"%elem[1]+ "  %5d"%elem[2]+ "  %5d"%elem[3]+  " %5d"%elem[4]+" %5d"%elem[5]+"\n")
     fl.close()
 
+    maparray = basismap(maparray, maptype)
+    maparray.save(working_dir + 'map.npy')
+
 
     return maparray, Nbas
 
@@ -202,40 +325,88 @@ def GEN_SPHLIST(lmax):
 
 #@jit( nopython=True, parallel=False, cache = jitcache, fastmath=False) 
 def GEN_VLIST(maparray, Nbas, map_type):
-    #create list of indices for matrix elements of the potential
-    vlist = []
-
-    #needs speed-up: convert maparray to numpy array and vectorize, add numpy
-
-    if map_type == 'DVR':
-        for p1 in range(Nbas):
-            for p2 in range(p1, Nbas):
-                if maparray[p1][2] == maparray[p2][2]: #and maparray[p1][2] < xi_cutoff
-                    vlist.append([ maparray[p1][2], maparray[p1][3], maparray[p1][4], \
-                        maparray[p2][3], maparray[p2][4], p1, p2  ])
+    """ Create list of indices for matrix elements of the potential.
 
-    elif map_type == 'SPECT':
-        for p1 in range(Nbas):
-            for p2 in range(p1, Nbas):
-                if maparray[p1][2] == maparray[p2][2]:
-                    vlist.append([ maparray[p1][2], maparray[p1][3], maparray[p1][4], maparray[p2][3], maparray[p2][4] ])
-    return vlist
+        All pairs p1 <= p2 of basis functions sharing the same radial point xi are generated
+        block-wise from the index arithmetic of each xi-block, so the cost is linear in the output size.
 
+        Returns:
+            vlist: int32 array, rows (xi, l1, m1, l2, m2, p1, p2) for 'DVR' and (xi, l1, m1, l2, m2) for 'SPECT',
+                    ordered by p1, then p2.
+    """
+    maparray    = np.asarray(maparray, dtype = np.int32)[:Nbas]
+    ind         = np.arange(maparray.shape[0])
 
-def GEN_KLIST(maparray, Nbas, map_type):
-    #create list of indices for matrix elements of the KEO
-    klist = []
+    p1, p2      = gen_block_pairs(maparray[:,2], ind)
 
     if map_type == 'DVR':
-        for p1 in range(Nbas):
-            for p2 in range(p1, Nbas):
-                if maparray[p1][3] == maparray[p2][3] and maparray[p1][4] == maparray[p2][4]:
-                    if maparray[p1][0] == maparray[p2][0] or maparray[p1][0] == maparray[p2][0] - 1 or maparray[p1][0] == maparray[p2][0] + 1: 
-                        klist.append([ maparray[p1][0], maparray[p1][1], maparray[p2][0], \
-                        maparray[p2][1], maparray[p2][3], p1, p2 ])
+        cols = (maparray[p1,2], maparray[p1,3], maparray[p1,4], maparray[p2,3], maparray[p2,4], p1, p2)
+    elif map_type == 'SPECT':
+        cols = (maparray[p1,2], maparray[p1,3], maparray[p1,4], maparray[p2,3], maparray[p2,4])
+    else:
+        raise ValueError("Incorrect map type")
 
+    return np.column_stack(cols).astype(np.int32)
 
-    return klist
+
+def GEN_KLIST(maparray, Nbas, map_type):
+    """ Create list of indices for matrix elements of the KEO.
+
+        Pairs p1 <= p2 with equal (l,m) and bin indices differing by at most one are generated from the
+        banded structure of each (l,m)-block, so the cost is linear in the output size.
+
+        Returns:
+            klist: int32 array, rows (i1, n1, i2, n2, l, p1, p2) ordered by p1, then p2.
+    """
+    if map_type != 'DVR':
+        return np.zeros((0,7), dtype = np.int32)
+
+    maparray    = np.asarray(maparray, dtype = np.int32)[:Nbas]
+    ind         = np.arange(maparray.shape[0])
+
+    _, lm_key   = np.unique(maparray[:,3:5], axis = 0, return_inverse = True)
+    p1, p2      = gen_block_pairs(lm_key.ravel(), ind, band = maparray[:,0])
+
+    return np.column_stack((maparray[p1,0], maparray[p1,1], maparray[p2,0], \
+                            maparray[p2,1], maparray[p2,3], p1, p2)).astype(np.int32)
+
+
+def gen_block_pairs(key, ind, band = None):
+    """ Return all index pairs (p1, p2), p1 <= p2, of elements sharing the same key.
+
+        If band is given, only pairs with abs(band[p1] - band[p2]) <= 1 are returned.
+        Pairs are sorted by p1, then p2.
+    """
+    order       = np.lexsort((ind, key)) if band is None else np.lexsort((ind, band, key))
+    key_s       = key[order]
+    band_s      = np.zeros_like(key_s) if band is None else band[order]
+
+    #range of partners of each element within its sorted block: [lo, hi)
+    bounds      = np.flatnonzero(np.diff(key_s)) + 1
+    start       = np.repeat(np.r_[0, bounds], np.diff(np.r_[0, bounds, key_s.size]))
+    end         = np.repeat(np.r_[bounds, key_s.size], np.diff(np.r_[0, bounds, key_s.size]))
+
+    if band is None:
+        lo, hi = start, end
+    else:
+        #within a block elements are sorted by band, so the partners with |dband| <= 1 form a window
+        glob    = key_s.astype(np.int64) * (band_s.max() - band_s.min() + 3) + (band_s - band_s.min())
+        lo      = np.searchsorted(glob, glob - 1, side = 'left')
+        hi      = np.searchsorted(glob, glob + 1, side = 'right')
+        lo      = np.maximum(lo, start)
+        hi      = np.minimum(hi, end)
+
+    counts      = hi - lo
+    rows        = np.repeat(np.arange(key_s.size), counts)
+    cols        = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+
+    p1          = ind[order][rows]
+    p2          = ind[order][cols]
+    keep        = p1 <= p2
+    p1, p2      = p1[keep], p2[keep]
+
+    srt         = np.lexsort((p2, p1))
+    return p1[srt], p2[srt]
 
 
 """ TESTING 
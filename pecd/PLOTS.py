@@ -80,6 +80,23 @@ def chi(i,n,r,Gr,w,nlobs,nbins):
 
 
 
+def chi_femlist(i,n,r,Gr,nlobs_bin,binw_bin):
+    """ radial basis function (i,n) on a grid of bins with nlobs_bin Gauss-Lobatto points and widths binw_bin.
+        The weights are scaled relative to the first bin, so that for uniform bins chi_femlist() equals chi(). """
+    nlobs   = nlobs_bin[i]
+    nbins   = nlobs_bin.size
+    x, w    = GRID.gauss_lobatto(nlobs,14)
+    w       = np.asarray(w, dtype = float) * binw_bin[i] / binw_bin[0]
+
+    if n == nlobs-1: #bridge functions
+        x, wnext    = GRID.gauss_lobatto(nlobs_bin[i+1],14)
+        wnext       = np.asarray(wnext, dtype = float) * binw_bin[i+1] / binw_bin[0]
+        return ( f(i,nlobs-1,r,Gr,nlobs,nbins) + f(i+1,0,r,Gr,nlobs_bin[i+1],nbins) ) * np.sqrt( w[nlobs-1] + wnext[0] )**(-1)
+
+    else:
+        return f(i,n,r,Gr,nlobs,nbins) * np.sqrt( w[n] ) **(-1) 
+
+
 def f(i,n,r,Gr,nlobs,nbins): 
     """calculate f_in(r). Input r can be a scalar or a vector (for quadpy quadratures) """
     
@@ -130,19 +147,35 @@ def plot_snapshot_int(params,psi,maparray,Gr,t,flist, irun):
     plot_wf_angrad_int_XY(0.0, rmax, npoints, nlobs, nbins, psi, maparray, Gr, params, t, flist, irun)
 
     
-def interpolate_chi(Gr,nlobs,nbins,binw,maparray):
+def interpolate_chi(Gr,nlobs,nbins,binw,maparray,femlist = None):
+    """ interpolants of the radial basis functions chi on the primitive grid Gr.
+        femlist: bins of different widths and Lobatto orders [[nbins, nlobs, binw], ...] (overrides nlobs, nbins, binw) 
+
+        Each chi is tabulated only over its own bin (two bins for bridge functions) with 50 steps per Gauss-Lobatto
+        point of the bin, and its interpolant returns zero outside of them. Memory is then proportional to the 
+        number of basis functions, independent of the ratio of the widest to the narrowest bin.
+    """
 
-    w       =  np.zeros(nlobs)
-    xx,w    =  GRID.gauss_lobatto(nlobs,14)
-    w       =  np.array(w)
+    if femlist is None:
+        femlist = [[nbins, nlobs, binw]]
 
-    interpolation_step = binw/200.0
-    x = np.arange(0.0, nbins * binw + 0.10, interpolation_step)
+    nlobs_bin, binw_bin = GRID.femlist_bins(femlist)
+    nsteps_lob = 50 #interpolation steps per Gauss-Lobatto point of a bin
 
     chilist  = []
 
     for i, elem in enumerate(maparray):
-        chilist.append( interpolate.interp1d(x, chi(elem[0], elem[1], x, Gr, w, nlobs, nbins) ) )
+        ibin, n = elem[0], elem[1]
+        nsteps = nsteps_lob * nlobs_bin[ibin]
+        x = np.linspace(Gr[ibin,0], Gr[ibin,nlobs_bin[ibin]-1], nsteps + 1)
+        xeval = x.copy()
+        if n == nlobs_bin[ibin]-1: #bridge functions extend over the next bin
+            x = np.concatenate((x, np.linspace(Gr[ibin+1,0], Gr[ibin+1,nlobs_bin[ibin+1]-1], nsteps_lob * nlobs_bin[ibin+1] + 1)[1:]))
+            xeval = x.copy()
+            xeval[nsteps] = np.nextafter(x[nsteps], -np.inf) #at the joint both bins contribute in f(): take the limit from the left
+
+        chilist.append( interpolate.interp1d(x, chi_femlist(ibin, n, xeval, Gr, nlobs_bin, binw_bin), 
+                                                bounds_error = False, fill_value = 0.0 ) )
 
     #xnew  = np.arange(0.02, nbins * binw, 0.01)
     #ynew = chilist[1](xnew)   # use interpolation function returned by `interp1d`
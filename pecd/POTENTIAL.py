@@ -10,13 +10,13 @@ from scipy.special import sph_harm
 import GRID 
 
 import os
+import hashlib
 import time
 import json
 import pickle
 import matplotlib.pyplot as plt
 from matplotlib import cm, colors
 from mpl_toolkits.mplot3d import Axes3D
-from multipoles import MultipoleExpansion
 
 
 def convert(o):
@@ -70,8 +70,9 @@ def delta_gaussian2D(XY,Z0, xyz_mol, Q_array):
     return g/(epsilon * np.sqrt(2.0 * np.pi))
 
 
-def chiralium_charge_distr(npoints,edge):
-    """ Build charge distribution for the model chiralium molecule"""
+def chiralium_centers():
+    """ Positions (3 x 5, cartesian) of the charge centers of the model chiralium molecule, 
+        amplitudes q_array of Slater (electron) and Q_array of Gaussian (nuclear) charges """
 
     # 1. Positions of the nuclei given in spherical coordinates
 
@@ -84,6 +85,13 @@ def chiralium_charge_distr(npoints,edge):
     x,y,z = sph2cart(r_array,theta_array,phi_array)
 
     xyz_mol = np.vstack((x,y,z))
+    return xyz_mol, q_array, Q_array
+
+
+def chiralium_charge_distr(npoints,edge):
+    """ Build charge distribution for the model chiralium molecule"""
+
+    xyz_mol, q_array, Q_array = chiralium_centers()
 
     x, y, z = [np.linspace(-edge/2., edge/2., npoints)]*3
     XYZ = np.meshgrid(x, y, z, indexing='ij')
@@ -109,125 +117,341 @@ def chiralium_charge_distr(npoints,edge):
     return rho, XYZ
 
 def calc_multipoles(params):
+    """ Multipole moments qlm[(L,M)] of the chiralium charge distribution about the origin, L <= multi_lmax:
+
+        qlm = sqrt(4pi/(2L+1)) int rho(r) r^L Y_LM^*(theta,phi) d^3r
+
+        params['multi_method']:
+            'analytic': every Slater and Gaussian center is spherically symmetric, so by the mean-value property of
+                        the solid harmonics its moments equal those of a point charge at the center with the
+                        total charge of the center (radial moment int f(r) d^3r: 8pi for exp(-r), 2pi eps^2 
+                        for the normalized Gaussian).
+            'grid':     quadrature on a multi_ncube_points^3 grid in a box of edge multi_box_edge, evaluated in
+                        slabs of the grid so that memory stays bounded.
+    """
 
-    qlm = []
     Lmax = params['multi_lmax']
 
+    if params['multi_method'] == 'analytic':
+        xyz_mol, q_array, Q_array = chiralium_centers()
+        epsilon = 0.1 #width of the Gaussian charges, see delta_gaussian()
+        charges = 8.0 * np.pi * q_array + 2.0 * np.pi * epsilon**2 * Q_array
+        qlm     = calc_multipoles_point(xyz_mol, charges, Lmax)
 
-    npoints = params['multi_ncube_points']
-    edge    = params['multi_box_edge']
+    elif params['multi_method'] == 'grid':
+        qlm     = calc_multipoles_grid(params['multi_ncube_points'], params['multi_box_edge'], Lmax)
 
-    rho, XYZ = chiralium_charge_distr(npoints,edge)
+    else:
+        raise ValueError("Incorrect method for the multipole moments")
 
-    charge_dist = {
-        'discrete': False,
-        'rho': rho,
-        'xyz': XYZ
-    }
 
-    Phi = MultipoleExpansion(charge_dist, Lmax)
-    qlm = Phi.multipole_moments
+    with open(params['job_directory']+ "multipoles.dat", 'w') as qlmfile: 
+        qlmfile.write( str(qlm) )
+        #json.dump(qlm, qlmfile, indent=4, default=convert) #not suitable for tule keys
 
-    """ Plot potential"""
-    npoints2D = 200
-    x, y = [np.linspace(-edge/2., edge/2., npoints2D)]*2
-    XY = np.meshgrid(x,y, indexing='ij')
+    return qlm
 
-    """
-    fig = plt.figure()
-    ax = fig.add_subplot(111)
 
-    Z0 = 0.0
-    rho2D = np.zeros((len(x),len(y)))
-    XY = np.meshgrid(x,y, indexing='ij')
-    for i in range(len(x)):
-        for j in range(len(x)):
-            rho2D[i,j] = Phi(x[i],y[j],Z0)
-    print(rho2D.shape)
-    print(rho2D)
-
-    plot_cont_1 = ax.contourf( XY[0], XY[1], rho2D, 
-                                20, 
-                                cmap = 'jet', 
-                                vmin = -20.0,
-                                vmax = 20.0)
-
-    fig.colorbar(plot_cont_1)
-    plt.show()
-    """
-    
+def calc_multipoles_point(xyz, charges, Lmax):
+    """ multipole moments about the origin of point charges located at xyz (3 x ncharges) """
+    r       = np.sqrt(np.sum(xyz**2, axis = 0))
+    theta   = np.arccos(np.clip(xyz[2] / np.where(r > 0.0, r, 1.0), -1.0, 1.0))
+    phi     = np.arctan2(xyz[1], xyz[0])
 
+    qlm = {}
+    for L in range(Lmax + 1):
+        for M in range(-L, L + 1):
+            qlm[(L,M)] = np.sqrt(4.0 * np.pi / (2 * L + 1)) * np.sum( charges * r**L * np.conj(sph_harm(M, L, phi, theta)) )
+    return qlm
 
-    with open(params['job_directory']+ "multipoles.dat", 'w') as qlmfile: 
-        qlmfile.write( str(qlm) )
-        #json.dump(qlm, qlmfile, indent=4, default=convert) #not suitable for tule keys
+
+def calc_multipoles_grid(npoints, edge, Lmax, max_slab_points = 2**21):
+    """ multipole moments about the origin of the chiralium charge distribution by quadrature on a cubic grid,
+        evaluated slab-by-slab (at most max_slab_points grid points at a time) """
+    xyz_mol, q_array, Q_array = chiralium_centers()
+
+    x       = np.linspace(-edge/2., edge/2., npoints)
+    dvol    = (x[1] - x[0])**3
+    nslab   = max(1, max_slab_points // npoints**2)
+
+    qlm = { (L,M): 0.0 + 0.0j for L in range(Lmax + 1) for M in range(-L, L + 1) }
+
+    for i0 in range(0, npoints, nslab):
+        XYZ     = np.meshgrid(x[i0:i0+nslab], x, x, indexing='ij')
+        rho     = (slater(XYZ, xyz_mol, q_array) + delta_gaussian(XYZ, xyz_mol, Q_array)).ravel() * dvol
+        r       = np.sqrt(XYZ[0]**2 + XYZ[1]**2 + XYZ[2]**2).ravel()
+        theta   = np.arccos(np.clip(XYZ[2].ravel() / np.where(r > 0.0, r, 1.0), -1.0, 1.0))
+        phi     = np.arctan2(XYZ[1].ravel(), XYZ[0].ravel())
+
+        rl = np.ones_like(r)
+        for L in range(Lmax + 1):
+            for M in range(-L, L + 1):
+                qlm[(L,M)] += np.sqrt(4.0 * np.pi / (2 * L + 1)) * np.dot( rho * rl, np.conj(sph_harm(M, L, phi, theta)) )
+            rl *= r
 
     return qlm
 
 
+def vlm_filename(params, L, M):
+    """ name of the file with the (L,M) partial wave of A. Artemyev's potential """
+    if M == 0:
+        suffix = ""
+    elif M > 0:
+        suffix = "_pos"
+    elif M < 0:
+        suffix = "_neg"
+    return params['main_dir'] + "potential/potential_L" + str(L) + "_M" + str(abs(M))+suffix + ".dat"
+
+
 def read_potential(params):
     #read the partial waves representation of the electrostatic potential. A. Artemyev's potential.
     #vLM[xi, L, M]
+    """ The text files are parsed once and stored in potential/vLM_L<multi_lmax>.npz. The binary cache is used
+        as long as it is newer than all text files it was generated from. """
 
-    Nr = (params['bound_nlobs']-1) * params['bound_nbins']
+    nlobs, binw = GRID.femlist_bins(params['FEMLIST'])
+    Nr      = int(np.sum(nlobs - 1)) #number of radial points of the bound grid
+    Lmax    = params['multi_lmax']
 
-    vLM = np.zeros((    Nr,
-                        params['multi_lmax'] + 1, 
-                        2 * params['multi_lmax'] + 1), 
-                        dtype=complex)
+    cachefile   = params['main_dir'] + "potential/vLM_L" + str(Lmax) + ".npz"
+    vlmfiles    = [ vlm_filename(params, L, M) for L in range(Lmax + 1) for M in range(-L,L+1) ]
 
-    for L in range(params['multi_lmax'] + 1):
-        for M in range(-L,L+1):
-            if M == 0:
-                suffix = ""
-            elif M > 0:
-                suffix = "_pos"
-            elif M < 0:
-                suffix = "_neg"
+    if os.path.isfile(cachefile) and os.path.getmtime(cachefile) >= max(os.path.getmtime(f) for f in vlmfiles):
+        data    = np.load(cachefile)
+        vLM_all = data['vLM']
+        rgrid   = data['rgrid']
+    else:
+        print("parsing partial waves of the potential and saving binary cache: " + cachefile)
+        vLM_all = None
+        for L in range(Lmax + 1):
+            for M in range(-L,L+1):
+                v = np.loadtxt(vlm_filename(params, L, M), skiprows = 3, ndmin = 2) #skip header
+                if vLM_all is None:
+                    vLM_all = np.zeros((v.shape[0], Lmax + 1, 2 * Lmax + 1), dtype=complex)
+                    rgrid   = v[:,0]
+                vLM_all[:,L,L+M] = v[:,1] + 1j * v[:,2]
+
+        tmpfile = cachefile[:-4] + "_" + str(os.getpid()) + ".tmp.npz"
+        try:
+            np.savez(tmpfile, vLM = vLM_all, rgrid = rgrid)
+            os.replace(tmpfile, cachefile)
+        except OSError as e:
+            print("Warning: could not save the binary cache of the potential: " + str(e))
+
+    if vLM_all.shape[0] < Nr:
+        raise ValueError("The partial waves of the potential have " + str(vLM_all.shape[0]) + \
+                            " radial points, the radial grid (FEMLIST) has " + str(Nr))
+    vLM = vLM_all[:Nr] #assuming our grid matches the one for the potential!!!
+    rgrid = rgrid[:Nr]
 
-            vlmfile = open(params['main_dir'] + "potential/potential_L" + str(L) + "_M" + str(abs(M))+suffix + ".dat" , 'r' )
-            v = []
+    return vLM,rgrid
 
-            for _ in range(3):
-                next(vlmfile) #skip header
 
-            for line in vlmfile:
-                words =  line.split()
-                r     =  float(words[0])
-                v_re  =  float(words[1])
-                v_im  =  float(words[2])
+def tab_ylm_leb(Gs, Lmax):
+    """ Tabulate Y_LM(theta, phi + pi) for L = 0,...,Lmax at points of a spherical quadrature grid Gs.
 
-                v.append([r, v_re + 1j * v_im])
-            vlmfile.close()
+        Returns:
+            Ymat: numpy array ((Lmax+1)*(2*Lmax+1), npts), row L*(2*Lmax+1) + L+M, zero rows for |M| > L,
+                    matching the flattened layout of vLM[xi, L, L+M]
+    """
+    L       = np.repeat(np.arange(Lmax + 1), 2 * Lmax + 1)
+    M       = np.tile(np.arange(2 * Lmax + 1), Lmax + 1) - L
+    valid   = np.abs(M) <= L
+    Ymat    = np.zeros(((Lmax + 1) * (2 * Lmax + 1), Gs.shape[0]), dtype = complex)
+    Ymat[valid] = sph_harm( M[valid][:,None], L[valid][:,None], Gs[None,:,1] + np.pi, Gs[None,:,0] )
+    return Ymat
 
-            #v.append([400.0,0.0+1j*0.0])
-            v = np.asarray(v)
-            vLM[:,L,L+M] = v[:Nr,1] #assuming our grid matches the one for the potential!!!
 
-    rgrid = v[:Nr,0]
+def gen_vlm_exact(params, Gr, mol_xyz):
+    """ Partial-wave representation vLM[xi, L, L+M] of the exact (psi4) ESP in the molecular frame.
+
+        The ESP is calculated once, from a single SCF, on Lebedev shells (params['vlm_quad_scheme']) placed
+        at all radial grid points and projected onto spherical harmonics up to L = params['multi_lmax'].
+        The result is stored in the sweep directory and reused for all orientations, which are generated
+        by rotation of vLM with Wigner D-matrices (see BOUND.rotate_vlm), and for all lmax of a sweep.
+        The file name contains a hash of the molecule, its geometry, the SCF settings, the quadrature and the
+        radial grid, so that a changed setup never reuses stale partial waves.
+
+        The expansion is truncated at the converged L: the smallest L beyond which max_r |vLM(r)| of all higher
+        partial waves stays below params['vlm_conv_tol'] times max_r |v00(r)| (no truncation if None).
+
+        Arguments:
+            Gr: radial grid (nbins, nlobs-1)
+            mol_xyz: cartesian coordinates (3, natoms) of the molecule in the molecular frame
+
+        Returns:
+            vLM: numpy array (Nr, Lconv+1, 2*Lconv+1), Lconv <= multi_lmax, same layout as in read_potential()
+    """
+    r_array = GRID.r_points(Gr)
+    Lmax    = params['multi_lmax']
+
+    h = hashlib.sha1()
+    for key in ['molec_name', 'mol_geometry', 'scf_basis', 'scf_method', 'scf_enr_conv', 'vlm_quad_scheme']:
+        h.update((key + "=" + str(params[key]) + ";").encode())
+    h.update(np.round(np.asarray(mol_xyz, dtype = float), 10).tobytes())
+    h.update(np.round(r_array, 10).tobytes())
+    rhash   = h.hexdigest()[:16]
+    vlmfile = params['sweep_directory'] + "esp/" + "vlm_exact_" + params['molec_name'] + "_" + rhash + ".npz"
+
+    if os.path.isfile(vlmfile):
+        print("reading partial waves of the ESP from file: " + vlmfile)
+        data = np.load(vlmfile)
+        if data['vLM'].shape[1] - 1 >= Lmax and np.allclose(data['rgrid'], r_array):
+            return truncate_vlm(data['vLM'][:, :Lmax + 1, :2 * Lmax + 1], params['vlm_conv_tol'])
+        print("stored partial waves do not match the current grid or multi_lmax, recalculating")
+
+    Gs = GRID.get_leb_quad(params['vlm_quad_scheme'], params['main_dir'])
+
+    """ 1. ESP on all Lebedev shells from a single SCF """
+    wfn     = GRID.CALC_SCF_PSI4_ROT(params, mol_xyz)
+    x, y, z = sph2cart( r_array[:,None], Gs[None,:,0], Gs[None,:,1] )
+    V       = -1.0 * GRID.CALC_ESP_WFN(wfn, np.stack((x,y,z), axis = -1).reshape(-1,3))
+    V       = V.reshape(r_array.shape[0], Gs.shape[0])
+
+    """ 2. Projection onto spherical harmonics: vLM(r) = 4pi sum_s w_s V(r,s) Y_LM^*(s) """
+    vLM     = np.zeros((r_array.shape[0], Lmax + 1, 2 * Lmax + 1), dtype = complex)
+    WV      = V * Gs[None,:,2]
+    for L in range(Lmax + 1):
+        M = np.arange(-L, L + 1)
+        Y = sph_harm( M[:,None], L, Gs[None,:,1] + np.pi, Gs[None,:,0] )
+        vLM[:, L, :2 * L + 1] = 4.0 * np.pi * WV @ Y.conj().T
+
+        print("L = " + str(L) + ", max |vLM(r)| = " + str('%12.6e'%np.max(np.abs(vLM[:, L, :2 * L + 1]))))
+
+    """ 3. Save in the sweep directory """
+    os.makedirs(params['sweep_directory'] + "esp/", exist_ok = True)
+    tmpfile = vlmfile[:-4] + "_" + str(os.getpid()) + ".tmp.npz"
+    np.savez(tmpfile, vLM = vLM, rgrid = r_array, scheme = params['vlm_quad_scheme'])
+    os.replace(tmpfile, vlmfile)
+
+    return truncate_vlm(vLM, params['vlm_conv_tol'])
+
+
+def truncate_vlm(vLM, tol):
+    """ Truncate partial waves vLM[xi, L, L+M] at the converged L: all partial waves above it have 
+        max_r |vLM(r)| <= tol * max_r |v00(r)|. No truncation if tol is None. """
+    if tol is None:
+        return vLM
+
+    Lmax    = vLM.shape[1] - 1
+    vmax    = np.array([ np.max(np.abs(vLM[:, L, :2 * L + 1])) for L in range(Lmax + 1) ])
+    above   = np.flatnonzero(vmax > tol * vmax[0])
+    Lconv   = int(above[-1]) if above.size else 0
+
+    if Lconv == Lmax:
+        print("partial waves of the ESP not converged within L = " + str(Lmax) + " (max |vLM| = " + \
+                str('%12.6e'%vmax[Lmax]) + "), consider increasing multi_lmax")
+    else:
+        print("partial waves of the ESP converged at L = " + str(Lconv) + " (tolerance " + str(tol) + ")")
+    return vLM[:, :Lconv + 1, :2 * Lconv + 1]
+
+class esp_interp_sph:
+    """ Interpolant of the ESP given on spherical shells: spherical-harmonic expansion of each shell
+        and a cubic spline in r of the expansion coefficients.
+
+        V(r,theta,phi) = sum_{L<=Lmax} sum_M vLM(r) Y_LM(theta,phi)
+
+        Points of the input ESP are grouped into shells of equal radius, within shell_tol (e.g. Lebedev shells 
+        written by GEN_XYZ_GRID with coordinates rounded to 6 decimals). The coefficients of each shell are fitted by linear least squares with L limited by the
+        number of points on the shell. Construction costs one small fit per shell and evaluation is a matrix
+        product with a table of Y_LM, so whole quadrature grids are evaluated at once.
+        Outside of the range of radii of the input shells NaN is returned, as with LinearNDInterpolator.
+    """
+
+    def __init__(self, xyz, v, Lmax, shell_tol = 1.0e-4):
+
+        self.Lmax       = Lmax
+        self.shell_tol  = shell_tol
+        r           = np.sqrt(np.sum(xyz**2, axis = 1))
+        theta       = np.arccos(np.clip(xyz[:,2] / np.where(r > 0.0, r, 1.0), -1.0, 1.0))
+        phi         = np.arctan2(xyz[:,1], xyz[:,0])
+
+        rshells, ishell = self.group_shells(r, shell_tol)
+
+        vLM     = np.zeros((rshells.shape[0], (Lmax + 1)**2), dtype = complex)
+        order   = np.argsort(ishell, kind = 'stable')
+        bounds  = np.r_[0, np.cumsum(np.bincount(ishell))]
+        pinvs   = {} #pseudo-inverses of Y_LM tables, shared by shells with the same angular grid
+        for k in range(rshells.shape[0]):
+            pts     = order[bounds[k]:bounds[k+1]]
+            key     = np.round(np.column_stack((theta[pts], phi[pts])), 8).tobytes()
+            if key not in pinvs:
+                #keep the least-squares problem overdetermined
+                Lk          = min(Lmax, int(np.sqrt(pts.shape[0])) - 1)
+                pinvs[key]  = (Lk, np.linalg.pinv(self.tab_ylm(theta[pts], phi[pts], Lk)))
+            Lk, pinv = pinvs[key]
+            vLM[k,:(Lk + 1)**2] = pinv @ v[pts]
+
+        self.rmin   = rshells[0]
+        self.rmax   = rshells[-1]
+        self.spline = interpolate.CubicSpline(rshells, vLM, axis = 0, extrapolate = False) if rshells.shape[0] > 1 else None
+        self.vLM0   = vLM[0]
+
+
+    @staticmethod
+    def group_shells(r, shell_tol):
+        """ Group radii into shells: sorted radii are split at gaps larger than shell_tol, so that radii recomputed
+            from coordinates stored with a few decimals (e.g. %10.6f in GEN_XYZ_GRID) fall into the same shell.
+            Returns the mean radius of each shell and the shell index of each point. """
+        order   = np.argsort(r, kind = 'stable')
+        newshell = np.r_[False, np.diff(r[order]) > shell_tol]
+        ishell  = np.empty(r.shape[0], dtype = int)
+        ishell[order] = np.cumsum(newshell)
+        rshells = np.bincount(ishell, weights = r) / np.bincount(ishell)
+        return rshells, ishell
+
+
+    @staticmethod
+    def tab_ylm(theta, phi, Lmax):
+        """ Y_LM(theta,phi) for all L <= Lmax, column index L*(L+1)+M """
+        L = np.repeat(np.arange(Lmax + 1), 2 * np.arange(Lmax + 1) + 1)
+        M = np.concatenate([ np.arange(-l, l + 1) for l in range(Lmax + 1) ])
+        return sph_harm(M[None,:], L[None,:], phi[:,None] % (2.0 * np.pi), theta[:,None])
+
+
+    def coeffs(self, r):
+        """ expansion coefficients vLM(r) at radii r """
+        r = np.atleast_1d(r)
+        #radii of the outermost shells are known within shell_tol only
+        r = np.where(np.abs(r - self.rmin) <= self.shell_tol, np.maximum(r, self.rmin), r)
+        r = np.where(np.abs(r - self.rmax) <= self.shell_tol, np.minimum(r, self.rmax), r)
+        if self.spline is None:
+            return np.where((r == self.rmin)[:,None], self.vLM0[None,:], np.nan)
+        return self.spline(r)
+
+
+    def eval_sph(self, r, theta, phi):
+        """ V at points on a single shell of radius r, evaluated in one matrix product """
+        theta, phi = np.atleast_1d(theta), np.atleast_1d(phi)
+        return (self.tab_ylm(theta, phi, self.Lmax) @ self.coeffs(r)[0]).real
+
+
+    def __call__(self, x, y, z):
+        x, y, z = np.broadcast_arrays(x, y, z)
+        r       = np.sqrt(x**2 + y**2 + z**2).ravel()
+        theta   = np.arccos(np.clip(z.ravel() / np.where(r > 0.0, r, 1.0), -1.0, 1.0))
+        phi     = np.arctan2(y.ravel(), x.ravel())
+        Y       = self.tab_ylm(theta, phi, self.Lmax)
+        V       = np.sum(Y * self.coeffs(r), axis = 1).real
+        return V.reshape(x.shape)
 
-    return vLM,rgrid
 
 def INTERP_POT(params):
     #interpolate potential on the grid
 
-    fl = open( params['working_dir'] + params['esp_file'] + ".dat", 'r' )
-    esp = []
-
-    for line in fl:
-        words = line.split()
-        x = float(words[0])
-        y = float(words[1])
-        z = float(words[2])
-        v = float(words[3])
-        esp.append([x,y,z,v])
+    esp = np.loadtxt( params['working_dir'] + params['esp_file'] + ".dat", usecols = (0,1,2,3), ndmin = 2 )
         
-    esp =  np.asarray(esp)  #NOTE: Psi4 returns ESP for a positive unit charge, so that the potential of a cation is positive. 
-                            #We want ESP for negaitve unit charge, so we must change sign: attractive interaction.
+    #NOTE: Psi4 returns ESP for a positive unit charge, so that the potential of a cation is positive. 
+    #We want ESP for negaitve unit charge, so we must change sign: attractive interaction.
     esp[:,3] = -1.0 * esp[:,3]
 
     start_time = time.time()
-    esp_interp = interpolate.LinearNDInterpolator( ( esp[:,0], esp[:,1], esp[:,2] ) , esp[:,3])
+    if params['esp_interp_method'] == 'sph':
+        esp_interp = esp_interp_sph( esp[:,:3], esp[:,3], params['esp_interp_lmax'] )
+    elif params['esp_interp_method'] == 'linear':
+        esp_interp = interpolate.LinearNDInterpolator( ( esp[:,0], esp[:,1], esp[:,2] ) , esp[:,3])
+    else:
+        raise ValueError("Incorrect ESP interpolation method")
     end_time = time.time()
     print("Interpolation of " + params['esp_file']  + " potential took " +  str("%10.3f"%(end_time-start_time)) + "s")
     
@@ -245,6 +469,8 @@ def INTERP_POT(params):
     return esp_interp
 
 def calc_interp_sph(interpolant,r,theta,phi):
+    if isinstance(interpolant, esp_interp_sph):
+        return interpolant.eval_sph(r, theta, phi)
     x = r * np.sin(theta) * np.cos(phi)
     y = r * np.sin(theta) * np.sin(phi)
     z = r * np.cos(theta)
@@ -252,13 +478,13 @@ def calc_interp_sph(interpolant,r,theta,phi):
 
 def BUILD_ESP_MAT(Gs,rgrid,esp_interpolant,r_cutoff):
     VG = []
-    Gr = rgrid.flatten()
+    Gr = GRID.r_points(rgrid)
 
     for igs, gs in enumerate(Gs):
         if Gr[igs] <= r_cutoff:
-            VG.append( np.array( [calc_interp_sph( esp_interpolant, Gr[igs], gs[:,0], gs[:,1] )] ) )
+            VG.append( calc_interp_sph( esp_interpolant, Gr[igs], gs[:,0], gs[:,1] ) )
         else:
-            VG.append( np.array( [-1.0 / Gr[igs] * np.ones(np.size(gs[:,0])) ] ) )
+            VG.append( -1.0 / Gr[igs] * np.ones(np.size(gs[:,0])) )
     return VG
 
 def BUILD_ESP_MAT_EXACT(params, Gs, Gr):
@@ -306,7 +532,7 @@ def BUILD_ESP_MAT_EXACT(params, Gs, Gr):
         fl       = open(params['working_dir'] + "esp/" + params['file_esp'], "w")
         np.savetxt(fl, esp_grid, fmt='%10.6f')
 
-    r_array = Gr.flatten()
+    r_array = GRID.r_points(Gr)
 
     VG = []
     counter = 0
@@ -324,7 +550,7 @@ def BUILD_ESP_MAT_EXACT(params, Gs, Gr):
 def BUILD_ESP_MAT_EXACT_ROT(params, Gs, Gr, mol_xyz, irun):
 
 
-    r_array = Gr.flatten()
+    r_array = GRID.r_points(Gr)
 
     VG = []
     counter = 0
@@ -338,92 +564,45 @@ def BUILD_ESP_MAT_EXACT_ROT(params, Gs, Gr, mol_xyz, irun):
 
         lmax_multi = params['multi_lmax']
 
+        # 2. Tabulate Y_LM once per quadrature scheme and evaluate V on all points of a shell with one product
+        ylm_tables = {}
         for k in range(len(r_array)-1):
-            sph = np.zeros(Gs[k].shape[0], dtype=complex)
-            print("No. spherical quadrature points  = " + str(Gs[k].shape[0]) + " at grid point " + str('{:10.3f}'.format(r_array[k])))
-            for s in range(Gs[k].shape[0]):
-
-                #entire potential block 
-                for L in range(0,lmax_multi+1):
-                    for M in range(-L,L+1):
-            
-                        #Gs[k][s,0] = theta
-                        sph[s] += vLM[k,L,L+M] * sph_harm( M, L, Gs[k][s,1]+np.pi, Gs[k][s,0] )
-                counter  += 1
+            if id(Gs[k]) not in ylm_tables:
+                ylm_tables[id(Gs[k])] = tab_ylm_leb(Gs[k], lmax_multi)
+            sph = vLM[k,:lmax_multi+1,:2*lmax_multi+1].reshape(-1) @ ylm_tables[id(Gs[k])]
+            counter += Gs[k].shape[0]
 
             VG.append(sph)
 
+        print("Time for the construction of the model potential on the quadrature grid: " +  str("%10.3f"%(time.time()-start_time)) + "s")
 
         return VG
 
 
-    if os.path.isfile(params['job_directory']  + "esp/" +str(irun) + "/" + params['file_esp']):
-        print (params['file_esp'] + " file exist")
-
-        #os.remove(params['working_dir'] + "esp/" + params['file_esp'])
-
-        if os.path.getsize(params['job_directory'] + "esp/" +str(irun) + "/"  + params['file_esp']) == 0:
-
-            print("But the file is empty.")
-            os.remove(params['job_directory'] + "esp/"+str(irun) + "/"  + params['file_esp'])
-            os.remove(params['job_directory']  + "esp" +str(irun) + "/" +"grid.dat")
-
-            grid_xyz = GRID.GEN_XYZ_GRID(Gs, Gr, params['job_directory']  + "esp/"+str(irun) + "/" )
-            grid_xyz = np.asarray(grid_xyz)
-            V        = GRID.CALC_ESP_PSI4(params['job_directory']  + "esp/"+str(irun) + "/" , params)
-            V        = -1.0 * np.asarray(V)
-            esp_grid = np.hstack((grid_xyz,V[:,None])) 
-            fl       = open(params['job_directory']  + "esp/"+str(irun) + "/"  + params['file_esp'], "w")
-            np.savetxt(fl,esp_grid, fmt='%10.6f')
-
-        else:
-            print("The file is not empty.")
-            flpot1 = open(params['job_directory']  + "esp/" +str(irun) + "/" + params['file_esp'], "r")
-            V = []
-            for line in flpot1:
-                words   = line.split()
-                potval  = float(words[3])
-                V.append(potval)
-            V = np.asarray(V)
-
-    else:
-        print (params['file_esp'] + " file does not exist")
-
-        #os.remove(params['working_dir'] + "esp/grid.dat")
-
-        grid_xyz = GRID.GEN_XYZ_GRID(Gs, Gr, params['job_directory']  + "esp/"+str(irun) + "/" )
-        grid_xyz = np.asarray(grid_xyz)
-        V        = GRID.CALC_ESP_PSI4_ROT(params['job_directory']  + "esp/"+str(irun) + "/" , params, mol_xyz)
-        V        = -1.0 * np.asarray(V)
-
-        esp_grid = np.hstack((grid_xyz,V[:,None])) 
-        fl       = open(params['job_directory']  + "esp/"+str(irun) + "/"  + params['file_esp'] + "_"+str(irun), "w")
-        np.savetxt(fl, esp_grid, fmt='%10.6f')
-
-    r_array = Gr.flatten()
-
-    VG = []
-    counter = 0
-    if params['molec_name'] == "h": # test case of shifted hydrogen
+    if params['molec_name'] == "h": # test case of shifted hydrogen: analytic potential, no psi4 calculation
         r0 = 1.0
         for k in range(len(r_array)-1):
-            sph = np.zeros(Gs[k].shape[0], dtype=float)
-            print("No. spherical quadrature points  = " + str(Gs[k].shape[0]) + " at grid point " + str('{:10.3f}'.format(r_array[k])))
-            for s in range(Gs[k].shape[0]):
-                sph[s] = -1.0 / np.sqrt(r_array[k]**2 + r0**2 - 2.0 * r_array[k] * r0 * np.cos(Gs[k][s,0]))
-                #sph[s] = -1.0 / (r_array[k])
-                counter  += 1
-
+            sph = -1.0 / np.sqrt(r_array[k]**2 + r0**2 - 2.0 * r_array[k] * r0 * np.cos(Gs[k][:,0]))
             VG.append(sph)
 
+        return VG
+
+
+    """ ESP values are kept in a binary store keyed by molecule, SCF settings and grids; one file per orientation """
+    storedir = GRID.esp_store_open(params, Gr, Gs)
+    V        = GRID.esp_store_read(storedir, mol_xyz)
+
+    if V is None or np.any(np.isnan(V)):
+        print("ESP for orientation " + str(irun) + " not found in the store " + storedir)
+        grid_xyz = GRID.GEN_XYZ_GRID(Gs, Gr)
+        wfn      = GRID.CALC_SCF_PSI4_ROT(params, mol_xyz)
+        V        = -1.0 * GRID.CALC_ESP_WFN(wfn, grid_xyz)
+        GRID.esp_store_write(storedir, mol_xyz, V)
     else:
-        for k in range(len(r_array)-1):
-            sph = np.zeros(Gs[k].shape[0], dtype=float)
-            print("No. spherical quadrature points  = " + str(Gs[k].shape[0]) + " at grid point " + str('{:10.3f}'.format(r_array[k])) )
-            for s in range(Gs[k].shape[0]):
-                sph[s] = V[counter]
-                counter  += 1
+        print("ESP for orientation " + str(irun) + " read from the store " + storedir)
 
-            VG.append(sph)
+    #split the flat array of ESP values into spherical shells
+    offsets = np.cumsum([ Gs[k].shape[0] for k in range(len(Gs)) ])
+    VG      = np.split(np.asarray(V, dtype = float), offsets)[:len(r_array)-1]
 
     return VG
\ No newline at end of file
@@ -9,6 +9,7 @@ import numpy as np
 from scipy import sparse
 from scipy.fftpack import fftn
 from scipy.sparse.linalg import expm, expm_multiply, eigsh
+from scipy.sparse.csgraph import connected_components
 from scipy.special import sph_harm
 from scipy.special import eval_legendre
 
@@ -30,14 +31,19 @@ import unittest
 import MAPPING
 import GRID
 import BOUND
+import POTENTIAL
 import CONSTANTS
 import FIELD
 import PLOTS
 import ROTDENS
+import QUEUE
 
 import time
 import os
 import sys
+import hashlib
+import tempfile
+import shutil
 
 import matplotlib.pyplot as plt
 from matplotlib import cm, colors
@@ -86,33 +92,9 @@ def prop_wf( params, ham0, psi0, maparray, Gr, euler, ieuler ):
 
     print("Allocating wavepacket")
 
-    if params['field_type']['function_name'] == "fieldRCPL":
-        helicity = "R"
-    elif params['field_type']['function_name'] == "fieldLCPL":
-        helicity = "L"  
-    elif params['field_type']['function_name'] == "fieldLP":
-        helicity = "0"
-    else:
-        raise ValueError("Incorect field name")
-
-
-    if params['wavepacket_format'] == "dat":
-        flwavepacket      = open(   params['job_directory'] + 
-                                    params['wavepacket_file'] +
-                                    helicity + "_" + str(ieuler) 
-                                    + ".dat", 'w' )
-
-    elif params['wavepacket_format'] == "h5":
-
-        flwavepacket =  h5py.File(  params['job_directory'] +
-                                    params['wavepacket_file'] + 
-                                    helicity + "_" + str(ieuler) + ".h5",
-                                    mode='w')
-
-    else:
-        raise ValueError("incorrect/not implemented format")
+    wavepacketfile  = wavepacket_filename(params, ieuler)
+    prophash        = prop_hash(params, euler)
 
-  
     # Project the bound Hamiltonian onto the propagation Hamiltonian
     Nbas, psi_init  = PROJECT_PSI_GLOBAL(params,maparray,psi0) 
     ham_init        = PROJECT_HAM_GLOBAL(params, maparray, Nbas, Gr, ham0 )
@@ -121,6 +103,20 @@ def prop_wf( params, ham0, psi0, maparray, Gr, euler, ieuler ):
     psi               = psi_init[:]
     psi[:]           /= np.sqrt( np.sum( np.conj(psi) * psi ) )
 
+    """ continue a partially written h5 wavepacket of the same job from its last saved time step """
+    itime0 = 0
+    if params['wavepacket_format'] == "h5" and params['resume'] == True:
+        flwavepacket, itime0, psi_saved = wavepacket_resume(wavepacketfile, prophash, tgrid, wfn_saverate, Nbas)
+        if psi_saved is not None:
+            psi = psi_saved
+    elif params['wavepacket_format'] == "dat":
+        flwavepacket      = open( wavepacketfile, 'w' )
+    elif params['wavepacket_format'] == "h5":
+        flwavepacket =  h5py.File( wavepacketfile, mode='w')
+        flwavepacket.attrs['prop_hash'] = prophash
+    else:
+        raise ValueError("incorrect/not implemented format")
+
 
 
     if params['calc_free_energy'] == True:
@@ -151,8 +147,19 @@ def prop_wf( params, ham0, psi0, maparray, Gr, euler, ieuler ):
     Fvec = np.stack(( Fvec[i] for i in range(len(Fvec)) ), axis=1) 
     #Fvec += np.conjugate(Fvec)
 
+    """ propagate only in the symmetry blocks reachable from the initial state with the field components present """
+    if params['sym_blocks'] == True:
+        active  = [ intmat0[k] for k in range(3) if np.any(np.abs(Fvec[:,k]) > 0.0) ]
+        sel     = reachable_block(maparray, [ham_init] + active, psi, params['sym_block_tol'])
+        print("Propagation in " + str(len(sel)) + " out of " + str(Nbas) + " basis functions")
+        ham_init    = ham_init[sel][:,sel]
+        intmat0     = [ mat[sel][:,sel] for mat in intmat0 ]
+    else:
+        sel     = np.arange(Nbas)
+
     start_time_global = time.time()
-    for itime, t in enumerate(tgrid): 
+    for itime in range(itime0, len(tgrid)): 
+        t = tgrid[itime]
 
         start_time = time.time()
         if itime%10 == 0:
@@ -168,8 +175,8 @@ def prop_wf( params, ham0, psi0, maparray, Gr, euler, ieuler ):
         #dip = sparse.csr_matrix(dip)
         #print("Is the full hamiltonian matrix symmetric? " + str(check_symmetric( ham0 + dip )))
                 
-        psi_out             = expm_multiply( -1.0j * ( ham_init + dip ) * dt, psi ) 
-        wavepacket[itime,:] = psi_out
+        psi_out             = expm_multiply( -1.0j * ( ham_init + dip ) * dt, psi[sel] ) 
+        wavepacket[itime,sel] = psi_out
         psi                 = wavepacket[itime,:]
 
         end_time = time.time()
@@ -190,11 +197,255 @@ def prop_wf( params, ham0, psi0, maparray, Gr, euler, ieuler ):
                                                 dtype       = complex,
                                                 compression = 'gzip' #no-loss compression. Compression with loss is possible and can save space.
                                             )
+                flwavepacket.flush() #complete up to this step if the job dies
                 
     end_time_global = time.time()
     print("The time for the wavefunction propagation is: " + str("%10.3f"%(end_time_global-start_time_global)) + "s")
     flwavepacket.close()
 
+    QUEUE.marker_write( wavepacketfile + ".done", { "prop_hash":    prophash,
+                                                    "nsteps":       len(range(0, len(tgrid), wfn_saverate)),
+                                                    "wavepacket":   QUEUE.file_info(wavepacketfile) } )
+
+
+""" ============ H0 cache ============ """
+""" parameters which determine the field-free Hamiltonian and its eigenpairs """
+HAM0_KEYS = [   'molec_name', 'mol_geometry', 'mol_embedding', 'mol_masses',
+                'FEMLIST', 'bound_nbins', 'bound_nlobs', 'bound_binw', 'bound_lmax', 'bound_rshift', 'map_type',
+                'esp_mode', 'esp_file', 'scf_basis', 'scf_method', 'scf_enr_conv', 'r_cutoff', 'enable_cutoff',
+                'sph_quad_global', 'sph_quad_default', 'sph_quad_tol', 'gen_adaptive_quads', 'use_adaptive_quads',
+                'calc_method', 'multi_lmax', 'multi_method', 'multi_ncube_points', 'multi_box_edge', 'vlm_quad_scheme', 'vlm_conv_tol',
+                'esp_interp_method', 'esp_interp_lmax',
+                'hmat_format', 'hmat_filter', 'sym_blocks', 'sym_block_tol',
+                'num_ini_vec', 'ARPACK_which', 'ARPACK_tol', 'ARPACK_maxiter', 'ARPACK_enr_guess' ]
+
+
+def ham0_input_checksum(params):
+    """ Checksum of input files the Hamiltonian is read from (the ESP file in the 'interpolate' esp_mode, the partial
+        waves of the potential in the 'anton' esp_mode), so that a changed file under the same name leads to a new
+        cache entry. Computed once per file (size, mtime). """
+    if params['esp_mode'] == 'interpolate':
+        files = [ params['working_dir'] + params['esp_file'] + ".dat" ]
+    elif params['esp_mode'] == 'anton':
+        files = [ POTENTIAL.vlm_filename(params, L, M) for L in range(params['multi_lmax'] + 1) for M in range(-L,L+1) ]
+    else:
+        return ""
+
+    checksum = ""
+    for filename in files:
+        if not os.path.isfile(filename):
+            continue
+        stat = os.stat(filename)
+        key  = (filename, stat.st_size, stat.st_mtime)
+        if key not in ham0_input_checksums:
+            ham0_input_checksums[key] = QUEUE.file_checksum(filename)
+        checksum += ham0_input_checksums[key]
+    return checksum
+
+ham0_input_checksums = {}
+
+
+def ham0_cache_dir(params, euler):
+    """ Directory ham0_cache/<hash> in the job directory holding H0 and its eigenpairs for orientation euler.
+        The hash is calculated from all parameters in HAM0_KEYS and the Euler angles, so a change of any of them
+        (basis, ESP, quadratures, filter, eigensolver) leads to a new entry. """
+    h = hashlib.sha1()
+    for key in HAM0_KEYS:
+        h.update((key + "=" + str(params.get(key)) + ";").encode())
+    h.update(ham0_input_checksum(params).encode())
+    h.update(np.round(np.asarray(euler, dtype = float), 12).tobytes())
+    return params['job_directory'] + "ham0_cache/" + h.hexdigest()[:16] + "/"
+
+
+def ham0_cache_read(cachedir, hmat_format):
+    """ Load H0, energies and eigenvectors from the cache as memory-mapped .npy arrays (None if not cached).
+        Pages are shared between processes reading the same entry. """
+    if not os.path.isfile(cachedir + "coeffs.npy"):
+        return None
+
+    enr     = np.load(cachedir + "enr.npy", mmap_mode = 'r')
+    coeffs  = np.load(cachedir + "coeffs.npy", mmap_mode = 'r')
+
+    if hmat_format == 'sparse_csr':
+        shape   = tuple(np.load(cachedir + "shape.npy"))
+        ham0    = sparse.csr_matrix( (  np.load(cachedir + "data.npy", mmap_mode = 'r'), 
+                                        np.load(cachedir + "indices.npy", mmap_mode = 'r'), 
+                                        np.load(cachedir + "indptr.npy", mmap_mode = 'r')), shape = shape, copy = False )
+    else:
+        ham0    = np.load(cachedir + "hmat.npy", mmap_mode = 'r')
+
+    return ham0, enr, coeffs
+
+
+def ham0_cache_write(cachedir, ham0, enr, coeffs):
+    """ Save H0, energies and eigenvectors as raw .npy files. The entry is written to a temporary directory
+        which is renamed when complete, so that concurrent workers never read a partial entry. """
+    os.makedirs(os.path.dirname(cachedir.rstrip("/")), exist_ok = True)
+    tmpdir = tempfile.mkdtemp(dir = os.path.dirname(cachedir.rstrip("/")), prefix = ".tmp_")
+
+    if sparse.issparse(ham0):
+        ham0 = ham0.tocsr()
+        np.save(tmpdir + "/data.npy", ham0.data)
+        np.save(tmpdir + "/indices.npy", ham0.indices)
+        np.save(tmpdir + "/indptr.npy", ham0.indptr)
+        np.save(tmpdir + "/shape.npy", np.array(ham0.shape))
+    else:
+        np.save(tmpdir + "/hmat.npy", np.asarray(ham0))
+
+    np.save(tmpdir + "/enr.npy", np.asarray(enr))
+    np.save(tmpdir + "/coeffs.npy", np.asarray(coeffs))
+
+    try:
+        os.rename(tmpdir, cachedir.rstrip("/"))
+    except OSError:
+        #another worker has written the same entry in the meantime
+        shutil.rmtree(tmpdir, ignore_errors = True)
+
+""" parameters which determine the field-free Hamiltonian up to the size of the angular basis """
+HAM0_NESTED_KEYS = [ key for key in HAM0_KEYS if key not in ['bound_lmax', 'sym_blocks', 'sym_block_tol', 'num_ini_vec', 'ARPACK_which',
+                                                             'ARPACK_tol', 'ARPACK_maxiter', 'ARPACK_enr_guess'] ]
+
+
+def ham0_nested_enabled(params):
+    """ H0 for lmax is the (l <= lmax) sub-block of H0 for any larger lmax on the same radial grid, as long as the ESP
+        matrix elements do not depend on lmax. Adaptive spherical quadratures are chosen per lmax, so the nested
+        store is not used with them. """
+    if params['nested_lmax'] != True:
+        return False
+    if params['esp_mode'] == "exact" and (params['gen_adaptive_quads'] == True or params['use_adaptive_quads'] == True):
+        return False
+    return True
+
+
+def ham0_nested_dir(params, euler):
+    """ Directory ham0_nested/<hash>/ in the sweep directory holding filtered H0 matrices for orientation euler,
+        one sub-directory lmax_<lmax> per size of the angular basis. The hash does not include bound_lmax, so all
+        jobs of an lmax sweep with the same radial grid and ESP settings share the entry. """
+    h = hashlib.sha1()
+    for key in HAM0_NESTED_KEYS:
+        h.update((key + "=" + str(params.get(key)) + ";").encode())
+    h.update(ham0_input_checksum(params).encode())
+    h.update(np.round(np.asarray(euler, dtype = float), 12).tobytes())
+    return params['sweep_directory'] + "ham0_nested/" + h.hexdigest()[:16] + "/"
+
+
+def ham0_nested_read(nesteddir, maparray, lmax, hmat_format):
+    """ Slice the filtered H0 for the basis maparray out of the stored H0 with the smallest lmax_store >= lmax.
+        Returns None if there is no such entry. """
+    if not os.path.isdir(nesteddir):
+        return None
+
+    lmax_stored = sorted( int(name[5:]) for name in os.listdir(nesteddir) if name.startswith("lmax_") )
+    lmax_stored = [ L for L in lmax_stored if L >= lmax ]
+    if not lmax_stored:
+        return None
+
+    entry   = nesteddir + "lmax_" + str(lmax_stored[0]) + "/"
+    start_time = time.time()
+
+    """ rows of the stored basis with the (bin, n, l, m) labels of maparray """
+    labels  = np.load(entry + "labels.npy")
+    rows    = { tuple(elem): i for i, elem in enumerate(labels) }
+    idx     = np.array([ rows[(b, n, l, m)] for b, n, l, m in zip( maparray.field('bin'), maparray.field('n'), 
+                                                                    maparray.field('l'), maparray.field('m') ) ])
+
+    if hmat_format == 'sparse_csr':
+        ham0    = sparse.load_npz(entry + "hmat.npz").tocsr()
+        ham0    = ham0[idx,:][:,idx].tocsr()
+    else:
+        ham0    = np.load(entry + "hmat.npy", mmap_mode = 'r')
+        ham0    = ham0[np.ix_(idx,idx)]
+
+    end_time = time.time()
+    print("Field-free Hamiltonian for lmax = " + str(lmax) + " sliced from the stored lmax = " + str(lmax_stored[0]) + \
+          " Hamiltonian in " + str("%10.3f"%(end_time-start_time)) + "s: " + entry)
+    return ham0
+
+
+def ham0_nested_write(nesteddir, maparray, lmax, ham0):
+    """ Store the filtered H0 with the (bin, n, l, m) labels of its basis. Written to a temporary directory which
+        is renamed when complete, as in ham0_cache_write(). """
+    os.makedirs(nesteddir, exist_ok = True)
+    tmpdir = tempfile.mkdtemp(dir = nesteddir, prefix = ".tmp_")
+
+    labels = np.stack([ maparray.field('bin'), maparray.field('n'), maparray.field('l'), maparray.field('m') ], axis = 1)
+    np.save(tmpdir + "/labels.npy", labels)
+    if sparse.issparse(ham0):
+        sparse.save_npz(tmpdir + "/hmat.npz", ham0.tocsr(), compressed = False)
+    else:
+        np.save(tmpdir + "/hmat.npy", np.asarray(ham0))
+
+    try:
+        os.rename(tmpdir, nesteddir + "lmax_" + str(lmax))
+    except OSError:
+        shutil.rmtree(tmpdir, ignore_errors = True)
+
+
+""" ============ completion markers and restart ============ """
+""" parameters which determine the wavepacket of one orientation """
+PROP_KEYS = HAM0_KEYS + [   'FEMLIST_PROP', 'ivec', 'field_type', 'field_env', 
+                            't0', 'tmax', 'dt', 'time_units', 'wfn_saverate', 'wavepacket_format' ]
+
+
+def prop_hash(params, euler):
+    """ hash of the propagation parameters and the orientation """
+    return QUEUE.params_hash(dict(params, euler = np.round(np.asarray(euler, dtype = float), 12).tolist()), PROP_KEYS + ['euler'])
+
+
+def wavepacket_filename(params, ieuler):
+    """ wavepacket file of orientation ieuler: job_directory/<wavepacket_file><helicity>_<ieuler>.<format> """
+    if params['field_type']['function_name'] == "fieldRCPL":
+        helicity = "R"
+    elif params['field_type']['function_name'] == "fieldLCPL":
+        helicity = "L"  
+    elif params['field_type']['function_name'] == "fieldLP":
+        helicity = "0"
+    else:
+        raise ValueError("Incorect field name")
+
+    return params['job_directory'] + params['wavepacket_file'] + helicity + "_" + str(ieuler) + "." + params['wavepacket_format']
+
+
+def prop_done(params, euler, ieuler):
+    """ True if the wavepacket of orientation ieuler is complete: its marker (written at the end of prop_wf) matches
+        the current parameters, the number of saved steps and the file (size, mtime, checksum). 
+        The wavepacket file is read for its checksum only when all other checks pass. """
+    wavepacketfile  = wavepacket_filename(params, ieuler)
+    marker          = QUEUE.marker_read(wavepacketfile + ".done")
+    if marker is None:
+        return False
+
+    ntimes = int((params['tmax']-params['t0'])/params['dt']+1)
+    return  marker.get('prop_hash') == prop_hash(params, euler) and \
+            marker.get('nsteps') == len(range(0, ntimes, params['wfn_saverate'])) and \
+            QUEUE.file_unchanged(marker.get('wavepacket'), wavepacketfile)
+
+
+def wavepacket_resume(wavepacketfile, prophash, tgrid, wfn_saverate, Nbas):
+    """ Open the h5 wavepacket file for writing. A file written by a run with the same parameters is continued: 
+        returns the index of the first time step to propagate and the last saved wavefunction. Otherwise a new 
+        file is started (itime0 = 0, psi = None). """
+    if os.path.isfile(wavepacketfile):
+        try:
+            flwavepacket = h5py.File( wavepacketfile, mode = 'a')
+        except OSError:
+            print("Warning: unreadable wavepacket file " + wavepacketfile + ", starting from t0")
+        else:
+            if flwavepacket.attrs.get('prop_hash') == prophash:
+                saved = [ itime for itime in range(0, len(tgrid), wfn_saverate) 
+                            if str('{:10.3f}'.format(tgrid[itime])) in flwavepacket ]
+                if saved:
+                    psi = flwavepacket[str('{:10.3f}'.format(tgrid[saved[-1]]))][:]
+                    if psi.shape[0] == Nbas:
+                        print("Resuming propagation from t = " + str('{:10.3f}'.format(tgrid[saved[-1]])) + \
+                              " (step " + str(saved[-1]) + " of " + str(len(tgrid)) + ")")
+                        return flwavepacket, saved[-1] + 1, psi.astype(complex)
+            flwavepacket.close()
+
+    flwavepacket = h5py.File( wavepacketfile, mode = 'w')
+    flwavepacket.attrs['prop_hash'] = prophash
+    return flwavepacket, 0, None
+
 def PROJECT_HAM_GLOBAL(params, maparray, Nbas, Gr, ham0):
 
     ham = sparse.csr_matrix((Nbas, Nbas), dtype=complex) 
@@ -209,21 +460,13 @@ def PROJECT_HAM_GLOBAL(params, maparray, Nbas, Gr, ham0):
     # 1. Build the full KEO in propagation space minus bound space
  
     start_time = time.time()
-    keomat = BOUND.BUILD_KEOMAT_FAST( params, maparray, Nbas , Gr )
+    keomat_copy = BOUND.BUILD_KEOMAT_FAST( params, maparray, Nbas , Gr, triangle = 'full', femlist = params['FEMLIST_PROP'] )
     end_time = time.time()
     print("Time for construction of KEO matrix in full propagation space is " +  str("%10.3f"%(end_time-start_time)) + "s")
 
-    #plt.spy(keomat,precision=1e-8, markersize=2)
+    #plt.spy(keomat_copy,precision=1e-8, markersize=2)
     #plt.show()
 
-    #print("Shape of keomat: " + str(keomat.shape) )
-    #print("Shape of ham: " + str(ham.shape) )
-
-    keomat_copy = keomat.copy()
-    keomat_copy += keomat.getH()
-    for i in range(keomat.shape[0]):
-        keomat_copy[i,i] /=2.0 #-= hmat.diagonal()[i]
-
 
     ham[:Nbas0,:Nbas0]  -= keomat_copy[:Nbas0, :Nbas0]
     #plt.spy(ham,precision=1e-4, markersize=2)
@@ -275,13 +518,150 @@ def TEST_BOUNDARY_HAM(params,ham,Nbas0):
     return np.allclose(enr,enr0,atol=1e-4)
 
 
+def BUILD_HMAT0_FILTERED(params, Gr, maparray, Nbas, grid_euler, irun):
+    """ Field-free Hamiltonian with rotated ESP in unrotated basis: ESP matrix + KEO, hermitized and filtered """
+
+    if params['hmat_format'] == 'numpy_arr':    
+        hmat =  np.zeros((Nbas, Nbas), dtype=float)
+    elif params['hmat_format'] == 'sparse_csr':
+        if params['esp_mode']  == 'anton':
+            hmat = sparse.csr_matrix((Nbas, Nbas), dtype=complex) #complex potential in Demekhin's work
+        else:
+            hmat = sparse.csr_matrix((Nbas, Nbas), dtype=complex) #if
+    else:
+        raise ValueError("Incorrect format type for the Hamiltonian")
+        exit()
+
+    """ calculate POTMAT """
+    if params['esp_mode'] == "exact":
+        """ Use Psi4 to generate values of the ESP at quadrature grid points. 
+            Use jit for fast calculation of the matrix elements """
+        potmat, potind = BOUND.BUILD_POTMAT0_ROT( params, maparray, Nbas, Gr, grid_euler, irun )   
+
+
+    elif params['esp_mode'] == "multipoles":
+        potmat, potind = BOUND.BUILD_POTMAT0_MULTIPOLES_ROT( params, maparray, Nbas , Gr, grid_euler, irun )
+    
+    elif params['esp_mode'] == "anton":
+        potmat, potind = BOUND.BUILD_POTMAT0_ANTON_ROT( params, maparray, Nbas , Gr, grid_euler, irun )
+
+    elif params['esp_mode'] == "exact_vlm":
+        """ Partial waves of the psi4 ESP calculated once in the molecular frame and rotated with Wigner D-matrices """
+        potmat, potind = BOUND.BUILD_POTMAT0_VLM_ROT( params, maparray, Nbas , Gr, grid_euler, irun )
+
+    """ Put the indices and values back together in the Hamiltonian array"""
+    potmat = np.asarray(potmat).ravel()
+    potind = np.asarray(potind, dtype = int).reshape(-1,2)
+
+    if params['hmat_format'] == 'numpy_arr':
+        hmat[ potind[:,0], potind[:,1] ] = potmat
+    elif params['hmat_format'] == 'sparse_csr':
+        hmat = sparse.csr_matrix( (potmat, (potind[:,0], potind[:,1])), shape = (Nbas, Nbas), dtype = complex)
+
+
+    #print("plot of hmat")
+
+    #BOUND.plot_mat(hmat.todense())
+    #plt.spy(hmat,precision=params['sph_quad_tol'], markersize=3, label="HMAT")
+    #plt.legend()
+    #plt.show()
+    #exit()
+
+    """ calculate KEO """
+    start_time = time.time()
+    #print(Gr.ravel())
+    #exit()
+    keomat = BOUND.BUILD_KEOMAT_FAST( params, maparray, Nbas , Gr, femlist = params['FEMLIST'] )
+    end_time = time.time()
+    print("New implementation - time for construction of KEO matrix is " +  str("%10.3f"%(end_time-start_time)) + "s")
+
+    #start_time = time.time()
+    #keomat = BOUND.BUILD_KEOMAT( params, maparray, Nbas , Gr )
+    #end_time = time.time()
+    #print("Old implementation - time for construction of KEO matrix is " +  str("%10.3f"%(end_time-start_time)) + "s")
+    
+    hmat += keomat 
+    #BOUND.plot_mat(hmat.todense())
+    #print("plot of hmat")
+    #BOUND.plot_mat(hmat)
+    #plt.spy(hmat,precision=params['sph_quad_tol'], markersize=3, label="HMAT")
+    #plt.legend()
+    #plt.show()
+    
+    """ --- make the hamiltonian matrix hermitian --- """
+    if params['hmat_format'] == 'numpy_arr':    
+        ham0    = np.copy(hmat)
+        ham0    += np.transpose(hmat.conjugate()) 
+        for i in range(ham0.shape[0]):
+            ham0[i,i] -= hmat.diagonal()[i]
+        print("Is the field-free hamiltonian matrix symmetric? " + str(check_symmetric(ham0)))
+
+    elif params['hmat_format'] == 'sparse_csr':
+        #hmat = sparse.csr_matrix(hmat)
+        hmat_csr_size = hmat.data.size/(1024**2)
+        print('Size of the sparse Hamiltonian csr_matrix: '+ '%3.2f' %hmat_csr_size + ' MB')
+        ham0 = hmat + hmat.getH()
+        ham0 = (ham0 - sparse.diags(0.5 * ham0.diagonal())).tocsr()
+    else:
+        raise ValueError("Incorrect format type for the Hamiltonian")
+        exit()
+
+    """ --- filter hamiltonian matrix  --- """
+
+    if params['hmat_format'] == 'numpy_arr':    
+        ham_filtered = np.where( np.abs(ham0) < params['hmat_filter'], 0.0, ham0)
+        #ham_filtered = sparse.csr_matrix(ham_filtered)
+
+    elif params['hmat_format'] == 'sparse_csr':
+        nonzero_mask        = np.array(np.abs(ham0[ham0.nonzero()]) < params['hmat_filter'])[0]
+        rows                = ham0.nonzero()[0][nonzero_mask]
+        cols                = ham0.nonzero()[1][nonzero_mask]
+        ham0[rows, cols]    = 0
+        ham_filtered        = ham0.copy()
+
+
+    #plt.spy(ham0, precision=params['sph_quad_tol'], markersize=3, label="HMAT")
+    #plt.legend()
+    #plt.show()
+    #exit()
+    #print("Maximum real part of the hamiltonian matrix = " + str(np.max(ham_filtered.real)))
+    #print("Maximum imaginary part of the hamiltonian matrix = " + str(np.max(ham_filtered.imag)))
+    #exit()
+
+    return ham_filtered
+
+
+def save_psi0_enr0(params, maparray, enr, coeffs, irun):
+    """ Save the initial wavefunctions and their energies (params['save_psi0'], params['save_enr0']) """
+    if params['save_psi0'] == True:
+        psifile = open(params['job_directory']  + params['file_psi0']+ "_"+str(irun), 'w')
+        for ielem,elem in enumerate(maparray):
+            psifile.write( " %5d"%elem[0] +  " %5d"%elem[1] + "  %5d"%elem[2] + \
+                            " %5d"%elem[3] +  " %5d"%elem[4] + "\t" + \
+                            "\t\t ".join('{:10.5e}'.format(coeffs[ielem,v]) for v in range(0,params['num_ini_vec'])) + "\n")
+        psifile.close()
+
+    if params['save_enr0'] == True:
+        with open(params['job_directory'] + params['file_enr0']+ "_"+str(irun), "w") as energyfile:   
+            np.savetxt( energyfile, enr * CONSTANTS.au_to_ev , fmt='%10.5f' )
+
+
 def BUILD_HMAT0_ROT(params, Gr, maparray, Nbas, grid_euler, irun):
     """ Build the stationary hamiltonian with rotated ESP in unrotated basis, store the hamiltonian in a file """
 
+    """ a Hamiltonian read from file (read_ham_init_file) is not taken from the cache """
+    if params['ham0_cache'] == True and params['read_ham_init_file'] == False:
+        cachedir    = ham0_cache_dir(params, grid_euler[irun])
+        cached      = ham0_cache_read(cachedir, params['hmat_format'])
+        if cached is not None:
+            print("Field-free Hamiltonian and eigenpairs read from cache: " + cachedir)
+            save_psi0_enr0(params, maparray, cached[1], cached[2], irun)
+            return cached[0], cached[2]
+
     if params['read_ham_init_file'] == True:
 
         if params['hmat_format']   == "numpy_arr":
-            if os.path.isfile(params['job_directory'] + params['file_hmat0'] + "_" + str(irun) + ".dat"  ):
+            if os.path.isfile(params['job_directory'] + params['file_hmat0'] + "_" + str(irun) + ".npy"  ):
         
                 print (params['file_hmat0'] + " file exist")
                 hmat = read_ham_init_rot(params,irun)
@@ -312,7 +692,10 @@ def BUILD_HMAT0_ROT(params, Gr, maparray, Nbas, grid_euler, irun):
 
                 """ diagonalize hmat """
                 start_time = time.time()
-                enr, coeffs = call_eigensolver(ham0, params)
+                if params['sym_blocks'] == True:
+                    enr, coeffs = call_eigensolver_blocks(ham0, params, gen_sym_blocks(maparray, [ham0], params['sym_block_tol']))
+                else:
+                    enr, coeffs = call_eigensolver(ham0, params)
                 end_time = time.time()
                 print("Time for diagonalization of field-free Hamiltonian: " +  str("%10.3f"%(end_time-start_time)) + "s")
 
@@ -322,113 +705,21 @@ def BUILD_HMAT0_ROT(params, Gr, maparray, Nbas, grid_euler, irun):
                 exit()
     else:
 
-        if params['hmat_format'] == 'numpy_arr':    
-            hmat =  np.zeros((Nbas, Nbas), dtype=float)
-        elif params['hmat_format'] == 'sparse_csr':
-            if params['esp_mode']  == 'anton':
-                hmat = sparse.csr_matrix((Nbas, Nbas), dtype=complex) #complex potential in Demekhin's work
-            else:
-                hmat = sparse.csr_matrix((Nbas, Nbas), dtype=complex) #if
-        else:
-            raise ValueError("Incorrect format type for the Hamiltonian")
-            exit()
-
-        """ calculate POTMAT """
-        if params['esp_mode'] == "exact":
-            """ Use Psi4 to generate values of the ESP at quadrature grid points. 
-                Use jit for fast calculation of the matrix elements """
-            potmat, potind = BOUND.BUILD_POTMAT0_ROT( params, maparray, Nbas, Gr, grid_euler, irun )   
-
-
-        elif params['esp_mode'] == "multipoles":
-            potmat, potind = BOUND.BUILD_POTMAT0_MULTIPOLES_ROT( params, maparray, Nbas , Gr, grid_euler, irun )
-        
-        elif params['esp_mode'] == "anton":
-            potmat, potind = BOUND.BUILD_POTMAT0_ANTON_ROT( params, maparray, Nbas , Gr, grid_euler, irun )
-
-        """ Put the indices and values back together in the Hamiltonian array"""
-        for ielem, elem in enumerate(potmat):
-            #print(elem[0])
-            hmat[ potind[ielem][0], potind[ielem][1] ] = elem[0]
-
-
-        #print("plot of hmat")
-
-        #BOUND.plot_mat(hmat.todense())
-        #plt.spy(hmat,precision=params['sph_quad_tol'], markersize=3, label="HMAT")
-        #plt.legend()
-        #plt.show()
-        #exit()
-
-        """ calculate KEO """
-        start_time = time.time()
-        #print(Gr.ravel())
-        #exit()
-        keomat = BOUND.BUILD_KEOMAT_FAST( params, maparray, Nbas , Gr )
-        end_time = time.time()
-        print("New implementation - time for construction of KEO matrix is " +  str("%10.3f"%(end_time-start_time)) + "s")
-
-        #start_time = time.time()
-        #keomat = BOUND.BUILD_KEOMAT( params, maparray, Nbas , Gr )
-        #end_time = time.time()
-        #print("Old implementation - time for construction of KEO matrix is " +  str("%10.3f"%(end_time-start_time)) + "s")
-        
-        hmat += keomat 
-        #BOUND.plot_mat(hmat.todense())
-        #print("plot of hmat")
-        #BOUND.plot_mat(hmat)
-        #plt.spy(hmat,precision=params['sph_quad_tol'], markersize=3, label="HMAT")
-        #plt.legend()
-        #plt.show()
-        
-        """ --- make the hamiltonian matrix hermitian --- """
-        if params['hmat_format'] == 'numpy_arr':    
-            ham0    = np.copy(hmat)
-            ham0    += np.transpose(hmat.conjugate()) 
-            for i in range(ham0.shape[0]):
-                ham0[i,i] -= hmat.diagonal()[i]
-            print("Is the field-free hamiltonian matrix symmetric? " + str(check_symmetric(ham0)))
+        ham_filtered = None
+        if ham0_nested_enabled(params):
+            nesteddir       = ham0_nested_dir(params, grid_euler[irun])
+            ham_filtered    = ham0_nested_read(nesteddir, maparray, params['bound_lmax'], params['hmat_format'])
 
-        elif params['hmat_format'] == 'sparse_csr':
-            #hmat = sparse.csr_matrix(hmat)
-            hmat_csr_size = hmat.data.size/(1024**2)
-            print('Size of the sparse Hamiltonian csr_matrix: '+ '%3.2f' %hmat_csr_size + ' MB')
-            ham0 = hmat.copy()
-            ham0 += hmat.getH()
-            for i in range(ham0.shape[0]):
-                ham0[i,i] /=2.0#-= hmat.diagonal()[i]
-        else:
-            raise ValueError("Incorrect format type for the Hamiltonian")
-            exit()
-
-        """ --- filter hamiltonian matrix  --- """
-
-        if params['hmat_format'] == 'numpy_arr':    
-            ham_filtered = np.where( np.abs(ham0) < params['hmat_filter'], 0.0, ham0)
-            #ham_filtered = sparse.csr_matrix(ham_filtered)
-
-        elif params['hmat_format'] == 'sparse_csr':
-            nonzero_mask        = np.array(np.abs(ham0[ham0.nonzero()]) < params['hmat_filter'])[0]
-            rows                = ham0.nonzero()[0][nonzero_mask]
-            cols                = ham0.nonzero()[1][nonzero_mask]
-            ham0[rows, cols]    = 0
-            ham_filtered        = ham0.copy()
-
-
-        #plt.spy(ham0, precision=params['sph_quad_tol'], markersize=3, label="HMAT")
-        #plt.legend()
-        #plt.show()
-        #exit()
-        #print("Maximum real part of the hamiltonian matrix = " + str(np.max(ham_filtered.real)))
-        #print("Maximum imaginary part of the hamiltonian matrix = " + str(np.max(ham_filtered.imag)))
-        #exit()
+        if ham_filtered is None:
+            ham_filtered = BUILD_HMAT0_FILTERED(params, Gr, maparray, Nbas, grid_euler, irun)
+            if ham0_nested_enabled(params):
+                ham0_nested_write(nesteddir, maparray, params['bound_lmax'], ham_filtered)
 
         if params['save_ham0'] == True:
             if params['hmat_format'] == 'sparse_csr':
                 sparse.save_npz( params['job_directory']  + params['file_hmat0'] + "_" + str(irun) , ham_filtered , compressed = False )
             elif params['hmat_format'] == 'numpy_arr':
-                with open( params['job_directory'] + params['file_hmat0']+ "_" + str(irun) , 'w') as hmatfile:   
-                    np.savetxt(hmatfile, ham_filtered, fmt = '%10.4e')
+                np.save( params['job_directory'] + params['file_hmat0'] + "_" + str(irun) + ".npy", ham_filtered )
             print("Hamiltonian matrix saved.")
 
         """ diagonalize hmat """
@@ -438,7 +729,11 @@ def BUILD_HMAT0_ROT(params, Gr, maparray, Nbas, grid_euler, irun):
             end_time = time.time()
         elif params['hmat_format'] == 'sparse_csr':
             start_time = time.time()
-            enr, coeffs = call_eigensolver(ham_filtered, params)
+            if params['sym_blocks'] == True:
+                blocks = gen_sym_blocks(maparray, [ham_filtered], params['sym_block_tol'])
+                enr, coeffs = call_eigensolver_blocks(ham_filtered, params, blocks)
+            else:
+                enr, coeffs = call_eigensolver(ham_filtered, params)
             end_time = time.time()
 
    
@@ -450,30 +745,25 @@ def BUILD_HMAT0_ROT(params, Gr, maparray, Nbas, grid_euler, irun):
             print(str(v) + " " + str(np.sqrt( np.sum( np.conj(coeffs[:,v] ) * coeffs[:,v] ) )))
 
 
-        if params['save_psi0'] == True:
-            psifile = open(params['job_directory']  + params['file_psi0']+ "_"+str(irun), 'w')
-            for ielem,elem in enumerate(maparray):
-                psifile.write( " %5d"%elem[0] +  " %5d"%elem[1] + "  %5d"%elem[2] + \
-                                " %5d"%elem[3] +  " %5d"%elem[4] + "\t" + \
-                                "\t\t ".join('{:10.5e}'.format(coeffs[ielem,v]) for v in range(0,params['num_ini_vec'])) + "\n")
-
-        if params['save_enr0'] == True:
-            with open(params['job_directory'] + params['file_enr0']+ "_"+str(irun), "w") as energyfile:   
-                np.savetxt( energyfile, enr * CONSTANTS.au_to_ev , fmt='%10.5f' )
+        save_psi0_enr0(params, maparray, enr, coeffs, irun)
     
 
         """ Plot initial orbitals """
         if params['plot_ini_orb'] == True:
             PLOTS.plot_initial_orbitals(params,maparray,coeffs)
 
+        if params['ham0_cache'] == True:
+            ham0_cache_write(cachedir, ham_filtered, enr, coeffs)
 
         return ham_filtered, coeffs
 
+
 def call_eigensolver(A,params):
     if params['ARPACK_enr_guess'] == None:
         print("No eigenvalue guess defined")
+        sigma = None
     else:
-        params['ARPACK_enr_guess'] /= CONSTANTS.au_to_ev
+        sigma = params['ARPACK_enr_guess'] / CONSTANTS.au_to_ev #params are not modified, so that repeated calls agree
 
 
     if params['ARPACK_which'] == 'LA':
@@ -487,7 +777,7 @@ def call_eigensolver(A,params):
 
         enr, coeffs = eigsh(    -1.0 * A, k = params['num_ini_vec'], 
                                 which=params['ARPACK_which'] , 
-                                sigma=params['ARPACK_enr_guess'],
+                                sigma=sigma,
                                 return_eigenvectors=True, 
                                 mode='normal', 
                                 tol = params['ARPACK_tol'],
@@ -505,7 +795,7 @@ def call_eigensolver(A,params):
     else:
         enr, coeffs = eigsh(    A, k = params['num_ini_vec'], 
                                 which=params['ARPACK_which'] , 
-                                sigma=params['ARPACK_enr_guess'],
+                                sigma=sigma,
                                 return_eigenvectors=True, 
                                 mode='normal', 
                                 tol = params['ARPACK_tol'],
@@ -517,6 +807,89 @@ def call_eigensolver(A,params):
 
     return enr, coeffs
 
+def gen_sym_blocks(maparray, mats, tol):
+    """ Decompose the basis into blocks of angular functions (l,m) which are not coupled by any of the matrices mats.
+
+        Two (l,m) are connected if any matrix element between basis functions carrying them exceeds tol in magnitude.
+        tol (params['sym_block_tol']) should be well below hmat_filter: couplings under tol are dropped from the
+        block-wise diagonalization and propagation. Blocks are the connected components of this graph, so that 
+        conserved quantities are detected without assumptions about the potential: m for axial potentials (linear
+        molecules along z), l-parity for inversion-symmetric potentials, m mod n for a C_n axis along z.
+
+        Only symmetries that are diagonal in the complex (l,m) basis are found. Point-group irreps that mix m 
+        (e.g. C2v with the C2 axis off z) are not separated: this would need symmetry-adapted angular functions 
+        (projection onto the irreps), which are not implemented.
+
+        Returns:
+            blocks: list of arrays of basis function indices (rows of maparray), one array per block
+    """
+    l       = maparray.field('l').astype(np.int64)
+    m       = maparray.field('m').astype(np.int64)
+    lm      = l * (l + 1) + m
+    nlm     = int(lm.max()) + 1
+
+    graph   = sparse.identity(nlm, format = 'csr')
+    for mat in mats:
+        mat     = sparse.coo_matrix(mat)
+        mask    = np.abs(mat.data) > tol
+        graph   = graph + sparse.csr_matrix( (np.ones(np.count_nonzero(mask)), (lm[mat.row[mask]], lm[mat.col[mask]])), shape = (nlm, nlm) )
+
+    nblocks, label_lm   = connected_components(graph, directed = False)
+    label               = label_lm[lm]
+
+    blocks = [ np.flatnonzero(label == k) for k in np.unique(label) ]
+
+    """ report the conserved quantities """
+    print("Number of symmetry blocks: " + str(len(blocks)) + ", block sizes: " + str([ len(b) for b in blocks ]))
+    if len(blocks) > 1:
+        if all( np.unique(m[b]).size == 1 for b in blocks ):
+            print("m is conserved")
+        if all( np.unique(l[b] % 2).size == 1 for b in blocks ):
+            print("parity is conserved")
+
+    return blocks
+
+
+def reachable_block(maparray, mats, psi, tol):
+    """ Indices of basis functions in all symmetry blocks of mats (see gen_sym_blocks) which overlap with psi """
+    blocks  = gen_sym_blocks(maparray, mats, tol)
+    active  = [ b for b in blocks if np.any(np.abs(psi[b]) > 0.0) ]
+    return np.sort(np.concatenate(active))
+
+
+def call_eigensolver_blocks(A, params, blocks):
+    """ Diagonalize A block-by-block and return the num_ini_vec eigenpairs selected as in call_eigensolver() from
+        all blocks, sorted by energy. Eigenvectors are given in the full basis. """
+    nvec = params['num_ini_vec']
+    enr_list    = []
+    coeffs_list = []
+
+    for b in blocks:
+        Ab = A[b][:,b]
+
+        if len(b) <= nvec + 1:
+            #ARPACK needs k < N: small blocks are diagonalized directly
+            enr_b, coeffs_b = np.linalg.eigh(Ab.toarray() if sparse.issparse(Ab) else Ab)
+        else:
+            enr_b, coeffs_b = call_eigensolver(Ab, params)
+
+        coeffs_full = np.zeros((A.shape[0], len(enr_b)), dtype = complex)
+        coeffs_full[b,:] = coeffs_b
+        enr_list.append(enr_b)
+        coeffs_list.append(coeffs_full)
+
+    enr     = np.concatenate(enr_list)
+    coeffs  = np.concatenate(coeffs_list, axis = 1)
+
+    if params['ARPACK_enr_guess'] == None:
+        isel = np.argsort(enr)[:nvec]
+    else:
+        isel = np.argsort(np.abs(enr - params['ARPACK_enr_guess'] / CONSTANTS.au_to_ev))[:nvec]
+    isel = isel[np.argsort(enr[isel])]
+
+    return enr[isel], coeffs[:,isel]
+
+
 def read_coeffs(filename,nvecs):
 
     coeffs = []
@@ -573,8 +946,7 @@ def read_ham_init_rot(params,irun):
     if params['hmat_format'] == 'sparse_csr':
         hmat = sparse.load_npz( params['job_directory'] + params['file_hmat0']+ "_" + str(irun) + ".npz" )
     elif params['hmat_format'] == 'numpy_arr':
-        with open( params['job_directory'] + params['file_hmat0'] + "_"+str(irun) + ".dat", 'r') as hmatfile:   
-            hmat = np.loadtxt(hmatfile)
+        hmat = np.load( params['job_directory'] + params['file_hmat0'] + "_" + str(irun) + ".npy", mmap_mode = 'r' )
     return hmat
 
 
@@ -583,40 +955,40 @@ def calc_intmat(maparray,rgrid,Nbas):
     #field: (E_-1, E_0, E_1) in spherical tensor form
     """calculate the <Y_l'm'(theta,phi)| d(theta,phi) | Y_lm(theta,phi)> integral """
 
-    if params['hmat_format'] == 'numpy_arr':    
-        intmat =   np.zeros(( Nbas , Nbas ), dtype = complex)
-    elif params['hmat_format'] == 'sparse_csr':
-        intmat1 = sparse.csr_matrix(( Nbas, Nbas ), dtype = complex)
-        intmat2 = sparse.csr_matrix(( Nbas, Nbas ), dtype = complex)
-        intmat3 = sparse.csr_matrix(( Nbas, Nbas ), dtype = complex)
-
-    D = np.zeros(3)
+    if not isinstance(maparray, MAPPING.basismap):
+        maparray = MAPPING.basismap(np.asarray(maparray)[:Nbas], params['map_type'])
 
     """precompute all necessary 3-j symbols"""
     #generate arrays of 3j symbols with 'spherical':
     tjmat = gen_3j_dip(params['bound_lmax'])
-  
 
-    for i in range(Nbas):
-        rin = rgrid[ maparray[i][0], maparray[i][1] -1 ]
-        for j in range(Nbas):
+    """ only functions sharing the radial point xi couple: all pairs (i,j) within each xi-block of the map """
+    rows    = np.arange(Nbas)
+    ilist   = []
+    jlist   = []
+    for xi in range(maparray.xi_max + 1):
+        block   = rows[maparray.xi_block(xi)]
+        ii, jj  = np.meshgrid(block, block, indexing = 'ij')
+        ilist.append(ii.ravel())
+        jlist.append(jj.ravel())
+    i = np.concatenate(ilist)
+    j = np.concatenate(jlist)
+
+    l   = maparray.field('l')
+    m   = maparray.field('m')
+    rin = rgrid[ maparray.field('bin')[i], maparray.field('n')[i] - 1 ]
 
-            if  maparray[i][2] == maparray[j][2]:
-                #D[0] = N( gaunt( maparray[i][3], 1, maparray[j][3], maparray[i][4], -1, maparray[j][4] ) )
-                #D[1] = N( gaunt( maparray[i][3], 1, maparray[j][3], maparray[i][4], 0, maparray[j][4] ) ) * np.sqrt(2.)
-                #D[2] = N( gaunt( maparray[i][3], 1, maparray[j][3], maparray[i][4], 1, maparray[j][4] ) ) 
+    #D[0] = N( gaunt( l_i, 1, l_j, m_i, -1, m_j ) ), D[1] = N( gaunt( l_i, 1, l_j, m_i, 0, m_j ) ) * np.sqrt(2.), D[2] = N( gaunt( l_i, 1, l_j, m_i, 1, m_j ) )
+    D   = tjmat[ l[i], l[j], m[i] + l[i], : ] #-1, 0 , +1
+    fac = np.sqrt( 2.0 * np.pi / 3.0 ) * rin
 
-                #intmat1[i,j] = np.sqrt( 2.0 * np.pi / 3.0 ) * D[0] * rin 
-                #intmat2[i,j] = np.sqrt( 2.0 * np.pi / 3.0 ) * D[1] * rin 
-                #intmat3[i,j] = np.sqrt( 2.0 * np.pi / 3.0 ) * D[2] * rin 
+    sel2 = m[j] == m[i]
+    sel1 = m[j] == 1 - m[i]
+    sel3 = m[j] == -1 - m[i]
 
-                D[:] = tjmat[ maparray[i][3], maparray[j][3], maparray[i][4]+maparray[i][3], : ] #-1, 0 , +1
-                if maparray[j][4] == maparray[i][4]:
-                    intmat2[i,j] = np.sqrt( 2.0 * np.pi / 3.0 ) * D[1] * rin * np.sqrt(2.)
-                elif maparray[j][4] ==1- maparray[i][4]:
-                    intmat1[i,j] = np.sqrt( 2.0 * np.pi / 3.0 ) * D[0] * rin 
-                elif maparray[j][4] ==-1- maparray[i][4]:
-                    intmat3[i,j] = np.sqrt( 2.0 * np.pi / 3.0 ) * D[2] * rin 
+    intmat1 = sparse.csr_matrix( (fac[sel1] * D[sel1,0], (i[sel1], j[sel1])), shape = (Nbas, Nbas), dtype = complex )
+    intmat2 = sparse.csr_matrix( (fac[sel2] * D[sel2,1] * np.sqrt(2.), (i[sel2], j[sel2])), shape = (Nbas, Nbas), dtype = complex )
+    intmat3 = sparse.csr_matrix( (fac[sel3] * D[sel3,2], (i[sel3], j[sel3])), shape = (Nbas, Nbas), dtype = complex )
 
 
     #plt.spy(intmat_new1, precision=params['sph_quad_tol'], markersize=5)
@@ -757,11 +1129,20 @@ def read_euler_grid():
         grid_euler = np.loadtxt(eulerfile)
     return grid_euler
 
+def save_euler_rep(rep_euler):
+    """ grid_euler_rep.dat: index of the symmetry-equivalent representative of each orientation """
+    tmpfile = "grid_euler_rep.dat." + str(os.getpid()) + ".tmp"
+    with open( tmpfile , 'w') as repfile:   
+        np.savetxt(repfile, rep_euler, fmt = '%d')
+    os.replace(tmpfile, "grid_euler_rep.dat")
+
 def save_map(map,file):
+    """ save basis map as formatted text (file) and in binary format (structured .npy array next to it, see MAPPING.basismap.load) """
     fl = open(file,'w')
     for elem in map:   
         fl.write(" ".join('{:5d}'.format(elem[i]) for i in range(0,6)) + "\n")
     fl.close()
+    map.save(os.path.splitext(file)[0] + '.npy')
 
 
 if __name__ == "__main__":   
@@ -804,14 +1185,10 @@ if __name__ == "__main__":
     save_map(maparray0,params['job_directory'] + 'map0.dat')
     save_map(maparray,params['job_directory'] + 'map_global.dat')
 
-    Gr0, Nr0                       = GRID.r_grid(             params['bound_nlobs'], 
-                                                            params['bound_nbins'] , 
-                                                            params['bound_binw'],  
+    Gr0, Nr0                       = GRID.r_grid_femlist(     params['FEMLIST'], 
                                                             params['bound_rshift'] )
 
-    Gr, Nr                       = GRID.r_grid(             params['bound_nlobs'], 
-                                                            params['prop_nbins'] , 
-                                                            params['bound_binw'],  
+    Gr, Nr                       = GRID.r_grid_femlist(     params['FEMLIST_PROP'], 
                                                             params['bound_rshift'] )
 
     """ Read grid of Euler angles"""
@@ -821,14 +1198,44 @@ if __name__ == "__main__":
 
     N_Euler = grid_euler.shape[0]
 
-    N_per_batch = int(N_Euler/params['N_batches'])
-
     maparray_chi, Nbas_chi = MAPPING.GENMAP_FEMLIST( params['FEMLIST'],  0, \
                                 params['map_type'], path )
 
     save_map(maparray_chi,params['job_directory'] + 'map_chi.dat')
 
-    for irun in range(ibatch * N_per_batch, (ibatch+1) * N_per_batch):
+    """ Orientations equivalent by molecular symmetry: only the representative of each class is propagated.
+        The map is saved for ANALYZE, which uses the results of the representative for all orientations of its class. """
+    if params['orient_symmetry'] == True:
+        rep_euler = BOUND.gen_euler_equivalence(params, grid_euler)
+    else:
+        rep_euler = np.arange(N_Euler)
+    save_euler_rep(rep_euler)
+    unique_euler = np.flatnonzero(rep_euler == np.arange(N_Euler))
+
+    """ Orientations of this batch: claimed one at a time from the shared queue, or a fixed chunk of the unique orientations.
+        The queue is keyed on the grid (and its symmetry map) as well, since orientations are queued by index. """
+    static_iruns = [ unique_euler[k] for k in QUEUE.static_batch(len(unique_euler), params['N_batches'], ibatch) ]
+    if params['orient_queue'] == True:
+        iruns = QUEUE.orientation_queue(params, "propagate_" + QUEUE.params_hash(params, PROP_KEYS)[:8] + "_" + \
+                                        QUEUE.array_hash(grid_euler, rep_euler)[:8], N_Euler, ibatch)
+    else:
+        iruns = static_iruns
+
+    """ Evaluate ESPs of all orientations in this batch in parallel worker processes.
+        With the queue the orientations are not known in advance: the static chunk of the batch is precomputed. """
+    if params['esp_mode'] == "exact" and params['esp_nprocs'] > 1:
+        BOUND.precompute_esp_rot(params, Gr0, grid_euler, static_iruns)
+
+    for irun in iruns:
+
+        if rep_euler[irun] != irun:
+            print("Orientation " + str(irun) + " is equivalent to " + str(rep_euler[irun]) + " by symmetry, skipping")
+            continue
+
+        """ outputs of this orientation are complete: nothing to do """
+        if params['resume'] == True and prop_done(params, grid_euler[irun], irun):
+            print("Orientation " + str(irun) + " already propagated, skipping")
+            continue
 
         #print(grid_euler[irun])
         """ Generate Initial Hamiltonian with rotated electrostatic potential in unrotated basis """
@@ -837,5 +1244,5 @@ if __name__ == "__main__":
         prop_wf(params, ham0, psi0, maparray, Gr, grid_euler[irun], irun)
 
 
-end_time_total = time.time()
-print("Global time =  " + str("%10.3f"%(end_time_total-start_time_total)) + "s")
+    end_time_total = time.time()
+    print("Global time =  " + str("%10.3f"%(end_time_total-start_time_total)) + "s")
@@ -0,0 +1,304 @@
+import numpy as np
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+
+def static_batch(N_Euler, N_batches, ibatch):
+    """ Orientations assigned to batch ibatch when the grid is split into N_batches contiguous chunks.
+        Chunk sizes differ by at most one, so that all N_Euler orientations are covered. """
+    bounds = np.linspace(0, N_Euler, N_batches + 1).round().astype(int)
+    return range(bounds[ibatch], bounds[ibatch + 1])
+
+
+class orientation_queue:
+    """ Work queue over the Euler grid shared by all batches of a job through the file system.
+
+        Workers claim orientations one at a time by atomically creating the file <irun>.claim in the queue directory
+        (os.open with O_CREAT | O_EXCL: exactly one worker succeeds). While an orientation is being processed,
+        a background thread touches its claim file every params['queue_heartbeat'] seconds. A claim whose file has
+        not been touched for params['queue_stale_time'] seconds belongs to a dead worker: it is moved aside with
+        os.rename (again exactly one worker succeeds) and the orientation is claimed anew. A finished orientation
+        gets a <irun>.done marker and is never claimed again.
+
+        Each claim file holds a token unique to the claim. A worker touches or removes a claim file only after
+        checking that it holds its own token, and a stale claim moved aside is checked to be the file (inode and
+        token) that was found stale; otherwise it is put back. A worker wrongly taken as dead therefore never
+        touches or removes the claim of the worker that took over its orientation.
+
+        The scan over the grid starts at the first orientation of the static chunk of batch ibatch, so that workers
+        spread over the grid instead of competing for the same orientations.
+
+        The queue belongs to one launch of the job (params['queue_launch'], set by run_job.run_array_job): the done
+        markers record only what the batches of this launch have processed. Outputs of earlier launches are reused
+        only through the completion markers checked by the worker (params['resume']), so that a rerun or a deleted
+        or corrupted output file is never skipped because of an old done marker.
+
+        Usage:
+            queue = orientation_queue(params, "propagate", N_Euler, ibatch)
+            for irun in queue:
+                ...  # process orientation irun; it is marked done when the next one is requested
+    """
+
+    def __init__(self, params, name, N_Euler, ibatch):
+        if params.get('queue_launch'):
+            name += "_" + str(params['queue_launch'])
+        self.dir        = os.path.join(params['job_directory'], "queue_" + name)
+        self.N_Euler    = N_Euler
+        self.start      = static_batch(N_Euler, params['N_batches'], ibatch).start
+        self.heartbeat  = params['queue_heartbeat']
+        self.stale_time = params['queue_stale_time']
+        self.worker     = socket.gethostname() + ":" + str(os.getpid()) + ":" + str(ibatch)
+        os.makedirs(self.dir, exist_ok = True)
+
+        self.irun       = None
+        self.token      = None
+        self.nclaimed   = 0
+        self._stop      = threading.Event()
+        self._thread    = None
+
+    def claim_file(self, irun):
+        return os.path.join(self.dir, str(irun) + ".claim")
+
+    def done_file(self, irun):
+        return os.path.join(self.dir, str(irun) + ".done")
+
+    def is_done(self, irun):
+        return os.path.isfile(self.done_file(irun))
+
+    @staticmethod
+    def read_token(filename):
+        """ Token held by a claim file, None if the file is absent """
+        try:
+            with open(filename, 'r') as claimfile:
+                return claimfile.read().strip()
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def put_back(movedfile, filename):
+        """ Return a claim file moved aside by mistake to its place, unless a new claim was made there meanwhile """
+        try:
+            os.link(movedfile, filename)
+        except FileExistsError:
+            pass
+        os.remove(movedfile)
+
+    def take_aside(self, filename, stat, token):
+        """ Move the claim file aside if it is still the file with the given stat and token.
+            Returns the name of the moved file, None if the claim is gone or was replaced in the meantime. """
+        movedfile = filename + ".stale." + self.worker + "." + uuid.uuid4().hex
+        try:
+            os.rename(filename, movedfile)
+        except FileNotFoundError:
+            return None
+        try:
+            moved = os.stat(movedfile)
+        except FileNotFoundError:
+            return None
+        if moved.st_ino != stat.st_ino or moved.st_dev != stat.st_dev or self.read_token(movedfile) != token:
+            self.put_back(movedfile, filename)
+            return None
+        return movedfile
+
+    def try_claim(self, irun):
+        """ Claim orientation irun. Returns True on success. """
+        if self.is_done(irun):
+            return False
+
+        filename = self.claim_file(irun)
+        try:
+            fd = os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                stat = os.stat(filename)
+            except FileNotFoundError:
+                return False    # released in the meantime; picked up on the next pass
+            age = time.time() - stat.st_mtime
+            if age < self.stale_time:
+                return False
+            token = self.read_token(filename)
+            stalefile = self.take_aside(filename, stat, token)
+            if stalefile is None:
+                return False    # another worker reclaimed it first
+            if time.time() - os.stat(stalefile).st_mtime < self.stale_time:
+                self.put_back(stalefile, filename)  # touched by its owner just before it was moved
+                return False
+            os.remove(stalefile)
+            print("queue: reclaiming orientation " + str(irun) + " (no heartbeat for " + str("%8.1f"%age) + " s)")
+            try:
+                fd = os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                return False
+
+        self.token = self.worker + ":" + uuid.uuid4().hex
+        with os.fdopen(fd, 'w') as claimfile:
+            claimfile.write(self.token + "\n")
+
+        if self.is_done(irun):
+            # finished by a worker whose claim was wrongly taken as stale
+            self.drop_claim(irun)
+            return False
+        return True
+
+    def drop_claim(self, irun):
+        """ Remove the claim file of irun if it holds our token """
+        filename = self.claim_file(irun)
+        try:
+            stat = os.stat(filename)
+        except FileNotFoundError:
+            return
+        movedfile = self.take_aside(filename, stat, self.token)
+        if movedfile is not None:
+            os.remove(movedfile)
+        else:
+            print("queue: claim on orientation " + str(irun) + " was taken over by another worker; left in place")
+
+    def _beat(self, filename, token):
+        while not self._stop.wait(self.heartbeat):
+            # touch the file that was read, so that a claim taken over in the meantime is never touched
+            try:
+                fd = os.open(filename, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                with os.fdopen(fd, 'r') as claimfile:
+                    if claimfile.read().strip() == token:
+                        os.utime(claimfile.fileno())
+                    else:
+                        print("queue: lost the claim on " + filename + " to another worker")
+                        return
+            except FileNotFoundError:
+                pass
+
+    def _start_heartbeat(self, irun):
+        self._stop.clear()
+        self._thread = threading.Thread(target = self._beat, args = (self.claim_file(irun), self.token),
+                                        daemon = True)
+        self._thread.start()
+
+    def _stop_heartbeat(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def mark_done(self, irun):
+        """ Write the done marker of irun and drop its claim """
+        self._stop_heartbeat()
+        tmpfile = self.done_file(irun) + "." + str(os.getpid()) + ".tmp"
+        with open(tmpfile, 'w') as donefile:
+            donefile.write(self.worker + " " + time.ctime() + "\n")
+        os.replace(tmpfile, self.done_file(irun))
+        self.drop_claim(irun)
+
+    def release(self, irun):
+        """ Give up the claim on irun without marking it done, so that another worker can take it at once """
+        self._stop_heartbeat()
+        self.drop_claim(irun)
+
+    def __iter__(self):
+        try:
+            while True:
+                irun = None
+                for k in range(self.N_Euler):
+                    jrun = (self.start + k) % self.N_Euler
+                    if self.try_claim(jrun):
+                        irun = jrun
+                        break
+                if irun is None:
+                    break
+
+                self.irun = irun
+                self.nclaimed += 1
+                self._start_heartbeat(irun)
+                print("queue: worker " + self.worker + " claimed orientation " + str(irun))
+
+                yield irun
+
+                self.mark_done(irun)
+                self.irun = None
+        finally:
+            # loop body failed or the loop was left early: the current orientation is not finished
+            if self.irun is not None:
+                self.release(self.irun)
+                self.irun = None
+
+        ndone = sum(1 for irun in range(self.N_Euler) if self.is_done(irun))
+        print("queue: worker " + self.worker + " processed " + str(self.nclaimed) + " orientations; " + \
+              str(ndone) + " of " + str(self.N_Euler) + " done in total")
+
+
+""" ============ completion markers ============ """
+""" bookkeeping parameters of a launch, which do not change any result """
+RUN_KEYS = [ 'queue_launch' ]
+
+
+def params_hash(params, keys = None):
+    """ sha1 of the parameters listed in keys (all parameters except RUN_KEYS if None) """
+    if keys is None:
+        keys = sorted(key for key in params.keys() if key not in RUN_KEYS)
+    h = hashlib.sha1()
+    for key in keys:
+        h.update((key + "=" + str(params.get(key)) + ";").encode())
+    return h.hexdigest()
+
+
+def array_hash(*arrays):
+    """ sha1 of the values of numpy arrays, e.g. the grid of Euler angles the orientation indices refer to """
+    h = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        h.update((str(array.dtype) + str(array.shape) + ";").encode())
+        h.update(array.tobytes())
+    return h.hexdigest()
+
+
+def file_checksum(filename, blocksize = 2**20):
+    """ sha1 of the contents of a file """
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def file_info(filename):
+    """ Size, modification time and checksum of a file, as stored in completion markers """
+    stat = os.stat(filename)
+    return { "size": stat.st_size, "mtime": stat.st_mtime_ns, "checksum": file_checksum(filename) }
+
+
+def file_unchanged(info, filename):
+    """ True if filename is the file described by info (see file_info). The cheap checks (existence, size,
+        modification time) come first; the file is read for the checksum only if they all agree. """
+    if not isinstance(info, dict):
+        return False
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return False
+    if info.get("size") != stat.st_size or info.get("mtime") != stat.st_mtime_ns:
+        return False
+    return info.get("checksum") == file_checksum(filename)
+
+
+def marker_read(markerfile):
+    """ Contents (dict) of a completion marker, None if absent or unreadable """
+    try:
+        with open(markerfile, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def marker_write(markerfile, info):
+    """ Write a completion marker (json). Written to a temporary file and moved into place. """
+    tmpfile = markerfile + "." + str(os.getpid()) + ".tmp"
+    with open(tmpfile, 'w') as f:
+        json.dump(info, f, indent = 4)
+    os.replace(tmpfile, markerfile)
@@ -5,6 +5,7 @@ import itertools
 import sys
 import quaternionic
 import spherical
+from scipy.stats import qmc
 
 
 def read_coefficients(coef_file, coef_thresh=1.0e-16):
@@ -55,25 +56,46 @@ def read_wavepacket(coef_file, coef_thresh=1.0e-16):
     return time, coefs, quanta
 
 
-def calc_rotdens(grid_3d, WDMATS, params):
-    #calc rotdens at a point
+def load_rotdens_wavepacket(params):
+    """ Richmol states and the components of the ro-vibrational wavepacket at time params['rv_wavepacket_time'].
+        Returns (states, quanta, coefs), as needed by calc_rotdens. """
+    itime                    = int( params['rv_wavepacket_time']/    params['rv_wavepacket_dt']  )
+    states                   = read_coefficients(params['rot_coeffs_file'], coef_thresh=1.0e-16)
+    time, coefs, quanta_all  = read_wavepacket(params['rot_wf_file'], coef_thresh=1.0e-16)
+    return states, quanta_all[itime], coefs[itime]
 
-    wavepacket_file = params['rot_wf_file']
-    coef_file       = params['rot_coeffs_file']
 
-    Jmax            = params['Jmax']
-    itime           = int( params['rv_wavepacket_time']/    params['rv_wavepacket_dt']  )
+def wigner_dmats(grid_euler, Jmax, jlist = None):
+    """ Wigner D-matrices on a grid of Euler angles, in the layout of BOUND.gen_wigner_dmats:
+        WDMATS[J][m+J,k+J,ipoint] = D^J_{m,k}(grid_euler[ipoint]). Only J in jlist are filled (all J if None). """
+    wigner  = spherical.Wigner(Jmax)
+    R       = quaternionic.array.from_euler_angles(grid_euler.reshape(-1,3))
+    D       = wigner.D(R).reshape(-1, wigner.Dsize)
 
-    states                   = read_coefficients(coef_file, coef_thresh=1.0e-16)
-    time, coefs, quanta_all  = read_wavepacket(wavepacket_file, coef_thresh=1.0e-16)
-    quanta                   = quanta_all[itime]
+    WDMATS = [None] * (Jmax+1)
+    for J in range(Jmax+1):
+        if jlist is not None and J not in jlist:
+            continue
+        i0 = wigner.Dindex(J,-J,-J) #D is ordered as (J, m, k) with k running fastest
+        WDMATS[J] = np.transpose(D[:,i0:i0+(2*J+1)**2].reshape(-1,2*J+1,2*J+1), (1,2,0))
+    return WDMATS
+
+
+def calc_rotdens(grid_3d, WDMATS, params, wavepacket = None, jacobian = True):
+    """ Rotational probability density of the Richmol wavepacket on a grid of Euler angles grid_3d = (npoints,3).
+
+        wavepacket: (states, quanta, coefs) from load_rotdens_wavepacket; read from params['rot_coeffs_file'] and
+                    params['rot_wf_file'] if None
+        jacobian:   include the sin(beta) factor of the volume element (density in alpha, beta, gamma). Without it,
+                    the density is taken with respect to the invariant (Haar) measure on SO(3).
+    """
+    if wavepacket is None:
+        wavepacket = load_rotdens_wavepacket(params)
+    states, quanta, coefs = wavepacket
 
     npoints_3d = grid_3d.shape[0]
     # mapping between wavepacket and rovibrational states
-    print("shape of grid_3d " + str(grid_3d.shape))
     ind_state = []
-    print(np.shape(quanta))
-    print(quanta)
     for q in quanta:
         j       = q[1] #q[0] = M
         id      = q[2]
@@ -85,42 +107,6 @@ def calc_rotdens(grid_3d, WDMATS, params):
         """
         ind_state.append(istate) #at each time we append an array of indices which locate the current wavepacket in the states dictionary
 
-
-    # lists of J and m quantum numbers
-    jlist = list(set(j for j in quanta[:,1]))
-    mlist = []
-    for j in jlist:
-        mlist.append(list(set(m  for m,jj in zip(quanta[:,0],quanta[:,1]) if jj==j)))
-    print("List of J-quanta:", jlist)
-    print("List of m-quanta:", mlist)
-
-
-    # precompute symmetric-top functions on a 3D grid of Euler angles for given J, m=J, and k=-J..J
-    wigner = spherical.Wigner(Jmax)
-
-    R = quaternionic.array.from_euler_angles(grid_3d)
-
-    print("\nPrecompute symmetric-top functions...")
-    symtop = []
-
-    for J,ml,ij in zip(jlist,mlist,range(len(jlist))):
-        print("J = ", J)
-        print("m = " , ml)
-        print("ij = ", ij)
-        Jfac = np.sqrt((2*J+1)/(8*np.pi**2))
-        symtop.append([])
-
-
-            #D[wigner.Dindex(J, m, k)]
-            #wigner.wiglib.DJ_m_k(int(J), int(m), grid_3d[:,:]) #grid_3d= (3,npoints_3d). Returns wig = array (npoints, 2*J+1) for each k,  #wig Contains values of D-functions on grid, 
-            #D_{m,k}^{(J)} = wig[ipoint,k+J], so that the range for the second argument is 0,...,2J
-            
-        symtop[ij].append( np.conj(WDMATS[int(J)]) * Jfac )
-    print("...done")
-
-    #print(np.shape(symtop))
-    #print(np.shape(symtop[0]))
-
     # compute rotational density
 
     vmax = max([max([v for v in state["v"]]) for state in states])
@@ -133,32 +119,110 @@ def calc_rotdens(grid_3d, WDMATS, params):
         m = q[0]
         j = q[1]
         state = states[istate]
-
-        ind_j = jlist.index(j)
-        ind_m = mlist[ind_j].index(m)
-
-        print(ind_j)
-        print(ind_m)
-        print(m+int(j))
+        Jfac = np.sqrt((2*j+1)/(8*np.pi**2))
 
         # primitive rovibrational function on Euler grid
         func[:,:] = 0
-        print(np.shape(symtop[ind_j]))
-        print(np.shape(WDMATS))
-        print("shape of grid",np.shape(grid_3d))
         for v,k,c in zip(state["v"],state["k"],state["coef"]): #loop over coefficients of primitive symmetric top functions comprising individual components of the wavepacket
             func[:,v] += c * np.conj(WDMATS[int(j)][int(m)+int(j),k+int(j),:]) * Jfac
         # total function
         tot_func[:,:] += func[:,:] * cc
 
     # reduced rotational density on Euler grid
-    dens = np.einsum('ij,ji->i', tot_func, np.conj(tot_func.T)) * np.sin(grid_3d[:,1]) 
-    #tensor contraction: element-wise multuplication of tot_func and transpose of np.conj(tot_func.T)) * np.sin(grid_3d[1,ipoint0:ipoint1] and we take diagonal elements of the output.
+    dens = np.einsum('ij,ji->i', tot_func, np.conj(tot_func.T))
+    #tensor contraction: element-wise multuplication of tot_func and transpose of np.conj(tot_func.T)) and we take diagonal elements of the output.
     # This is to remove the vibrational index. 
+    if jacobian == True:
+        dens *= np.sin(grid_3d[:,1]) 
 
     return grid_3d, dens
 
 
+def haar_candidates(npoints, sampling, seed = None):
+    """ npoints orientations (alpha, beta, gamma) = (npoints,3) distributed uniformly over SO(3): uniform in alpha, cos(beta)
+        and gamma. 
+        
+        sampling = "qmc":        scrambled Sobol sequence (npoints rounded up to a power of 2)
+        sampling = "stratified": one randomly placed point in each cell of an n x n x n grid of equal-volume cells
+                                 (npoints rounded to a cube)
+    """
+    rng = np.random.default_rng(seed)
+    if sampling == "qmc":
+        sobol   = qmc.Sobol(d = 3, scramble = True, seed = rng)
+        u       = sobol.random_base2(m = int(np.ceil(np.log2(npoints))))
+    elif sampling == "stratified":
+        n       = max(1, int(round(npoints**(1/3))))
+        cells   = np.array(list(itertools.product(range(n), repeat = 3)), dtype = float)
+        u       = (cells + rng.random(cells.shape)) / n
+    else:
+        raise ValueError("incorrect rotdens sampling type")
+
+    grid = np.zeros((u.shape[0],3), dtype = float)
+    grid[:,0] = 2.0 * np.pi * u[:,0]
+    grid[:,1] = np.arccos(1.0 - 2.0 * u[:,1])
+    grid[:,2] = 2.0 * np.pi * u[:,2]
+    return grid
+
+
+def resample_orientations(grid, dens, npoints, seed = None):
+    """ Draw npoints orientations from the candidates grid = (ncand,3) with probabilities proportional to dens,
+        by systematic resampling: one random offset, then one draw in each of npoints equal strata of the 
+        cumulative distribution. Repeated draws are merged.
+
+        Returns the distinct orientations and their importance weights (number of draws / npoints, summing to 1).
+    """
+    dens = np.clip(np.asarray(dens, dtype = float), 0.0, None)
+    if np.sum(dens) <= 0.0:
+        raise ValueError("rotational density vanishes on all candidate orientations")
+
+    rng     = np.random.default_rng(seed)
+    cdf     = np.cumsum(dens) / np.sum(dens)
+    cdf[-1] = 1.0
+    pos     = (np.arange(npoints) + rng.random()) / npoints
+    idraw   = np.searchsorted(cdf, pos, side = 'right')
+
+    iunique, counts = np.unique(idraw, return_counts = True)
+    return grid[iunique], counts / float(npoints)
+
+
+def sample_orientations(params):
+    """ Euler grid with importance weights drawn from the rotational density of the Richmol wavepacket.
+
+        params['rotdens_npoints'] * params['rotdens_oversampling'] candidate orientations, uniform over SO(3)
+        (haar_candidates with params['rotdens_sampling']), are weighted with the rotational density and
+        params['rotdens_npoints'] orientations are drawn from them (resample_orientations). An orientation average of
+        an observable O is then sum_i weights[i] * O(grid_euler[i]), which needs few orientations for aligned ensembles.
+
+        Returns (grid_euler, weights) with grid_euler = (N_Euler,3); to be used with params['density_averaging'] = False.
+    """
+    npoints     = params['rotdens_npoints']
+    seed        = params['rotdens_seed']
+    wavepacket  = load_rotdens_wavepacket(params)
+    jlist       = sorted(set(int(j) for j in wavepacket[1][:,1]))
+
+    candidates  = haar_candidates(npoints * params['rotdens_oversampling'], params['rotdens_sampling'], seed)
+    ncand       = candidates.shape[0]
+    print("\nSampling " + str(npoints) + " orientations from the rotational density at t = " + \
+            str(params['rv_wavepacket_time']) + " ps using " + str(ncand) + " candidates (" + params['rotdens_sampling'] + ")")
+
+    """ evaluate the density in chunks: the Wigner matrices for all J <= Jmax take Dsize complex numbers per point """
+    nchunk  = max(1, int(2**24 / spherical.Wigner(params['Jmax']).Dsize))
+    dens    = np.zeros(ncand, dtype = float)
+    for i0 in range(0, ncand, nchunk):
+        chunk           = candidates[i0:i0+nchunk]
+        WDMATS          = wigner_dmats(chunk, params['Jmax'], jlist)
+        _, dens_chunk   = calc_rotdens(chunk, WDMATS, params, wavepacket, jacobian = False)
+        dens[i0:i0+nchunk] = dens_chunk.real
+
+    ess = np.sum(dens)**2 / np.sum(dens**2)
+    print("norm of the rotational density (Monte-Carlo estimate): " + str("%12.6f"%(8.0 * np.pi**2 * np.mean(dens))))
+    print("effective sample size of the candidates: " + str("%12.1f"%ess) + " of " + str(ncand))
+
+    grid_euler, weights = resample_orientations(candidates, dens, npoints, seed)
+    print("Total number of Euler grid points (rotdens): " + str(grid_euler.shape[0]) + " distinct of " + str(npoints) + " draws")
+    return grid_euler, weights
+
+
 def rotdens(npoints, nbatches, ibatch, states, quanta, coefs):
     """
     """
@@ -259,58 +323,24 @@ def rotdens(npoints, nbatches, ibatch, states, quanta, coefs):
 
 
 if __name__ == "__main__":
-
-    coef_file = sys.argv[1]
-    wavepacket_file = sys.argv[2]
-    time0 = round(float(sys.argv[3]),1)
-    dens_name = sys.argv[4]
-
-    states = read_coefficients(coef_file, coef_thresh=1.0e-06)
-    time, coefs, quanta = read_wavepacket(wavepacket_file, coef_thresh=1.0e-06)
-    #time = np.asarray(time)
-    #coefs = np.asarray(coefs)
-    quanta = np.asarray(quanta)
-    for itime in range(0,10):
-    	print(time[itime],quanta[itime],coefs[itime])
-
-    # Cartesian coordinates of D2S
-
-    xyz = np.array([[  0.00000000,        0.00000000,        0.10358697],
-                    [ -0.96311715,        0.00000000,       -0.82217544],
-                    [  0.96311715,        0.00000000,       -0.82217544]], dtype=np.float64)
-
-    # polarizability axes: small, middle, main (c = y, b = z, a = x)
-
-    #xyz = np.array([[0,1,0],
-    #                [0,0,1],
-    #                [1,0,0]], dtype=np.float64)
-
-    time_index = [round(t,1) for t in time].index(time0)
-
-    #for itime in range(len(time)):
-    #    print(itime,time[itime])
-    #sys.exit()
-
-    # manual state entry
-    #quanta0 = np.array([[-10,10,1,1]])
-    #coefs0 = [1.0]
-
-    for itime in [time_index]:
-
-        print(itime, time[itime])
-
-        # compute rotational density
-
-        npoints = 1000000
-        nbatches = 1
-
-        for ibatch in range(nbatches):
-            grid_3d, dens, [ipt1,ipt2] = rotdens(npoints, nbatches, ibatch, states, quanta[itime], coefs[itime])
-            #grid_3d, dens, [ipt1,ipt2] = rotdens(npoints, nbatches, ibatch, states, quanta0, coefs0)
-            if ibatch==0:
-                dens_3d = np.zeros(grid_3d.shape[1], dtype=np.float64)
-            dens_3d[ipt1:ipt2] = dens[:]
-
-        # do monte-carlo
-
-        monte_carlo(grid_3d, dens_3d, xyz, dens_name, npoints=100000)
+    """ Sample an Euler grid with importance weights from a Richmol wavepacket:
+        python3 ROTDENS.py coef_file wavepacket_file time(ps) dt(ps) Jmax npoints path
+        writes path/grid_euler.dat and path/grid_euler_weights.dat (as run_job.save_euler_grid)
+    """
+    params = {  'rot_coeffs_file':      sys.argv[1],
+                'rot_wf_file':          sys.argv[2],
+                'rv_wavepacket_time':   float(sys.argv[3]),
+                'rv_wavepacket_dt':     float(sys.argv[4]),
+                'Jmax':                 int(sys.argv[5]),
+                'rotdens_npoints':      int(sys.argv[6]),
+                'rotdens_oversampling': 64,
+                'rotdens_sampling':     "qmc",
+                'rotdens_seed':         0}
+    path = sys.argv[7]
+
+    grid_euler, weights = sample_orientations(params)
+
+    with open( path + "/grid_euler.dat" , 'w') as eulerfile:   
+        np.savetxt(eulerfile, grid_euler, fmt = '%22.15e')
+    with open( path + "/grid_euler_weights.dat" , 'w') as weightfile:   
+        np.savetxt(weightfile, weights, fmt = '%22.15e')
@@ -73,6 +73,8 @@ def gen_input():
 
     params['esp_method_name']    = "uhf_631Gss"
     params['esp_mode']           = "exact" #exact or interpolate
+    params['esp_interp_method']  = 'linear' #sph: spherical-harmonic expansion of ESP shells + radial spline; linear: 3D LinearNDInterpolator
+    params['esp_interp_lmax']    = 16 #maximum L in the spherical-harmonic expansion of the interpolated ESP
     params['enable_cutoff']      = True #use cut-off for the ESP?
     params['r_cutoff']           = 40.0    
     params['plot_esp']           = False
@@ -30,6 +30,20 @@ def read_input():
 
     params['jobtype'] 	= "slurm" 
 
+    """ local jobs: batches run concurrently, each with local_nthreads OpenMP/MKL/numba threads """
+    params['local_nprocs']      = None  # number of concurrent batches; None -> available cores // local_nthreads
+    params['local_nthreads']    = 1     # threads per batch
+    params['local_retries']     = 1     # number of re-runs of a failed batch
+
+    """ slurm jobs """
+    params['slurm_submit']      = "array"   # "array": all batches in one sbatch --array job; "batch": one sbatch per batch (slurm_run/master_script.sh)
+    params['slurm_throttle']    = None      # maximum number of simultaneously running array tasks (None: no limit)
+    params['slurm_resubmit']    = False     # True: submit again only the batches of the last array job that did not finish with exit code 0
+    params['slurm_partition']   = "cfel-cmi,all"
+    params['slurm_ncpus']       = 32        # cores per array task (OMP threads)
+    params['slurm_time']        = 100       # wall-clock limit per task (hours)
+    params['slurm_sbatch']      = "sbatch"  # sbatch executable; slurm_run/sbatch_stub.py for tests without SLURM
+
 
 
     params['job_label']    = "conv" #job identifier. In case of Psi4 ESP it can be metod/basis specification: "UHF-aug-cc-pVTZ" #"UHF_6-31Gss"
@@ -45,10 +59,16 @@ def read_input():
     params['bound_nlobs_arr']   = (10,10,1)
     params['bound_lmax_arr']    = (6,6,4)
     params['bound_binw_arr']    = (1.0,3.0,11)
+    params['nested_lmax']       = True  # lmax sweep: run the largest lmax first and slice smaller-lmax Hamiltonians out of its H0
 
     params['bound_nbins']   = 30
     params['bound_rshift']  = 0.0
 
+    """ GENERAL RADIAL GRID: list of segments [nbins, nlobs, binw]; None -> uniform bins defined above.
+        Example: [[4,8,0.5],[6,10,2.0],[6,16,12.0]] """
+    params['bound_femlist']     = None
+    params['prop_femlist']      = None #None -> bound_femlist extended up to prop_nbins bins with its last segment
+
     """ CONTINUUM PART"""
 
     params['map_type']      = 'DVR' #DVR, SPECT (mapping of basis set indices)
@@ -68,7 +88,13 @@ def read_input():
 
     params['N_euler'] 	        = 1     # number of euler grid points per dimension (beta angle) for orientation averaging. Alpha and gamma are on double-sized grid.
     params['N_batches'] 	    = 1    # number of batches for orientation averaging
-    params['orient_grid_type']  = "2D"  # 2D or 3D. Use 2D when averaging is performed over phi in W2D.
+    params['orient_queue']      = True  # True: batches claim orientations from a shared queue in job_directory (load balancing); False: fixed chunks of the grid
+    params['queue_heartbeat']   = 30.0  # interval (s) at which a batch confirms it is still working on its orientation
+    params['queue_stale_time']  = 600.0 # a claimed orientation without heartbeat for this long (s) is taken over by another batch
+    params['resume']            = True  # skip orientations with complete outputs (completion markers), continue partially written h5 wavepackets
+    params['orient_grid_type']  = "2D"  # 2D or 3D (uniform grids, N_euler), or SO(3) quadratures with weights: lebedev_3D, lebedev_2D, gauss_3D, gauss_2D, or rotdens (importance sampling of the rotational density). Use 2D when averaging is performed over phi in W2D.
+    params['orient_quad_L']     = 4     # quadratures: all Wigner D^J with J <= orient_quad_L are integrated exactly (2*Jmax for rotational densities)
+    params['orient_symmetry']   = True  # propagate only one orientation per class of orientations equivalent by molecular symmetry
 
     """ ===== Molecule definition ====== """ 
     """
@@ -143,16 +169,20 @@ def read_input():
 
         """ **** parameters of the multipole moment expansion of the ESP **** """
         params['multi_lmax']         = 8 #maximum l in the multipole expansion
+        params['vlm_quad_scheme']    = "lebedev_041" #Lebedev quadrature used to project the ESP onto partial waves in the exact_vlm mode
+        params['vlm_conv_tol']       = 1.0e-6 #exact_vlm: truncate partial waves at the L above which all max|vLM| are below this fraction of max|v00| (None: use multi_lmax)
+        params['multi_method']       = 'analytic' #analytic: moments from the charge centers; grid: quadrature on a multi_ncube_points^3 grid
         params['multi_ncube_points'] = 201
         params['multi_box_edge']     = 20
 
         """==== electrostatic potential ===="""
 
 
-        params['esp_mode']           = "exact" #exact or multipoles or anton. 
+        params['esp_mode']           = "exact" #exact or multipoles or anton or exact_vlm. 
                                         # exact -> use Psi4. 
                                         # multipoles -> perform multipole expansion of the potential from given charge distr.
                                         # anton -> partial wave representation of the potential from A. Artemyev
+                                        # exact_vlm -> partial waves (up to multi_lmax) of the Psi4 ESP calculated once in the molecular frame, rotated with Wigner D-matrices
                                         # use anton with nlobs = 10, nbins = 200, Rbin = 2.0, lmax = 9, Lmax = 8. 1800 grid points. 160k basis size.
 
         params['enable_cutoff']      = True #use cut-off for the ESP?
@@ -161,6 +191,9 @@ def read_input():
         params['scf_enr_conv']       = 1.0e-6 #convergence threshold for SCF
         params['scf_basis']          = 'aug-cc-pVTZ' #"cc-pDTZ" #"631G**"
         params['scf_method']         = 'UHF'
+        params['esp_nprocs']         = 1 #number of parallel psi4 worker processes for the ESP of orientations in a batch (exact mode)
+        params['esp_nthreads']       = 1 #number of threads per psi4 worker process
+        params['esp_scratch_dir']    = None #parent directory for scratch directories of psi4 workers (None: system default)
 
         params['esp_rotation_mode']  = 'mol_xyz' #'on_the_fly', 'to_wf'
         params['plot_esp']           = False
@@ -172,8 +205,11 @@ def read_input():
 
         """===== Hamiltonian parameters ====="""
         params['read_ham_init_file']    = False    # if available read the initial Hamiltonian from file
+        params['ham0_cache']            = True     # reuse H0 and its eigenpairs stored in job_directory/ham0_cache/<hash of all H0 parameters>/
         params['hmat_format']           = "sparse_csr" # numpy_arr
         params['hmat_filter']           = 1e-12 #threshold value (in a.u.) for keeping matrix elements of the field-free Hamiltonian
+        params['sym_blocks']            = False #True: diagonalize and propagate only in the blocks of (l,m) coupled by the Hamiltonian (and the field)
+        params['sym_block_tol']         = 1.0e-12 #couplings above this magnitude connect (l,m) into one block; keep well below hmat_filter
 
         params['num_ini_vec']           = 20 # number of initial wavefunctions (orbitals) stored in file
         params['file_format']           = 'npz' #dat, npz, hdf5 (format for storage of the wavefunction and the Hamiltonian matrix)
@@ -196,6 +232,10 @@ def read_input():
         params['Jmax']              = 60 #maximum J for the ro-vibrational wavefunction
         params['rv_wavepacket_time']= 50
         params['rv_wavepacket_dt']  = 0.1 #richmol time-step in ps #
+        params['rotdens_npoints']      = 200      #orient_grid_type = rotdens: number of orientations drawn from the rotational density (repeated draws are merged)
+        params['rotdens_oversampling'] = 64       #candidate orientations per draw, uniform over SO(3)
+        params['rotdens_sampling']     = "qmc"    #candidates: qmc (scrambled Sobol) or stratified (one random point per equal-volume cell)
+        params['rotdens_seed']         = 0        #random seed of the sampler (None: different grid at each run)
 
         """====  SAVING ===="""
         params['save_ham0']     = True #save the calculated bound state Hamiltonian
@@ -13,33 +13,131 @@ def convert(o):
 
 
 
+def trapz_sin_weights(beta_1d):
+    """ Trapezoid weights in beta (endpoints included) with the sin(beta) measure of SO(3), normalized to 1.
+        Uniform weights if the grid has no interior points (all sin(beta) = 0). """
+    w = np.sin(beta_1d)
+    if len(beta_1d) > 1:
+        w[0]    *= 0.5
+        w[-1]   *= 0.5
+    if np.sum(w) <= 0.0:
+        w = np.ones(len(beta_1d))
+    return w / np.sum(w)
+
+
 def gen_euler_grid_2D(n_euler):
-    """ Cartesian product of 1D grids of Euler angles"""
+    """ Cartesian product of 1D grids of Euler angles. 
+        Returns the grid, its size and the quadrature weights (trapezoid with sin(beta) in beta, uniform in gamma) """
     alpha_1d        = list(np.linspace(0, 2*np.pi,  num=1, endpoint=False))
     beta_1d         = list(np.linspace(0, np.pi,    num=n_euler, endpoint=True))
     gamma_1d        = list(np.linspace(0, 2*np.pi,  num=n_euler, endpoint=False))
     euler_grid_3d   = np.array(list(itertools.product(*[alpha_1d, beta_1d, gamma_1d]))) #cartesian product of [alpha,beta,gamma]
+    weights         = np.array([ wb for wa, wb, wg in itertools.product(*[[1.0], trapz_sin_weights(np.array(beta_1d)), 
+                                                                          np.ones(len(gamma_1d))]) ])
 
     n_euler_3d      = euler_grid_3d.shape[0]
     print("\nTotal number of 2D-Euler grid points: ", n_euler_3d , " and the shape of the 3D grid array is:    ", euler_grid_3d.shape)
     #print(euler_grid_3d)
-    return euler_grid_3d, n_euler_3d
+    return euler_grid_3d, n_euler_3d, weights / np.sum(weights)
 
 def gen_euler_grid(n_euler):
-    """ Cartesian product of 1D grids of Euler angles"""
+    """ Cartesian product of 1D grids of Euler angles
+        Returns the grid, its size and the quadrature weights (trapezoid with sin(beta) in beta, uniform in alpha, gamma) """
     alpha_1d        = list(np.linspace(0, 2*np.pi,  num=n_euler, endpoint=False))
     beta_1d         = list(np.linspace(0, np.pi,    num=n_euler, endpoint=True))
     gamma_1d        = list(np.linspace(0, 2*np.pi,  num=n_euler, endpoint=False))
     euler_grid_3d   = np.array(list(itertools.product(*[alpha_1d, beta_1d, gamma_1d]))) #cartesian product of [alpha,beta,gamma]
+    weights         = np.array([ wb for wa, wb, wg in itertools.product(*[np.ones(len(alpha_1d)), trapz_sin_weights(np.array(beta_1d)), 
+                                                                          np.ones(len(gamma_1d))]) ])
 
     n_euler_3d      = euler_grid_3d.shape[0]
     print("\nTotal number of 3D-Euler grid points: ", n_euler_3d , " and the shape of the 3D grid array is:    ", euler_grid_3d.shape)
     #print(euler_grid_3d)
-    return euler_grid_3d, n_euler_3d
+    return euler_grid_3d, n_euler_3d, weights / np.sum(weights)
+
+def read_leb_degrees(path):
+    """ degrees of the Lebedev grids available in path/lebedev_grids/ """
+    return sorted( int(name[len("lebedev_"):-len(".txt")]) for name in os.listdir(path + "lebedev_grids/")
+                    if name.startswith("lebedev_") and name.endswith(".txt") )
+
+
+def read_leb_grid(degree, path):
+    """ Lebedev grid of given degree as arrays (theta, phi, w) in radians; weights sum to 1 """
+    grid    = np.loadtxt(path + "lebedev_grids/lebedev_" + str(degree).zfill(3) + ".txt")
+    phi     = np.mod(np.pi * grid[:,0] / 180.0, 2.0 * np.pi)
+    theta   = np.pi * grid[:,1] / 180.0
+    return theta, phi, grid[:,2]
+
+
+def gen_euler_quad(grid_type, L, path):
+    """ Quadrature on SO(3) (or on (beta,gamma) with alpha = 0 for "_2D" grids) integrating all Wigner 
+        D-functions D^J_{mk}(alpha,beta,gamma) with J <= L exactly.
+
+        Orientation averages of quantities built from rotational wavefunctions with J <= Jmax (densities, b-coefficients
+        of molecules in rotational wavepackets) need L = 2*Jmax.
+
+        Grid types:
+            "lebedev_3D":   Lebedev (beta,alpha) x trapezoid gamma with L+1 points (L+2 if L+1 is odd). The gamma sum
+                            removes all D^J_{mk} with k != 0; D^J_{m0} are spherical harmonics of (beta,alpha), exact
+                            with a degree >= L grid.
+            "lebedev_2D":   Lebedev (beta,gamma), alpha = 0: for quantities averaged over alpha (e.g. W2Dav over phi).
+            "gauss_3D":     Gauss-Legendre in cos(beta) with L//2+1 nodes x trapezoid alpha and gamma.
+            "gauss_2D":     Gauss-Legendre in cos(beta) x trapezoid gamma, alpha = 0.
+
+        Returns:
+            grid_euler: numpy array (N,3) of (alpha,beta,gamma)
+            weights: numpy array (N), normalized to 1
+    """
+    nphi = L + 1 + (L + 1) % 2 #even number of trapezoid points: grids are closed under alpha -> alpha + pi and gamma -> gamma + pi,
+                               #i.e. under C2 rotations about the z axis, see BOUND.gen_euler_equivalence
+
+    if grid_type in ("lebedev_3D", "lebedev_2D"):
+        degrees = [ deg for deg in read_leb_degrees(path) if deg >= L ]
+        if not degrees:
+            raise ValueError("No Lebedev grid of degree >= " + str(L) + " in " + path + "lebedev_grids/")
+        beta, phi, w_sph = read_leb_grid(degrees[0], path)
+        print("Lebedev grid of degree " + str(degrees[0]) + " with " + str(beta.shape[0]) + " points")
+
+        if grid_type == "lebedev_2D":
+            grid_euler  = np.stack((np.zeros_like(beta), beta, phi), axis = 1)
+            weights     = w_sph
+        else:
+            gamma       = np.linspace(0, 2*np.pi, num = nphi, endpoint = False)
+            grid_euler  = np.array([ [a, b, g] for a, b in zip(phi, beta) for g in gamma ])
+            weights     = np.repeat(w_sph, gamma.shape[0]) / gamma.shape[0]
+
+    elif grid_type in ("gauss_3D", "gauss_2D"):
+        x, w_beta   = np.polynomial.legendre.leggauss(L//2 + 1)
+        beta        = np.arccos(x)
+        gamma       = np.linspace(0, 2*np.pi, num = nphi, endpoint = False)
+
+        if grid_type == "gauss_2D":
+            alpha   = np.zeros(1)
+        else:
+            alpha   = np.linspace(0, 2*np.pi, num = nphi, endpoint = False)
+
+        grid_euler  = np.array(list(itertools.product(*[alpha, beta, gamma])))
+        weights     = np.array([ wb for a in alpha for wb in w_beta for g in gamma ])
+
+    else:
+        raise ValueError("incorrect euler grid type")
 
-def save_euler_grid(grid_euler, path):   
+    weights = weights / np.sum(weights)
+
+    print("\nTotal number of Euler grid points (" + grid_type + ", exact for J <= " + str(L) + "): ", grid_euler.shape[0])
+    return grid_euler, weights
+
+
+def save_euler_grid(grid_euler, path, weights = None):   
+    """ grid_euler.dat: (alpha, beta, gamma) per orientation; grid_euler_weights.dat: quadrature weights.
+        Both are written at full double precision: the quadratures are exact to round-off only for the exact nodes. """
     with open( path + "grid_euler.dat" , 'w') as eulerfile:   
-        np.savetxt(eulerfile, grid_euler, fmt = '%15.4f')
+        np.savetxt(eulerfile, grid_euler, fmt = '%22.15e')
+
+    if weights is None:
+        weights = np.full(grid_euler.shape[0], 1.0 / grid_euler.shape[0])
+    with open( path + "grid_euler_weights.dat" , 'w') as weightfile:   
+        np.savetxt(weightfile, weights, fmt = '%22.15e')
 
 def save_input_file(params,filename):
     with open(params['job_directory']+ "input_"+filename, 'w') as input_file: 
@@ -77,10 +175,16 @@ def gen_inputs_list(params_input):
     params_list = []
 
     """ Generate a grid of molecular orientations parametrized with the Euler angles"""
+    weights_euler = None #uniform weights
     if params_input['orient_grid_type'] == "3D":
-        grid_euler, params_input['n_grid_euler_3d'] = gen_euler_grid(params_input['N_euler'])            
+        grid_euler, params_input['n_grid_euler_3d'], weights_euler = gen_euler_grid(params_input['N_euler'])            
     elif params_input['orient_grid_type'] == "2D":
-        grid_euler, params_input['n_grid_euler_2d'] = gen_euler_grid_2D(params_input['N_euler'])            
+        grid_euler, params_input['n_grid_euler_2d'], weights_euler = gen_euler_grid_2D(params_input['N_euler'])            
+    elif params_input['orient_grid_type'] in ("lebedev_3D", "lebedev_2D", "gauss_3D", "gauss_2D"):
+        grid_euler, weights_euler = gen_euler_quad(params_input['orient_grid_type'], params_input['orient_quad_L'], 
+                                                    os.path.dirname(os.path.abspath(__file__)) + "/")
+    elif params_input['orient_grid_type'] == "rotdens":
+        grid_euler = None #sampled from the rotational density below, once the wavepacket file paths are set up
     else:
         raise ValueError("incorrect euler grid typ")
 
@@ -100,6 +204,8 @@ def gen_inputs_list(params_input):
 
     binrange    = np.linspace(rbinmin,rbinmax,nrbin,endpoint=True,dtype=float)
     lrange      = np.linspace(lmin,lmax,nl,endpoint=True,dtype=int)
+    if params_input['nested_lmax'] == True:
+        lrange  = lrange[::-1] #largest lmax first: smaller-lmax jobs slice their Hamiltonians out of its H0 (PROPAGATE.ham0_nested_read)
     nrange      = np.linspace(nlobmin,nlobmax,nlobattos,endpoint=True,dtype=int)
 
     
@@ -115,8 +221,14 @@ def gen_inputs_list(params_input):
                 params_input['bound_binw'] = r
 
                 params_list.append(setup_input(params_input))
+
+    if params_input['orient_grid_type'] == "rotdens" and params_input['mode'] == 'propagate':
+        if params_input['density_averaging'] == True:
+            raise ValueError("orientations sampled from the rotational density must not be averaged with the density again")
+        import ROTDENS #imported here: needs spherical, quaternionic and scipy.stats.qmc, which other grids do not
+        grid_euler, weights_euler = ROTDENS.sample_orientations(params_list[0])
                
-    return params_list, grid_euler
+    return params_list, grid_euler, weights_euler
 
 def field_params(params):
     """ Define field parameters"""
@@ -183,8 +295,11 @@ def setup_input(params_input):
         params['main_dir']      = "/home/emil/Desktop/projects/PECD_personal/PECD/pecd/"
         params['working_dir']   = "/home/emil/Desktop/projects/PECD_personal/PECD/tests/molecules/" + params['molec_name'] + "/"
 
-    """ !!!In this version we are using uniform sized bins, allowing for an array of jobs
-        Later expand to general radial basis defined by FEMLIST + array of input parameters!!!"""
+    """ Uniform bins are generated from (bound_nbins, bound_nlobs, bound_binw), allowing for an array of jobs.
+        A general radial basis is given by params['bound_femlist'] = [[nbins, nlobs, binw], ...]: fine bins
+        near the molecule, wide bins of higher order in the asymptotic region. The propagation grid
+        params['prop_femlist'] must start with the bins of the bound grid; if not given, the bound grid is extended
+        with bins of the last segment up to prop_nbins bins in total."""
 
     #params['bound_nbins'], params['bound_nlobs'], params['bound_binw'] =  params_input['bound_nbins'], params_input['bound_nlobs'], params_input['bound_binw']
     #params['nbins'], params['nlobs'], params['binw'] = params_input['bound_nbins'], params_input['bound_nlobs'], params_input['bound_binw']
@@ -193,11 +308,27 @@ def setup_input(params_input):
     """ list defining the radial grid"""
 
 
-    params['FEMLIST']   = [     [params['bound_nbins'], params['bound_nlobs'], params['bound_binw']] ,\
-                                [0, params['bound_nlobs'], params['bound_binw']] ] 
+    if params.get('bound_femlist') is None:
+        params['FEMLIST']   = [     [params['bound_nbins'], params['bound_nlobs'], params['bound_binw']] ,\
+                                    [0, params['bound_nlobs'], params['bound_binw']] ] 
+
+        params['FEMLIST_PROP']   = [ [params['prop_nbins'], params['bound_nlobs'], params['bound_binw']] ,\
+                                    [0, params['bound_nlobs'], params['bound_binw']] ] 
+    else:
+        params['FEMLIST']       = [ list(elem) for elem in params['bound_femlist'] ]
+        params['bound_nbins']   = sum( int(elem[0]) for elem in params['FEMLIST'] )
+
+        if params.get('prop_femlist') is None:
+            last = params['FEMLIST'][-1]
+            params['FEMLIST_PROP']  = params['FEMLIST'] + [ [params['prop_nbins'] - params['bound_nbins'], last[1], last[2]] ]
+        else:
+            params['FEMLIST_PROP']  = [ list(elem) for elem in params['prop_femlist'] ]
+            params['prop_nbins']    = sum( int(elem[0]) for elem in params['FEMLIST_PROP'] )
 
-    params['FEMLIST_PROP']   = [ [params['prop_nbins'], params['bound_nlobs'], params['bound_binw']] ,\
-                                [0, params['bound_nlobs'], params['bound_binw']] ] 
+        bins0   = [ (elem[1], elem[2]) for elem in params['FEMLIST'] for i in range(int(elem[0])) ]
+        bins    = [ (elem[1], elem[2]) for elem in params['FEMLIST_PROP'] for i in range(int(elem[0])) ]
+        if bins[:len(bins0)] != bins0:
+            raise ValueError("the propagation grid must start with the bins of the bound grid")
 
 
     params['job_directory'] =  params['working_dir'] + params['molec_name']   + \
@@ -207,10 +338,13 @@ def setup_input(params_input):
                                 "_" + str(params['bound_nbins'])   + \
                                 "_" + str(params['job_label']) +"/"
 
+    """ directory shared by all jobs of a parameter sweep: ESP store and nested H0 matrices """
+    params['sweep_directory'] = params['working_dir'] + params['molec_name'] + "_sweep_" + str(params['job_label']) + "/"
 
-    if params['mode'] == 'propagate':
 
+    if params['mode'] == 'propagate':
 
+        """ Richmol wavepacket for the rotational density (ROTDENS) """
         params['rot_wf_file']       = params['working_dir'] + "rv_wavepackets/" + "wavepacket_J60.h5"
         params['rot_coeffs_file']   = params['working_dir'] + "rv_wavepackets/" + "coefficients_j0_j60.rchm"
 
@@ -302,18 +436,22 @@ def setup_input(params_input):
 
     return params
 
-def run_array_job(params_list,grid_euler):
+def run_array_job(params_list,grid_euler,weights_euler = None):
 
     for iparams in params_list:
 
         """ Create directories """
         path = create_dirs(iparams)
 
+        """ Each launch gets its own orientation queue (QUEUE.orientation_queue): orientations completed by earlier
+            launches are skipped only if their completion markers validate (params['resume']) """
+        iparams['queue_launch'] = time.strftime("%Y%m%d-%H%M%S") + "-" + str(os.getpid())
+
         if iparams['mode'] == 'propagate':
             """ Save input file and euler angles grid """
             print("mode = propagate")
             save_input_file(iparams,"prop")
-            save_euler_grid(grid_euler, path)
+            save_euler_grid(grid_euler, path, weights_euler)
 
         elif iparams['mode'] == 'analyze':
             print("mode = analyze")
@@ -324,7 +462,14 @@ def run_array_job(params_list,grid_euler):
 
         """ Run batches """
 
-        if iparams['jobtype'] == "slurm":
+        if iparams['jobtype'] == "slurm" and iparams['slurm_submit'] == "array":
+            print("Submitting a SLURM job array")
+            if iparams['mode'] == "propagate":
+                run_slurm_array(iparams, "PROPAGATE.py")
+            elif iparams['mode'] == "analyze":
+                run_slurm_array(iparams, "ANALYZE.py")
+
+        elif iparams['jobtype'] == "slurm":
             flag = []
             print("Submitting a SLURM job")
             path = os.getcwd()
@@ -354,7 +499,6 @@ def run_array_job(params_list,grid_euler):
             print(flag)
 
         elif iparams['jobtype'] == "local":
-            flag = []
             print("Executing local job")
             
             path = os.getcwd()
@@ -362,21 +506,228 @@ def run_array_job(params_list,grid_euler):
             print ("Job directory is %s" % iparams['job_directory'])
             print("Number of batches = " + str(iparams['N_batches']))
 
-            for ibatch in range(0,iparams['N_batches']):
-                if iparams['mode'] == "propagate":
-                    pecd_process = "python3 PROPAGATE.py " 	+ str(ibatch)  + " " +str(iparams['job_directory'])
-                    iflag = subprocess.call(pecd_process, shell=True) 
-                    flag.append([ibatch,iflag])
-
-                elif iparams['mode'] == "analyze":
-                    pecd_process = "python3 ANALYZE.py " 	+ str(ibatch)  + " " +str(iparams['job_directory'])
-                    iflag = subprocess.call(pecd_process, shell=True) 
-                    flag.append([ibatch,iflag])
+            if iparams['mode'] == "propagate":
+                flag = run_local_batches(iparams, "PROPAGATE.py")
+            elif iparams['mode'] == "analyze":
+                flag = run_local_batches(iparams, "ANALYZE.py")
 
             print("Termination flags for euler grid array job: [ibatch,flag]")
             print(flag)
 
 
+def slurm_array_spec(indices, throttle = None):
+    """ sbatch --array specification: [0,1,2,3,7,9,10,11], 4 -> '0-3,7,9-11%4' """
+    indices = sorted(indices)
+    ranges  = []
+    for i in indices:
+        if ranges and i == ranges[-1][1] + 1:
+            ranges[-1][1] = i
+        else:
+            ranges.append([i, i])
+
+    spec = ",".join( str(first) if first == last else str(first) + "-" + str(last) for first, last in ranges )
+    if throttle is not None:
+        spec += "%" + str(int(throttle))
+    return spec
+
+
+def slurm_failed_batches(params, script, batches):
+    """ Batches of the manifest without a zero exit code in job_directory/slurm_status/. A missing status file
+        means that the task did not finish (time limit, node failure, cancelled), so this has to be called after
+        the array job has left the queue. """
+    statusdir   = params['job_directory'] + "slurm_status/"
+    failed      = []
+    for ibatch in batches:
+        statusfile = statusdir + script + "_" + str(ibatch) + ".exit"
+        if not os.path.isfile(statusfile):
+            failed.append(ibatch)
+            continue
+        with open(statusfile, 'r') as f:
+            if f.read().strip() != "0":
+                failed.append(ibatch)
+    return failed
+
+
+def run_slurm_array(params, script):
+    """ Submit all batches as one SLURM job array with a single sbatch call.
+
+        Array index = batch id: each task (slurm_run/run_array_task.sh) runs "python3 script ibatch job_directory"
+        for ibatch = SLURM_ARRAY_TASK_ID and writes its exit code to job_directory/slurm_status/. The batches and
+        all submissions are recorded in the manifest job_directory/slurm_manifest_<script>.json.
+        params['slurm_throttle'] limits the number of simultaneously running tasks. With params['slurm_resubmit']
+        = True only the batches of an existing manifest which did not finish with exit code 0 are submitted again.
+        params['slurm_sbatch'] is the sbatch executable, e.g. slurm_run/sbatch_stub.py for tests.
+
+        Returns:
+            jobid: SLURM job id of the array (None if nothing was submitted)
+    """
+    name            = os.path.splitext(script)[0]
+    manifestfile    = params['job_directory'] + "slurm_manifest_" + name + ".json"
+    statusdir       = params['job_directory'] + "slurm_status/"
+    os.makedirs(statusdir, exist_ok = True)
+
+    if params['slurm_resubmit'] == True and os.path.isfile(manifestfile):
+        with open(manifestfile, 'r') as f:
+            manifest = json.load(f)
+        batches = slurm_failed_batches(params, script, manifest['batches'])
+        print("Resubmitting failed batches: " + str(batches))
+        if not batches:
+            print("All batches in " + manifestfile + " finished successfully, nothing to submit")
+            return None
+    else:
+        manifest = {    "script":           script,
+                        "job_directory":    params['job_directory'],
+                        "batches":          list(range(params['N_batches'])),
+                        "submissions":      [] }
+        batches = manifest['batches']
+
+    """ remove stale exit codes of the batches to be run """
+    for ibatch in batches:
+        statusfile = statusdir + script + "_" + str(ibatch) + ".exit"
+        if os.path.isfile(statusfile):
+            os.remove(statusfile)
+
+    spec    = slurm_array_spec(batches, params['slurm_throttle'])
+    jobname = "pecd_" + name
+    sbatch  = [ params['slurm_sbatch'], "--parsable",
+                "--partition=" + params['slurm_partition'],
+                "--ntasks=1",
+                "--cpus-per-task=" + str(params['slurm_ncpus']),
+                "--time=" + str(params['slurm_time']) + ":00:00",
+                "--job-name=" + jobname,
+                "--array=" + spec,
+                "--output=" + params['job_directory'] + jobname + "_%a.o",
+                "--error=" + params['job_directory'] + jobname + "_%a.e",
+                params['main_dir'] + "slurm_run/run_array_task.sh", params['job_directory'], script, params['main_dir'] ]
+
+    print(" ".join(sbatch))
+    result = subprocess.run(sbatch, stdout = subprocess.PIPE, stderr = subprocess.PIPE, universal_newlines = True)
+    if result.returncode != 0:
+        raise ValueError("sbatch failed with exit code " + str(result.returncode) + ": " + result.stderr.strip())
+
+    jobid = result.stdout.strip().split(";")[0]
+    print("Submitted array job " + jobid + " with " + str(len(batches)) + " tasks: --array=" + spec)
+
+    manifest['submissions'].append({"jobid": jobid, "array": spec, "batches": batches, "time": time.ctime()})
+    tmpfile = manifestfile + "." + str(os.getpid()) + ".tmp"
+    with open(tmpfile, 'w') as f:
+        json.dump(manifest, f, indent = 4, default = convert)
+    os.replace(tmpfile, manifestfile)
+
+    return jobid
+
+
+def local_pool_size(params):
+    """ Number of batches run concurrently by the local executor.
+
+        Each child gets params['local_nthreads'] OpenMP/MKL/numba threads. With params['local_nprocs'] = None
+        the pool fills the cores available to this process, i.e. ncores // local_nthreads.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        ncores = len(os.sched_getaffinity(0))
+    else:
+        ncores = os.cpu_count() or 1
+
+    nthreads = max(1, int(params['local_nthreads']))
+
+    if params['local_nprocs'] is None:
+        nprocs = max(1, ncores // nthreads)
+    else:
+        nprocs = int(params['local_nprocs'])
+        if nprocs < 1:
+            raise ValueError("local_nprocs must be a positive integer or None")
+        if nprocs * nthreads > ncores:
+            print("Warning: local_nprocs * local_nthreads = " + str(nprocs * nthreads) + \
+                  " exceeds the number of available cores = " + str(ncores))
+
+    return min(nprocs, params['N_batches']), nthreads
+
+
+def local_child_env(nthreads):
+    """ Environment of a batch process with its thread pools capped at nthreads """
+    env = os.environ.copy()
+    for key in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS", "NUMBA_NUM_THREADS"):
+        env[key] = str(nthreads)
+    return env
+
+
+def run_local_batches(params, script):
+    """ Run all batches of an array job on the local machine, several at a time.
+
+        Batches are started as separate processes ("python3 script ibatch job_directory") from the current
+        directory, at most local_pool_size(params) at once. Output of batch ibatch goes to
+        job_directory/logs/<script>_<ibatch>.log (appended to on retries). A batch with non-zero exit code is
+        re-queued up to params['local_retries'] times.
+
+        Returns:
+            flag: list [ibatch, exit code of the last attempt]
+    """
+    nprocs, nthreads = local_pool_size(params)
+    env = local_child_env(nthreads)
+
+    logdir = os.path.join(params['job_directory'], "logs")
+    os.makedirs(logdir, exist_ok = True)
+    name = os.path.splitext(script)[0]
+
+    print("Local executor: " + str(nprocs) + " concurrent batches x " + str(nthreads) + " threads, " + \
+          str(params['local_retries']) + " retries per batch")
+    print("Batch logs in " + logdir)
+
+    pending     = list(range(params['N_batches']))
+    attempts    = {ibatch: 0 for ibatch in pending}
+    running     = {}  # ibatch -> (process, log file, start time)
+    exitcode    = {}
+    nfailed     = 0
+
+    start_time = time.time()
+    while pending or running:
+
+        """ start queued batches """
+        while pending and len(running) < nprocs:
+            ibatch = pending.pop(0)
+            attempts[ibatch] += 1
+            logfile = open(os.path.join(logdir, name + "_" + str(ibatch) + ".log"), "a")
+            logfile.write("==== attempt " + str(attempts[ibatch]) + ", " + time.ctime() + " ====\n")
+            logfile.flush()
+            process = subprocess.Popen(["python3", script, str(ibatch), str(params['job_directory'])],
+                                        stdout = logfile, stderr = subprocess.STDOUT, env = env)
+            running[ibatch] = (process, logfile, time.time())
+            print("batch " + str(ibatch) + ": started (attempt " + str(attempts[ibatch]) + ", pid " + str(process.pid) + ")")
+
+        time.sleep(1.0)
+
+        """ collect finished batches """
+        changed = False
+        for ibatch in list(running.keys()):
+            process, logfile, t0 = running[ibatch]
+            iflag = process.poll()
+            if iflag is None:
+                continue
+
+            logfile.close()
+            del running[ibatch]
+            changed = True
+            exitcode[ibatch] = iflag
+
+            if iflag == 0:
+                print("batch " + str(ibatch) + ": done in " + str("%10.1f"%(time.time() - t0)) + " s")
+            elif attempts[ibatch] <= params['local_retries']:
+                print("batch " + str(ibatch) + ": failed with exit code " + str(iflag) + ", retrying")
+                pending.append(ibatch)
+            else:
+                nfailed += 1
+                print("batch " + str(ibatch) + ": failed with exit code " + str(iflag) + \
+                      " after " + str(attempts[ibatch]) + " attempts, see " + logfile.name)
+
+        if changed:
+            ndone = sum(1 for ibatch in exitcode if exitcode[ibatch] == 0)
+            print("progress: " + str(ndone) + " done, " + str(nfailed) + " failed, " + str(len(running)) + \
+                  " running, " + str(len(pending)) + " queued of " + str(params['N_batches']) + " batches; elapsed " + \
+                  str("%10.1f"%(time.time() - start_time)) + " s")
+
+    return [[ibatch, exitcode[ibatch]] for ibatch in range(params['N_batches'])]
+
+
 
 
 if __name__ == "__main__":    
@@ -390,6 +741,6 @@ if __name__ == "__main__":
     params_input = input_module.read_input()
     print("jobtype: " + str(params_input['jobtype']))
 
-    params_list, grid_euler = gen_inputs_list(params_input)
+    params_list, grid_euler, weights_euler = gen_inputs_list(params_input)
 
-    run_array_job(params_list,grid_euler)
\ No newline at end of file
+    run_array_job(params_list,grid_euler,weights_euler)
\ No newline at end of file
@@ -0,0 +1,30 @@
+#!/bin/bash
+# Task of a SLURM job array: $1 job directory, $2 python script (PROPAGATE.py or ANALYZE.py), $3 main directory
+# The batch id is the array index. The exit code is written to $1slurm_status/$2_<batch>.exit
+
+export ibatch=$SLURM_ARRAY_TASK_ID
+export OMP_NUM_THREADS=${SLURM_CPUS_PER_TASK:-1}
+export MKL_NUM_THREADS=$OMP_NUM_THREADS
+export NUMBA_NUM_THREADS=$OMP_NUM_THREADS
+export OMP_STACKSIZE=8000m
+export KMP_STACKSIZE=8000m
+export XDG_RUNTIME_DIR=`pwd`
+export DISPLAY=:0.0
+ulimit -s unlimited
+
+echo "Number of OMP threads :" $OMP_NUM_THREADS
+echo "Executable :" python3 $3$2
+echo "Batch :" $ibatch
+echo "Running on master node :" `hostname`
+echo "Job ID :" $SLURM_ARRAY_JOB_ID"_"$SLURM_ARRAY_TASK_ID
+echo "Start time :" `date`
+echo "Job directory:" $1
+
+mkdir -p $1slurm_status
+python3 $3$2 $ibatch $1 > $1$2_$ibatch.log 2> $1$2_$ibatch.err
+flag=$?
+echo $flag > $1slurm_status/$2_$ibatch.exit
+
+echo "Exit code :" $flag
+echo "Finish time :" `date`
+exit $flag
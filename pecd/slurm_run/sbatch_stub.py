@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+""" Stand-in for sbatch to test array submissions without SLURM: set params['slurm_sbatch'] to the path of this file.
+
+    The command line is appended to sbatch_stub.log in the current directory and a job id is printed as with
+    sbatch --parsable. With SBATCH_STUB_RUN=1 in the environment, the tasks of an --array job are executed one after
+    another, with SLURM_ARRAY_TASK_ID, SLURM_ARRAY_JOB_ID and SLURM_CPUS_PER_TASK set as on the cluster.
+"""
+import os
+import subprocess
+import sys
+import time
+
+
+def parse_array(spec):
+    """ '0-3,7,9-11%4' -> [0,1,2,3,7,9,10,11] """
+    indices = []
+    for elem in spec.split("%")[0].split(","):
+        if "-" in elem:
+            first, last = elem.split("-")
+            indices.extend(range(int(first), int(last) + 1))
+        else:
+            indices.append(int(elem))
+    return indices
+
+
+if __name__ == "__main__":
+
+    options = {}
+    args    = sys.argv[1:]
+    while args and args[0].startswith("--"):
+        key, _, value = args.pop(0)[2:].partition("=")
+        options[key] = value
+
+    jobid = str(int(time.time() * 1000) % 10**7)
+
+    with open("sbatch_stub.log", "a") as logfile:
+        logfile.write(jobid + " " + " ".join(sys.argv[1:]) + "\n")
+
+    if os.environ.get("SBATCH_STUB_RUN") == "1" and "array" in options:
+        for itask in parse_array(options["array"]):
+            env = os.environ.copy()
+            env["SLURM_ARRAY_JOB_ID"]   = jobid
+            env["SLURM_ARRAY_TASK_ID"]  = str(itask)
+            env["SLURM_CPUS_PER_TASK"]  = options.get("cpus-per-task", "1")
+            subprocess.call(["bash"] + args, env = env, stdout = subprocess.DEVNULL)
+
+    print(jobid)